@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Per-message cost of command and alias matching.
+
+Compares TheBot.parse_text with the per-alias find_and_extract loops it
+replaced (kept below as old_parse_text) and checks that both give the
+same command and arguments for every message.
+
+Usage: PYTHONPATH=bin python3 bench/command_matching.py
+'''
+
+import argparse
+import os
+import timeit
+
+from yanbinbot import TheBot, get_next_token
+
+
+PROJ_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXTRA_MESSAGES = [
+    'кунгфу занятия в понедельник', 'занятие кунгфу сегодня', 'что у шифу в субботу',
+    'ци гун во вторник', 'дети завтра', 'инструкторы', '/today', 'валера',
+    'расписание на неделю пожалуйста', 'ян бин послезавтра цигун', 'привет',
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--number', type=int, default=2000)
+    return parser.parse_args()
+
+
+def old_parse_text(bot, text):
+    text, _ = bot.find_and_extract(text, 'занятия|занятие')
+    text, _ = bot.find_and_extract(text, 'в|во')
+    for alias, name in bot.teacher_aliases.items():
+        txt, replaced = bot.find_and_extract(text, alias)
+        if replaced:
+            text = txt + ' ' + name
+            break
+    cmd = None
+    if text[:1] == '/':
+        text = text[1:]
+    else:
+        for c in list(bot.CmdMap.keys()) + list(bot.cmd_aliases.keys()):
+            text, word = bot.find_and_extract(text, c)
+            if word != None:
+                cmd = c
+                rest = text
+                break
+    if not cmd:
+        cmd, rest = get_next_token(text)
+    return cmd, rest
+
+
+def messages():
+    result = list(EXTRA_MESSAGES)
+    tests_dir = os.path.join(PROJ_DIR, 'tests')
+    for name in sorted(os.listdir(tests_dir)):
+        queries = os.path.join(tests_dir, name, 'queries.txt')
+        if os.path.exists(queries):
+            with open(queries, 'rb') as f:
+                result += f.read().decode('utf-8').splitlines()
+    return [m.lower() for m in result]
+
+
+def main(args):
+    bot = TheBot()
+    texts = messages()
+    for text in texts:
+        old, new = old_parse_text(bot, text), bot.parse_text(text)
+        assert old == new, (text, old, new)
+    for label, parse in [('find_and_extract loop', lambda t: old_parse_text(bot, t)),
+                         ('AliasMatcher', bot.parse_text)]:
+        seconds = timeit.timeit(lambda: [parse(t) for t in texts], number=args.number)
+        print('{0:>21}: {1:.1f} us per message'.format(label, seconds / args.number / len(texts) * 1e6))
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Per-update cost of hot path logging and metrics.
+
+Compares the logging.warning of every getUpdates payload and bot API
+response that the bot used to do with the sampled hot log, disabled and
+enabled at 1%, and with the metrics counting around an update.
+
+Usage: PYTHONPATH=bin python3 bench/hot_path_logging.py
+'''
+
+import argparse
+import io
+import json
+import logging
+import timeit
+
+from hotlog import HotLog
+import metrics
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--number', type=int, default=20000)
+    return parser.parse_args()
+
+
+def make_updates(count=5):
+    return [{'update_id': 1000 + i, 'message': {
+        'message_id': 50 + i, 'text': 'кунгфу завтра после 18', 'date': 1451910000,
+        'chat': {'id': 12345678, 'type': 'private', 'first_name': 'Иван'},
+        'from': {'id': 12345678, 'first_name': 'Иван', 'username': 'ivan'}}} for i in range(count)]
+
+
+def main(args):
+    stream = io.StringIO()
+    logging.basicConfig(stream=stream, format='[%(levelname)s] %(asctime)s: %(message)s', level=logging.WARNING)
+    updates = make_updates()
+    response = json.dumps({'ok': True, 'result': {'message_id': 1, 'text': 'x' * 500}})
+    hot = HotLog('bench.hot')
+
+    def old():
+        logging.warning('got updates: %s', str(updates))
+        logging.warning(response)
+
+    def new():
+        hot.debug('updates', count=len(updates), updates=updates)
+        hot.debug('response', method='sendMessage', status=200, size=len(response))
+
+    def counted():
+        with metrics.GET_UPDATES.time():
+            pass
+        metrics.UPDATES.inc()
+
+    cases = [('logging.warning', old), ('hot log disabled', new)]
+    for label, func in cases:
+        seconds = timeit.timeit(func, number=args.number)
+        print('{0:>18}: {1:.2f} us per update'.format(label, seconds / args.number * 1e6))
+    hot.configure(level=logging.DEBUG, sample=0.01)
+    seconds = timeit.timeit(new, number=args.number)
+    print('{0:>18}: {1:.2f} us per update'.format('hot log 1% sample', seconds / args.number * 1e6))
+    seconds = timeit.timeit(counted, number=args.number)
+    print('{0:>18}: {1:.2f} us per update'.format('metrics', seconds / args.number * 1e6))
+
+
+if __name__ == '__main__':
+    main(parse_args())
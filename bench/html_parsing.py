@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''CPU time and peak memory of reading the schedule tables from the page.
+
+Compares the streaming parser of schedule.fetcher with the former path:
+a pyquery DOM of the whole page and a parse template per row. The old
+path needs pyquery and parse installed, it is skipped without them. The
+saved page is inflated by appending --copies copies of its rows to every
+table and a large tail after the tables, as the published page has.
+tracemalloc does not see lxml's own allocations, so the peak memory of
+the old path is a lower bound.
+
+Usage: PYTHONPATH=bin python3 bench/html_parsing.py -c 20
+'''
+
+import argparse
+import os
+import time
+import tracemalloc
+
+import schedule.fetcher
+
+
+PROJ_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGE = os.path.join(PROJ_DIR, 'tests', 'real_data', 'schedule.html')
+ROW_PARSERS = [schedule.fetcher.parse_lesson_from_qigong_table,
+               schedule.fetcher.parse_lesson_from_kungfu_table,
+               schedule.fetcher.parse_lesson_from_children_table]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-c', '--copies', type=int, default=20)
+    parser.add_argument('-n', '--repeat', type=int, default=5)
+    return parser.parse_args()
+
+
+def inflated_page(copies):
+    with open(PAGE, 'rb') as f:
+        page = f.read().decode('utf-8')
+    tables = page.split('</table>')
+    for i, table in enumerate(tables[:-1]):
+        rows = table[table.index('<tr>', table.index('<tr>') + 1):]
+        tables[i] = table + rows * copies
+    tail = '<div class="grid">{0}</div>'.format('<span>cell</span>' * 20000 * copies)
+    return '</table>'.join(tables).replace('</body>', tail + '</body>').encode('utf-8')
+
+
+def streaming(page):
+    tables = schedule.fetcher.read_tables(page[i:i + schedule.fetcher.CHUNK_SIZE]
+                                          for i in range(0, len(page), schedule.fetcher.CHUNK_SIZE))
+    return [schedule.fetcher.parse_table(t, p) for t, p in zip(tables, ROW_PARSERS)]
+
+
+def old_parse_lesson(kind, row):
+    import parse
+    from schedule.schedule import Lesson
+    templates = {
+        'qigong': '{starts}###{ends}###{name}###{place}###{teacher}###{comment}'
+                  '###{difficulty}###{complex}###{}###{audience}',
+        'kungfu': '{starts}###{ends}###{name}###{place}###{teacher}###{difficulty}'
+                  '###{complex}###{comment}###{}###{audience}',
+        'children': '{starts}###{ends}###{name}###{audience}###{}###{place}'
+                    '###{teacher}###{complex}###{comment}',
+    }
+    result = parse.parse(templates[kind], '###'.join(row))
+    if result is None:
+        return None
+    values = dict.fromkeys(Lesson._fields, '')
+    values.update((k, '' if v == schedule.fetcher.NO_TEXT else v) for k, v in result.named.items())
+    if result[0] != schedule.fetcher.NO_TEXT:
+        field, suffix = schedule.fetcher.SUFFIXES[kind]
+        values[field] += suffix.format(result[0])
+    return Lesson(**values)
+
+
+def pyquery_and_parse(page):
+    import pyquery
+    tables = pyquery.PyQuery(page.decode('utf-8'))('table')[:3]
+    result = []
+    for table, kind in zip(tables, schedule.fetcher.TABLES):
+        rows = [[schedule.fetcher.NO_TEXT if td.text is None else td.text.strip() for td in tr.findall('td')]
+                for tr in table.findall('.//tr')]
+        result.append(schedule.fetcher.parse_table(rows, lambda row: old_parse_lesson(kind, row)))
+    return result
+
+
+def measure(func, page, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.process_time()
+        result = func(page)
+        times.append(time.process_time() - start)
+    tracemalloc.start()
+    func(page)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak, result
+
+
+def main(args):
+    page = inflated_page(args.copies)
+    print('page: {0:.1f} KiB'.format(len(page) / 1024.))
+    results = []
+    for label, func in [('streaming', streaming), ('pyquery+parse', pyquery_and_parse)]:
+        try:
+            cpu, peak, result = measure(func, page, args.repeat)
+        except ImportError as ex:
+            print('{0:>14}: skipped, {1}'.format(label, ex))
+            continue
+        results.append(result)
+        print('{0:>14}: {1:7.1f} ms CPU, {2:8.1f} KiB peak'.format(label, cpu * 1000, peak / 1024.))
+    if len(results) == 2:
+        assert results[0] == results[1], 'parsers disagree'
+
+
+if __name__ == '__main__':
+    main(parse_args())
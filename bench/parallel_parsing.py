@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Time to parse the three tables of a large page one by one and in pools.
+
+Parsing is pure Python, so threads are held back by the GIL; processes
+parse on separate cores but pay for sending rows and lessons across.
+Results have to be equal whatever finishes first.
+
+Usage: PYTHONPATH=bin python3 bench/parallel_parsing.py -c 50
+'''
+
+import argparse
+import concurrent.futures
+import time
+
+import schedule.fetcher
+from html_parsing import inflated_page
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-c', '--copies', type=int, default=50)
+    parser.add_argument('-n', '--repeat', type=int, default=5)
+    return parser.parse_args()
+
+
+def measure(tables, executor, repeat):
+    times = []
+    for _ in range(repeat):
+        # forget parsed tables, otherwise nothing is parsed again
+        schedule.fetcher._tables.clear()
+        start = time.perf_counter()
+        result = schedule.fetcher.parse_tables('bench', tables, executor)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main(args):
+    page = inflated_page(args.copies)
+    tables = schedule.fetcher.read_tables([page])
+    print('{0} rows'.format(sum(len(t) for t in tables)))
+    results = []
+    for label, executor in [('sequential', None),
+                            ('3 threads', concurrent.futures.ThreadPoolExecutor(3)),
+                            ('3 processes', concurrent.futures.ProcessPoolExecutor(3))]:
+        elapsed, result = measure(tables, executor, args.repeat)
+        results.append(result)
+        print('{0:>12}: {1:7.1f} ms'.format(label, elapsed * 1000))
+        if executor is not None:
+            executor.shutdown()
+    assert all(r == results[0] for r in results), 'results differ'
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Reply latency of sleep polling versus long polling.
+
+Messages "arrive" at random moments and are handed to the bot through
+the fake do_request from cli_yanbinbot.patch_do_request. The fake server
+answers getUpdates immediately when it has nothing, or holds the request
+open up to the requested timeout, like Telegram does.
+
+Usage: PYTHONPATH=bin python3 bench/polling_latency.py
+'''
+
+import argparse
+import io
+import json
+import os
+import random
+import statistics
+import time
+
+import utils
+from cli_yanbinbot import patch_do_request, patch_schedule_fetching, TheBot
+
+
+PROJ_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCHEDULE = os.path.join(PROJ_DIR, 'tests', 'real_data', 'schedule.json')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--messages', type=int, default=10)
+    parser.add_argument('-w', '--wait', type=float, default=1.0,
+                        help='sleep between polls in the sleep mode')
+    parser.add_argument('-t', '--poll-timeout', type=int, default=5,
+                        help='getUpdates timeout in the long polling mode')
+    return parser.parse_args()
+
+
+class Arrivals(object):
+    def __init__(self, texts, gaps):
+        self.start = time.time()
+        self.times = []
+        t = self.start
+        for gap in gaps:
+            t += gap
+            self.times.append(t)
+        self.texts = list(texts)
+        self.pos = 0
+        self.sent = []
+
+    def due(self):
+        return self.pos < len(self.times) and self.times[self.pos] <= time.time()
+
+    def done(self):
+        return self.pos >= len(self.times)
+
+    def readline(self):
+        self.pos += 1
+        return self.texts[self.pos - 1] + '\n'
+
+
+def measure(args, poll_timeout):
+    random.seed(0)
+    gaps = [random.uniform(0.2, 1.5) for _ in range(args.messages)]
+    arrivals = Arrivals(['сегодня'] * args.messages, gaps)
+    patch_do_request(arrivals, io.StringIO(), False)
+    fake = utils.do_request
+    bot = TheBot()
+    latencies = []
+    polls = [0]
+
+    def do_request(server_url, action, data=None):
+        if action != 'getUpdates':
+            latencies.append(time.time() - arrivals.times[arrivals.pos - 1])
+            return fake(server_url, action, data)
+        polls[0] += 1
+        deadline = time.time() + data.get('timeout', 0)
+        while not arrivals.due() and not arrivals.done() and time.time() < deadline:
+            time.sleep(0.001)
+        if arrivals.done():
+            bot.need_restart = True
+        if not arrivals.due():
+            return {'ok': True, 'result': []}
+        return fake(server_url, action, data)
+
+    utils.do_request = do_request
+    bot.run('http://stub-url.com', args.wait, poll_timeout)
+    return latencies, polls[0], time.time() - arrivals.start
+
+
+def main(args):
+    with open(SCHEDULE, 'rb') as f:
+        patch_schedule_fetching(json.loads(f.read().decode('utf-8')))
+    for label, poll_timeout in [('sleep %.1fs' % args.wait, 0),
+                                ('long poll %ds' % args.poll_timeout, args.poll_timeout)]:
+        latencies, polls, elapsed = measure(args, poll_timeout)
+        print('{0:>14}: mean {1:.3f}s max {2:.3f}s, {3} getUpdates in {4:.1f}s'.format(
+            label, statistics.mean(latencies), max(latencies), polls, elapsed))
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Cost of reminder timers for many subscriptions.
+
+Subscribes --chats chats to reminders about one teacher each, then
+simulates a week of due() checks every --step seconds and a schedule
+change that moves one lesson.
+
+Usage: PYTHONPATH=bin python3 bench/reminder_timers.py -c 5000
+'''
+
+import argparse
+import datetime
+import json
+import os
+import time
+
+import schedule.diff
+from cli_yanbinbot import schedule_from_json
+from reminders import ReminderQueue
+
+
+PROJ_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCHEDULE = os.path.join(PROJ_DIR, 'tests', 'real_data', 'schedule.json')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-c', '--chats', type=int, default=5000)
+    parser.add_argument('-s', '--step', type=int, default=5)
+    return parser.parse_args()
+
+
+def main(args):
+    with open(SCHEDULE, 'rb') as f:
+        old = schedule_from_json(json.loads(f.read().decode('utf-8')))
+    teachers = sorted(set(l.teacher for days in old.values() for lessons in days.values() for l in lessons if l))
+    queue = ReminderQueue(lambda text: lambda discipline, lesson: lesson.teacher == text)
+    start_time = datetime.datetime(2016, 1, 4)
+    queue.due(start_time)
+    queue.update(old)
+
+    start = time.perf_counter()
+    for chat in range(args.chats):
+        queue.add(str(chat), 30, teachers[chat % len(teachers)])
+    print('{0} subscriptions, {1} timers: added in {2:.0f} ms'.format(
+        args.chats, len(queue.timers), (time.perf_counter() - start) * 1000))
+
+    day = next(iter(old['kungfu']))
+    lessons = list(old['kungfu'][day])
+    lessons[0] = lessons[0]._replace(starts='6.00')
+    new = dict(old, kungfu=dict(old['kungfu']))
+    new['kungfu'][day] = lessons
+    start = time.perf_counter()
+    queue.update(new, schedule.diff.diff(old, new))
+    print('one lesson moved: {0:.2f} ms'.format((time.perf_counter() - start) * 1000))
+
+    checks = 7 * 24 * 3600 // args.step
+    fired = 0
+    start = time.perf_counter()
+    for i in range(1, checks + 1):
+        fired += len(queue.due(start_time + datetime.timedelta(seconds=i * args.step)))
+    elapsed = time.perf_counter() - start
+    print('a week of due() every {0} s: {1} reminders, {2:.2f} us per check'.format(
+        args.step, fired, elapsed / checks * 1e6))
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Memory taken by a large schedule as Lesson lists and as compact columns.
+
+The test schedule is inflated by copying every lesson --copies times with
+a few varied cells, then loaded from JSON like a snapshot is, so that
+equal cells are separate string objects as they are after parsing.
+
+Usage: PYTHONPATH=bin python3 bench/schedule_memory.py -c 100
+'''
+
+import argparse
+import gc
+import json
+import os
+import tracemalloc
+
+import schedule.compact
+import schedule.index
+from schedule.schedule import Lesson
+
+
+PROJ_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCHEDULE = os.path.join(PROJ_DIR, 'tests', 'real_data', 'schedule.json')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-c', '--copies', type=int, default=100)
+    return parser.parse_args()
+
+
+def inflated_json(copies):
+    with open(SCHEDULE, 'rb') as f:
+        data = json.loads(f.read().decode('utf-8'))
+    for days in data.values():
+        for day, lessons in days.items():
+            inflated = []
+            for i in range(copies):
+                for lesson in lessons:
+                    lesson = list(lesson)
+                    # different start times and comments, the rest repeats
+                    lesson[0] = '{0}.{1:02d}'.format(7 + i % 14, i % 60)
+                    lesson[7] = '{0} #{1}'.format(lesson[7], i % 10) if lesson[7] else ''
+                    inflated.append(lesson)
+            days[day] = inflated
+    return json.dumps(data, ensure_ascii=False)
+
+
+def load(text):
+    return {kind: {day: [Lesson(*lesson) for lesson in lessons] for day, lessons in days.items()}
+            for kind, days in json.loads(text).items()}
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, result
+
+
+def main(args):
+    text = inflated_json(args.copies)
+    count = sum(len(lessons) for days in json.loads(text).values() for lessons in days.values())
+    plain_size, plain = measure(lambda: load(text))
+    compact_size, compact = measure(lambda: schedule.compact.compact(load(text)))
+    index_size, _ = measure(lambda: schedule.index.ScheduleIndex(plain))
+    compact_index_size, _ = measure(lambda: schedule.index.ScheduleIndex(compact))
+    print('{0} lessons'.format(count))
+    for label, size in [('lessons', plain_size), ('compact', compact_size),
+                        ('lessons + index', plain_size + index_size),
+                        ('compact + index', compact_size + compact_index_size)]:
+        print('{0:>16}: {1:8.1f} KiB, {2:5.0f} bytes per lesson'.format(label, size / 1024., size / float(count)))
+
+
+if __name__ == '__main__':
+    main(parse_args())
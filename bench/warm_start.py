@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Time to the first answer with and without a schedule snapshot.
+
+Cold start fetches the schedule page from a local fake_sheets server, so
+the real network round trip to Google is not even counted.
+
+Usage: PYTHONPATH=bin:tests python3 bench/warm_start.py
+'''
+
+import argparse
+import os
+import tempfile
+import time
+
+import fake_sheets
+import schedule.fetcher
+from cli_yanbinbot import TheBot
+
+
+PROJ_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGE = os.path.join(PROJ_DIR, 'tests', 'real_data', 'schedule.html')
+MESSAGE = {'text': 'сегодня', 'from': {'username': 'You'}, 'chat': {'id': 0}}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--repeat', type=int, default=20)
+    return parser.parse_args()
+
+
+def first_answer(snapshot_path=None):
+    start = time.perf_counter()
+    bot = TheBot(snapshot_path=snapshot_path)
+    bot.process_text_message(dict(MESSAGE))
+    elapsed = time.perf_counter() - start
+    while bot.schedule_cache.refreshing:
+        time.sleep(0.001)
+    return elapsed
+
+
+def main(args):
+    with open(PAGE, 'rb') as f:
+        server = fake_sheets.serve(f.read())
+    schedule.fetcher.SHIYANBIN_SCHEDULE_LINK = server.url
+    snapshot_path = os.path.join(tempfile.mkdtemp(), 'shiyanbin.schedule.json')
+    TheBot(snapshot_path=snapshot_path).get_schedule()
+
+    cold, warm = [], []
+    for _ in range(args.repeat):
+        # forget validators and parsed tables so that every cold start is cold
+        schedule.fetcher._validators.clear()
+        schedule.fetcher._tables.clear()
+        schedule.fetcher._schedules.clear()
+        cold.append(first_answer())
+        warm.append(first_answer(snapshot_path))
+    for label, times in [('cold', cold), ('snapshot', warm)]:
+        times.sort()
+        print('{0:>8}: median {1:.2f} ms, max {2:.2f} ms'.format(
+            label, times[len(times) // 2] * 1000, times[-1] * 1000))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Replay throughput of the worker pool for different numbers of workers.
+
+Replays the test queries from many chats through workers.Supervisor with
+a fake bot API, and reports updates answered per second. Rate limits are
+lifted, --send-latency simulates the round trip of every sendMessage.
+
+Usage: PYTHONPATH=bin python3 bench/worker_scaling.py -w 1 2 4
+'''
+
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+
+import sender
+import utils
+import workers
+from cli_yanbinbot import patch_schedule_fetching, TheBot
+
+
+PROJ_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TESTS_DIR = os.path.join(PROJ_DIR, 'tests')
+QUERIES = ['понедельник', 'вторник цигун', 'среда дети', 'четверг валерий',
+           'пятница кунгфу', 'суббота', 'воскресенье', 'все', 'инструкторы']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--updates', type=int, default=3000)
+    parser.add_argument('-c', '--chats', type=int, default=200)
+    parser.add_argument('-b', '--batch', type=int, default=100, help='updates per getUpdates')
+    parser.add_argument('-l', '--send-latency', type=float, default=0.,
+                        help='seconds every sendMessage takes')
+    parser.add_argument('-w', '--workers', type=int, nargs='+', default=[1, 2, 4])
+    return parser.parse_args()
+
+
+def make_updates(args):
+    updates = []
+    for i in range(args.updates):
+        # unique teacher filters keep the reply cache from answering everything
+        text = '{0} {1}'.format(QUERIES[i % len(QUERIES)], 'abcdefghij'[i % 10] * (1 + i % 7))
+        updates.append({'update_id': i, 'message': {
+            'text': text, 'from': {'username': 'user%d' % i}, 'chat': {'id': i % args.chats}}})
+    return updates
+
+
+def replay(args, updates, snapshot_path, count):
+    bot = TheBot(snapshot_path=snapshot_path)
+    supervisor = workers.Supervisor(bot, 'http://stub-url.com', count, wait_time=0)
+
+    def do_request(server_url, action, data=None):
+        if action != 'getUpdates':
+            time.sleep(args.send_latency)
+            return {'ok': True}
+        batch = [u for u in updates if u['update_id'] >= data['offset']][:args.batch]
+        if not batch:
+            supervisor.stop()
+        return {'ok': True, 'result': batch}
+
+    utils.do_request = do_request
+    start = time.perf_counter()
+    supervisor.run()
+    elapsed = time.perf_counter() - start
+    assert bot.offset == len(updates), bot.offset
+    return elapsed
+
+
+def main(args):
+    logging.disable(logging.WARNING)
+    with open(os.path.join(TESTS_DIR, 'real_data', 'schedule.json'), 'rb') as f:
+        patch_schedule_fetching(json.loads(f.read().decode('utf-8')))
+    sender.GLOBAL_RATE = sender.CHAT_RATE = sender.CHAT_BURST = 10 ** 9
+    snapshot_path = os.path.join(tempfile.mkdtemp(), 'shiyanbin.schedule.json')
+    updates = make_updates(args)
+    for count in args.workers:
+        elapsed = replay(args, updates, snapshot_path, count)
+        print('{0:>2} workers: {1:.0f} updates/s'.format(count, len(updates) / elapsed))
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+'''Asyncio runtime for TheBot.
+
+Updates are fetched while earlier ones are still being answered. Each
+chat gets its own queue, so replies within a chat keep their order while
+a slow chat (e.g. one waiting for a schedule fetch) does not hold up
+the others. Command handlers are plain blocking methods of TheBot and
+run in a thread pool.
+
+getUpdates is always asked from the committed offset: it only moves past
+an update once it and every update before it have been answered, so
+Telegram keeps unanswered updates until they are answered, also across a
+crash. Updates still being answered come back in every response and are
+skipped, answered ones are skipped by TheBot.seen_updates after a
+restart. At most max_pending updates are answered at a time; with more
+the runner waits for a chat to finish before it polls again.
+'''
+
+import asyncio
+import concurrent.futures
+import logging
+
+import hotlog
+import metrics
+import offsets
+import utils
+from yanbinbot import poll_delay
+
+
+MAX_PENDING = 100
+
+
+class AsyncRunner(object):
+    def __init__(self, bot, server_url, wait_time=5, poll_timeout=0, max_backoff=60,
+                 max_sends=8, workers=None, max_pending=MAX_PENDING):
+        self.bot = bot
+        self.server_url = server_url
+        self.wait_time = wait_time
+        self.poll_timeout = poll_timeout
+        self.max_backoff = max_backoff
+        self.max_sends = max_sends
+        self.max_pending = max_pending
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.offsets = offsets.OffsetTracker(bot.offset)
+        self.chats = {}
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+    def request(self, action, data):
+        return utils.do_request(self.server_url, action, data)
+
+    async def call(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+
+    async def wait_for_chats(self):
+        '''Waits until a chat has answered all its updates.'''
+        if self.chats:
+            await asyncio.wait([task for _, task in list(self.chats.values())],
+                               return_when=asyncio.FIRST_COMPLETED)
+
+    async def get_updates(self):
+        while len(self.offsets.pending) >= self.max_pending:
+            await self.wait_for_chats()
+        # pending updates come first, so at most max_pending are answered at a time
+        request = {'offset': self.offsets.committed, 'limit': self.max_pending}
+        if self.poll_timeout:
+            request['timeout'] = self.poll_timeout
+        with metrics.GET_UPDATES.time():
+            response = await self.call(self.request, 'getUpdates', request)
+        if response and isinstance(response, dict) and response.get('ok'):
+            updates = response['result']
+            if updates and isinstance(updates, list):
+                hotlog.hot.debug('updates', count=len(updates), updates=updates)
+                dispatched = [update for update in updates if self.dispatch(update)]
+                # only updates still being answered: polling again would return them right away
+                if not dispatched:
+                    await self.wait_for_chats()
+            return True
+        logging.error('failed to get updates: %s', str(response))
+        return False
+
+    def dispatch(self, update):
+        '''Queues a new update for its chat, returns False for one seen already.'''
+        if not self.offsets.add(update['update_id']):
+            return False
+        if self.bot.seen_updates.seen(update):
+            metrics.UPDATES_SKIPPED.inc()
+            self.bot.offset = max(self.bot.offset, self.offsets.ack(update['update_id']))
+            return False
+        chat_id = update.get('message', {}).get('chat', {}).get('id')
+        if chat_id not in self.chats:
+            self.chats[chat_id] = (asyncio.Queue(), asyncio.ensure_future(self.chat_worker(chat_id)))
+        self.chats[chat_id][0].put_nowait(update)
+        return True
+
+    async def send(self, action, msg):
+        sending = self.bot.sender.sending(self.server_url, action, msg)
+        while True:
+            async with self.sends:
+                delay = await self.call(next, sending, None)
+            if delay is None:
+                return
+            # rate limited: other chats send meanwhile
+            await asyncio.sleep(delay)
+
+    async def chat_worker(self, chat_id):
+        queue = self.chats[chat_id][0]
+        while not queue.empty():
+            update = queue.get_nowait()
+            try:
+                for action, msg in await self.call(self.bot.process_update, update):
+                    await self.send(action, msg)
+                metrics.UPDATES.inc()
+            except Exception as ex:
+                metrics.UPDATE_ERRORS.inc()
+                logging.error('failed to process update: %s\n%s', str(update), str(ex))
+            self.bot.seen_updates.add(update)
+            self.bot.offset = max(self.bot.offset, self.offsets.ack(update['update_id']))
+        del self.chats[chat_id]
+
+    async def drain(self):
+        while self.chats:
+            await asyncio.gather(*[task for _, task in list(self.chats.values())])
+
+    async def run(self):
+        self.sends = asyncio.Semaphore(self.max_sends)
+        backoff = 0
+        try:
+            while not self.stopped and not self.bot.need_restart:
+                try:
+                    ok = await self.get_updates()
+                    await self.call(self.bot.send_notifications, self.server_url)
+                    # chat workers change subscriptions in the executor
+                    if not self.chats:
+                        self.bot.checkpoint()
+                except Exception as ex:
+                    ok = False
+                if self.stopped or self.bot.need_restart:
+                    break
+                delay, backoff = poll_delay(ok, backoff, self.wait_time, self.poll_timeout, self.max_backoff)
+                await asyncio.sleep(delay)
+        finally:
+            await self.drain()
+
+
+def run_async(bot, server_url, wait_time, poll_timeout=0, max_backoff=60, max_sends=8):
+    runner = AsyncRunner(bot, server_url, wait_time, poll_timeout, max_backoff, max_sends)
+    try:
+        asyncio.run(runner.run())
+    except KeyboardInterrupt:
+        logging.error('keyboard interrupt, stopped processing messages')
+    finally:
+        runner.executor.shutdown()
@@ -55,7 +55,10 @@ def patch_do_request(input_file=sys.stdin, output_file=sys.stdout, debug=True):
 
 
 def weekday_from_repr(s):
-    return weekday.days[weekday.days.index(s)]
+    day = weekday.lookup(s)
+    if day is None:
+        raise ValueError('unknown weekday: {0}'.format(s))
+    return day
 
 
 def schedule_from_json(data):
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+'''Updates answered already, so a replayed update is not answered twice.
+
+getUpdates returns an update again until the offset moves past it, and a
+webhook delivery is retried when the answer is slow. An update is known
+by its update_id and by (chat id, message id) of its message. The last
+`capacity` answered updates are kept in a ring buffer, with a set of their
+keys for lookups; the oldest one is forgotten when a new one comes in.
+on_add, when set, is called with the keys of every update added, the bot
+logs them with its offset, so they are known again after a crash.
+'''
+
+import collections
+import threading
+
+
+CAPACITY = 4096
+
+
+def update_keys(update):
+    '''(update_id, chat id, message id), the last two are None without a message.'''
+    msg = update.get('message') or {}
+    return (update.get('update_id'), msg.get('chat', {}).get('id'), msg.get('message_id'))
+
+
+class SeenUpdates(object):
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.ring = collections.deque()
+        self.keys = set()
+        self.on_add = None
+
+    def __len__(self):
+        return len(self.ring)
+
+    def seen(self, update):
+        update_id, chat, message = update_keys(update)
+        with self.lock:
+            return update_id in self.keys or (message is not None and (chat, message) in self.keys)
+
+    def add(self, update):
+        self.add_keys(update_keys(update))
+
+    def add_keys(self, keys):
+        if self.insert(keys) and self.on_add is not None:
+            self.on_add(keys)
+
+    def insert(self, keys):
+        '''Adds the keys, returns False if the update is known already.'''
+        update_id, chat, message = keys
+        with self.lock:
+            if update_id in self.keys:
+                return False
+            self.ring.append(keys)
+            self.keys.add(update_id)
+            if message is not None:
+                self.keys.add((chat, message))
+            while len(self.ring) > self.capacity:
+                update_id, chat, message = self.ring.popleft()
+                self.keys.discard(update_id)
+                self.keys.discard((chat, message))
+        return True
+
+    def dump(self):
+        '''[[update_id, chat id, message id]], oldest first, as saved with the bot state.'''
+        with self.lock:
+            return [list(keys) for keys in self.ring]
+
+    def restore(self, items):
+        with self.lock:
+            self.ring.clear()
+            self.keys.clear()
+        for keys in items:
+            self.insert(tuple(keys))
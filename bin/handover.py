@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+'''Zero downtime restart: the old process hands over to a new one.
+
+The old process starts the new one with one end of a socket pair and
+keeps answering updates. The new process loads the state and the
+schedule snapshot, says 'ready' and waits. Then the old process stops
+polling, saves the state and sends the offset and the snapshot path. The
+new process reloads the state and starts polling, and the old one exits.
+Updates are not polled for only between the two messages. If the new
+process exits or does not get ready in time, the old one stops polling
+just as well and goes on after complete() returns False.
+'''
+
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+
+
+READY_TIMEOUT = 60
+
+
+def child_argv(argv, fd):
+    '''argv of the new process, without the --handover-fd of this one.'''
+    result = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == '--handover-fd':
+            skip = True
+        elif not arg.startswith('--handover-fd='):
+            result.append(arg)
+    return result + ['--handover-fd', str(fd)]
+
+
+class Handover(object):
+    '''The old process side, started with the command line of the new process.'''
+
+    def __init__(self, prog_path, argv, bot, log_path):
+        self.bot = bot
+        self.sock, child = socket.socketpair()
+        self.reader = self.sock.makefile('rb')
+        self.ready = threading.Event()
+        try:
+            with open(log_path, 'ab') as log:
+                self.process = subprocess.Popen(
+                    [sys.executable, prog_path] + child_argv(argv, child.fileno()), pass_fds=[child.fileno()],
+                    stdin=subprocess.DEVNULL, stdout=log, stderr=log, start_new_session=True)
+        finally:
+            child.close()
+        self.watcher = threading.Thread(target=self.watch, daemon=True)
+        self.watcher.start()
+
+    def watch(self):
+        self.sock.settimeout(READY_TIMEOUT)
+        try:
+            line = self.reader.readline()
+            if line.strip() == b'ready':
+                self.ready.set()
+            else:
+                logging.error('new process exited before it got ready: %s', str(line))
+        except OSError as ex:
+            logging.error('new process did not get ready: %s', str(ex))
+        # once, either way: the engine stops and complete() hands over or gives up,
+        # the caller clears it before it runs an engine again
+        self.bot.need_restart = True
+
+    def complete(self, offset, snapshot_path):
+        '''Waits for the new process, returns True if it took over.'''
+        self.watcher.join()
+        try:
+            if not self.ready.is_set():
+                self.process.terminate()
+                return False
+            self.sock.settimeout(READY_TIMEOUT)
+            self.sock.sendall(json.dumps({'offset': offset, 'snapshot': snapshot_path}).encode('utf-8') + b'\n')
+            return self.reader.readline().strip() == b'started'
+        except OSError as ex:
+            logging.error('failed to hand over to the new process: %s', str(ex))
+            self.process.terminate()
+            return False
+        finally:
+            self.reader.close()
+            self.sock.close()
+
+
+def take_over(fd):
+    '''The new process side: says it is ready and waits for {'offset', 'snapshot'}.'''
+    sock = socket.socket(fileno=fd)
+    reader = sock.makefile('rb')
+    try:
+        sock.sendall(b'ready\n')
+        line = reader.readline()
+        if not line:
+            raise RuntimeError('the old process went away before handing over')
+        handover = json.loads(line.decode('utf-8'))
+        sock.sendall(b'started\n')
+        return handover
+    finally:
+        reader.close()
+        sock.close()
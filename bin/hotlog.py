@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+'''Leveled, sampled and structured logging for code that runs on every update.
+
+    hot.debug('updates', count=len(updates), updates=updates)
+
+logs 'updates count=2 updates=[...]' only when the 'yanbinbot.hot' logger
+is enabled for DEBUG, and then only for a `sample` share of the calls.
+A disabled call costs a level check: the fields are formatted only when
+the record is written.
+'''
+
+import logging
+import random
+
+
+LOGGER_NAME = 'yanbinbot.hot'
+
+
+class Fields(object):
+    '''key=value pairs, formatted when the record is.'''
+
+    __slots__ = ['fields']
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __str__(self):
+        return ' '.join('%s=%s' % (key, value) for key, value in self.fields.items())
+
+
+class HotLog(object):
+    def __init__(self, name=LOGGER_NAME, sample=1.0):
+        self.logger = logging.getLogger(name)
+        self.sample = sample
+
+    def configure(self, level=None, sample=None):
+        if level is not None:
+            self.logger.setLevel(level)
+        if sample is not None:
+            self.sample = sample
+
+    def enabled(self, level):
+        return self.logger.isEnabledFor(level) and (self.sample >= 1 or random.random() < self.sample)
+
+    def log(self, level, event, **fields):
+        if self.enabled(level):
+            self.logger.log(level, '%s %s', event, Fields(fields))
+
+    def debug(self, event, **fields):
+        self.log(logging.DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        self.log(logging.INFO, event, **fields)
+
+
+hot = HotLog()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+'''Single-pass search for command, teacher and discipline aliases.
+
+TheBot used to call find_and_extract once per alias, building and running
+a fresh regular expression for each of them on every message. AliasMatcher
+compiles all aliases into one alternation, finds which of them occur in a
+text in one scan and then extracts only those, with the same result as
+trying find_and_extract for every alias in turn: the first alias in the
+given order that occurs wins, and its last occurrence is removed.
+'''
+
+import re
+
+
+# Same shape as TheBot.find_and_extract.
+EXTRACT_PATTERN = r'(.*\s+|^)(%s)(\s+.*|$)'
+
+
+class AliasMatcher(object):
+    def __init__(self, groups):
+        '''groups: [(kind, [(pattern, value), ...]), ...] in priority order.'''
+        self.entries = []
+        self.literals = {}
+        parts = []
+        for kind, aliases in groups:
+            for pattern, value in aliases:
+                index = len(self.entries)
+                parts.append('(?P<_%d>%s)' % (index, pattern))
+                self.entries.append((kind, value, re.compile(EXTRACT_PATTERN % pattern)))
+                if re.escape(pattern) == pattern:
+                    self.literals.setdefault(pattern, []).append(index)
+        self.scanner = re.compile(r'(?:^|(?<=\s))(?:%s)(?=\s|$)' % '|'.join(parts))
+
+    def scan(self, text):
+        '''Returns {kind: set of indices of aliases found in text}.'''
+        found = {}
+        for m in self.scanner.finditer(text):
+            # the alternation reports one alias per position, a word can be
+            # an alias of several kinds (e.g. 'занятия')
+            indices = self.literals.get(m.group(), ())
+            for index in indices or (int(m.lastgroup[1:]),):
+                found.setdefault(self.entries[index][0], set()).add(index)
+        return found
+
+    def extract(self, text, candidates):
+        '''Removes the first of candidate aliases found in text.
+
+        Returns the text without it, the value of the alias and the matched
+        word; the latter two are None if none of the candidates is in text.
+        '''
+        for index in sorted(candidates):
+            kind, value, extractor = self.entries[index]
+            m = extractor.match(text)
+            if m:
+                return (m.group(1).strip() + ' ' + m.group(3).strip()).strip(), value, m.group(2)
+        return text, None, None
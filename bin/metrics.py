@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+'''Counters and latency histograms in the Prometheus text format.
+
+Metrics live in REGISTRY and are module globals, so every engine and the
+code reloaded in place (see reloader) count into the same ones. Counting
+is an increment under a lock, a histogram observation also finds its
+bucket with bisect. Dicts of stats kept elsewhere, like SendScheduler.stats,
+are exported as they are by add_stats. serve() answers GET /metrics on a
+local port for a scraper; while another process holds the port, like the
+bot being restarted, binding is retried in the background.
+'''
+
+import bisect
+import functools
+import http.server
+import logging
+import threading
+import time
+
+
+# seconds, from a cached reply to a slow spreadsheet fetch
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+BIND_RETRY = 1
+MAX_BIND_RETRY = 30
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def render(self):
+        return ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name,
+                '%s %s' % (self.name, format_value(self.value))]
+
+
+class Histogram(object):
+    def __init__(self, name, help_text, buckets=BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        # counts per bucket, the last one for values above all buckets
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        return Timer(self)
+
+    def timed(self, func):
+        '''Decorator observing the duration of every call of func.'''
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.observe(time.perf_counter() - started)
+        return wrapper
+
+    def count(self):
+        with self.lock:
+            return sum(self.counts)
+
+    def render(self):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            lines.append('%s_bucket{le="%s"} %d' % (self.name, format_value(bound), cumulative))
+        lines.append('%s_sum %s' % (self.name, format_value(total)))
+        lines.append('%s_count %d' % (self.name, cumulative))
+        return lines
+
+
+class Timer(object):
+    '''with histogram.time(): observes the duration of the block.'''
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+        # (prefix, function returning a dict of numbers)
+        self.stats = []
+        self.lock = threading.Lock()
+
+    def counter(self, name, help_text):
+        return self.add(Counter(name, help_text))
+
+    def histogram(self, name, help_text, buckets=BUCKETS):
+        return self.add(Histogram(name, help_text, buckets))
+
+    def add(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def add_stats(self, prefix, get_stats):
+        '''Exports the numbers of get_stats() as untyped prefix_<key>, replacing earlier ones of prefix.'''
+        with self.lock:
+            self.stats = [s for s in self.stats if s[0] != prefix] + [(prefix, get_stats)]
+
+    def render(self):
+        with self.lock:
+            metrics, stats = list(self.metrics), list(self.stats)
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        for prefix, get_stats in stats:
+            for key, value in sorted(get_stats().items()):
+                if isinstance(value, (int, float)):
+                    name = '%s_%s' % (prefix, key)
+                    lines += ['# TYPE %s untyped' % name, '%s %s' % (name, format_value(value))]
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+UPDATES = REGISTRY.counter('yanbinbot_updates_total', 'Updates answered.')
+UPDATES_SKIPPED = REGISTRY.counter('yanbinbot_updates_skipped_total', 'Updates skipped as answered already.')
+UPDATE_ERRORS = REGISTRY.counter('yanbinbot_update_errors_total', 'Updates that failed to be answered.')
+SEND_ERRORS = REGISTRY.counter('yanbinbot_send_errors_total', 'Bot API requests to send a reply that failed.')
+GET_UPDATES = REGISTRY.histogram('yanbinbot_get_updates_seconds', 'getUpdates requests, long polling included.')
+PARSE = REGISTRY.histogram('yanbinbot_parse_seconds', 'Splitting message texts into command and filter.')
+SHOW_LESSONS = REGISTRY.histogram('yanbinbot_show_lessons_seconds', 'Answering lesson queries, rendering included.')
+RENDER = REGISTRY.histogram('yanbinbot_render_seconds', 'Rendering lessons not found in the render cache.')
+SEND = REGISTRY.histogram('yanbinbot_send_seconds', 'Bot API requests sending replies.')
+SCHEDULE_FETCH = REGISTRY.histogram('yanbinbot_schedule_fetch_seconds', 'Fetching and parsing the spreadsheets.')
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(object):
+    '''Binds host:port and answers scrapes in a background thread until closed.'''
+
+    def __init__(self, host, port, registry=REGISTRY, retry=BIND_RETRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self.retry = retry
+        self.server = None
+        self.lock = threading.Lock()
+        self.bound = threading.Event()
+        self.closed = threading.Event()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    @property
+    def server_port(self):
+        return self.server.server_port if self.server else None
+
+    def run(self):
+        delay = self.retry
+        while not self.closed.is_set():
+            try:
+                server = http.server.ThreadingHTTPServer((self.host, self.port), MetricsHandler)
+            except OSError as ex:
+                logging.error('failed to serve metrics on %s:%d, retrying in %g s: %s',
+                              self.host, self.port, delay, str(ex))
+                if self.closed.wait(delay):
+                    return
+                delay = min(MAX_BIND_RETRY, delay * 2)
+                continue
+            server.daemon_threads = True
+            server.registry = self.registry
+            with self.lock:
+                if self.closed.is_set():
+                    server.server_close()
+                    return
+                self.server = server
+            self.bound.set()
+            logging.warning('serving metrics on http://%s:%d/metrics', self.host, server.server_port)
+            server.serve_forever()
+            return
+
+    def close(self):
+        '''Stops answering and frees the port.'''
+        with self.lock:
+            self.closed.set()
+            server, self.server = self.server, None
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+
+def serve(host, port, registry=REGISTRY, retry=BIND_RETRY):
+    '''Answers GET /metrics on host:port in a background thread, returns the MetricsServer.'''
+    return MetricsServer(host, port, registry, retry)
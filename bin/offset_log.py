@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+'''Append-only log of the getUpdates offset and of answered updates.
+
+Every committed offset and the dedup keys (update_id, chat id, message
+id) of every answered update are appended as fixed size records with
+their crc32, so a torn write at the end of the file is detected and cut
+off on recovery. Answered updates are logged because the offset only
+moves past an update once every update before it is answered: those
+answered out of order come back after a crash and are skipped by them.
+Writes are grouped: records are written and fsynced at most every
+`interval` seconds, all offsets committed in between are covered by the
+latest one. A crash loses at most `interval` seconds of records, and
+those updates are answered again after the restart. After
+`compact_every` records the full bot state is saved atomically and the
+log starts over; this runs in compact_if_due(), called by the engines
+from their main loop, never from the timer thread that flushes the log.
+'''
+
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+
+# kind, then the offset or the keys of an answered update, and the crc32 of them
+BODY = struct.Struct('<Bqqq')
+RECORD = struct.Struct('<%dsI' % BODY.size)
+OFFSET = 0
+ANSWERED = 1
+# chat and message id of an update without a message
+NO_ID = -2 ** 63
+FSYNC_INTERVAL = 1.0
+COMPACT_EVERY = 10000
+
+
+def pack(kind, a, b=None, c=None):
+    body = BODY.pack(kind, a, NO_ID if b is None else b, NO_ID if c is None else c)
+    return RECORD.pack(body, zlib.crc32(body))
+
+
+def unpack(record):
+    '''(kind, a, b, c) of a record, None if it is corrupted.'''
+    body, crc = RECORD.unpack(record)
+    if zlib.crc32(body) != crc:
+        return None
+    return tuple(None if value == NO_ID else value for value in BODY.unpack(body))
+
+
+class OffsetLog(object):
+    def __init__(self, path, interval=FSYNC_INTERVAL, compact_every=COMPACT_EVERY, save_state=None):
+        self.path = path
+        self.interval = interval
+        self.compact_every = compact_every
+        self.save_state = save_state
+        self.lock = threading.RLock()
+        self.pending = None
+        # keys of updates answered since the last write
+        self.answers = []
+        self.written = None
+        self.records = 0
+        self.last_sync = None
+        self.timer = None
+        self.file = None
+        self.stats = {'appends': 0, 'writes': 0, 'compactions': 0}
+
+    def recover(self):
+        '''Returns the last offset in the log, 0 if there is none, and the answered updates.
+
+        The answered updates are [(update_id, chat id, message id)] logged
+        since the state was saved. A torn or corrupted tail is cut off, so
+        new records are appended right after the last good one.
+        '''
+        offset, answered = 0, []
+        if not os.path.exists(self.path):
+            return offset, answered
+        with open(self.path, 'r+b') as f_log:
+            data = f_log.read()
+            good = 0
+            for pos in range(0, len(data) - RECORD.size + 1, RECORD.size):
+                record = unpack(data[pos:pos + RECORD.size])
+                if record is None:
+                    break
+                kind, a, b, c = record
+                if kind == OFFSET:
+                    offset = a
+                elif kind == ANSWERED:
+                    answered.append((a, b, c))
+                good = pos + RECORD.size
+            self.truncate(f_log, good)
+        if data and not good:
+            logging.error('no valid records in offset log %s', self.path)
+        return offset, answered
+
+    def truncate(self, f_log, size):
+        if os.fstat(f_log.fileno()).st_size != size:
+            logging.error('cutting offset log %s to %d bytes', self.path, size)
+            f_log.truncate(size)
+            os.fsync(f_log.fileno())
+        self.records = size // RECORD.size
+
+    def open(self):
+        if self.file is None:
+            self.file = open(self.path, 'ab')
+        return self.file
+
+    def append(self, offset):
+        with self.lock:
+            self.stats['appends'] += 1
+            self.pending = offset
+            if self.last_sync is None or time.monotonic() - self.last_sync >= self.interval:
+                self.flush()
+            else:
+                self.flush_later()
+
+    def answer(self, keys):
+        '''Logs (update_id, chat id, message id) of an answered update with the next write.'''
+        with self.lock:
+            self.answers.append(keys)
+            self.flush_later()
+
+    def flush_later(self):
+        if self.timer is None:
+            self.timer = threading.Timer(self.interval, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        '''Writes and fsyncs the answered updates and the latest pending offset.'''
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            records = [pack(ANSWERED, *keys) for keys in self.answers]
+            if self.pending is not None and self.pending != self.written:
+                records.append(pack(OFFSET, self.pending))
+            if not records:
+                return
+            f_out = self.open()
+            f_out.write(b''.join(records))
+            f_out.flush()
+            os.fsync(f_out.fileno())
+            self.answers = []
+            self.written = self.pending
+            self.records += len(records)
+            self.last_sync = time.monotonic()
+            self.stats['writes'] += 1
+
+    def compact_if_due(self):
+        '''Compacts after compact_every records, call it where the bot state does not change.'''
+        with self.lock:
+            if self.compact_every and self.records >= self.compact_every:
+                self.compact()
+                return True
+        return False
+
+    def compact(self):
+        '''Saves the whole state, then starts the log over.'''
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            # the state has the pending offset or a later one, and the answered updates
+            self.written = self.pending
+            self.answers = []
+            if self.save_state is not None:
+                self.save_state()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            with open(self.path, 'wb') as f_out:
+                os.fsync(f_out.fileno())
+            self.records = 0
+            self.stats['compactions'] += 1
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
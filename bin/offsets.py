@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+'''Update offset bookkeeping for engines that answer updates out of order.'''
+
+
+class OffsetTracker(object):
+    '''Tracks which fetched updates are still being answered.
+
+    fetch_offset is the offset for the next getUpdates, committed only moves
+    past an update once it and every update before it are acknowledged.
+    '''
+
+    def __init__(self, offset):
+        self.committed = offset
+        self.fetch_offset = offset
+        self.pending = set()
+
+    def add(self, update_id):
+        '''Registers a fetched update, returns False for one seen already.'''
+        if update_id < self.fetch_offset:
+            return False
+        self.fetch_offset = update_id + 1
+        self.pending.add(update_id)
+        return True
+
+    def ack(self, update_id):
+        '''Marks the update answered and returns the committed offset.'''
+        self.pending.discard(update_id)
+        offset = min(self.pending) if self.pending else self.fetch_offset
+        self.committed = max(self.committed, offset)
+        return self.committed
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+'''Coalescing of outgoing messages.
+
+Commands like "все" answer with a header and a body per weekday. Sending
+each of them separately costs a round trip per message, so adjacent
+sendMessage replies to the same chat with the same options are joined
+with a newline up to Telegram's message length limit. Replies longer than
+the limit are split, preferably between paragraphs, and never inside a
+*bold* or _italic_ span.
+'''
+
+
+MAX_MESSAGE_LENGTH = 4096
+SEPARATORS = ['\n\n', '\n', ' ']
+MARKERS = '*_'
+
+
+def is_balanced(text):
+    return all(text.count(marker) % 2 == 0 for marker in MARKERS)
+
+
+def split_text(text, limit=MAX_MESSAGE_LENGTH):
+    parts = []
+    while len(text) > limit:
+        cut = None
+        for separator in SEPARATORS:
+            pos = text.rfind(separator, 0, limit - len(separator) + 1)
+            while pos > 0 and not is_balanced(text[:pos]):
+                pos = text.rfind(separator, 0, pos)
+            if pos > 0:
+                cut = pos + len(separator)
+                break
+        if cut is None:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:]
+    parts.append(text)
+    return parts
+
+
+def can_merge(first, second, limit):
+    if set(first) != set(second):
+        return False
+    if any(first[k] != second[k] for k in first if k != 'text'):
+        return False
+    return len(first['text']) + 1 + len(second['text']) <= limit
+
+
+def coalesce(replies, limit=MAX_MESSAGE_LENGTH):
+    '''Merges and splits a list of (action, message) replies.'''
+    result = []
+    for action, msg in replies:
+        if action != 'sendMessage':
+            result.append((action, msg))
+            continue
+        for text in split_text(msg['text'], limit):
+            msg = dict(msg, text=text)
+            if result and result[-1][0] == 'sendMessage' and can_merge(result[-1][1], msg, limit):
+                result[-1][1]['text'] += '\n' + text
+            else:
+                result.append((action, msg))
+    return result
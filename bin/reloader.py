@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+'''Restart by reloading the code of commands and of the fetcher in place.
+
+The modules in RELOADED are reloaded in this order and the bot gets the
+class of the reloaded yanbinbot module. Everything else stays: the state
+of the bot, the schedule cache with the schedule it has, the reminders
+and the keep-alive session of utils. A module lists the globals that
+survive its reload in KEEP_ON_RELOAD, this is how the fetcher keeps
+its conditional request validators and parsed tables.
+'''
+
+import importlib
+import logging
+import sys
+
+
+# leaves first, modules that import the bot last
+RELOADED = [
+    'matcher',
+    'outgoing',
+    'render',
+    'schedule.diff',
+    'schedule.index',
+    'schedule.fetcher',
+    'yanbinbot',
+    'async_runner',
+    'webhook',
+    'workers',
+]
+
+
+def reload_module(name):
+    module = sys.modules.get(name)
+    if module is None:
+        return importlib.import_module(name)
+    kept = dict((attr, getattr(module, attr)) for attr in getattr(module, 'KEEP_ON_RELOAD', ()))
+    try:
+        module = importlib.reload(module)
+    finally:
+        # also when the new code is broken, the old one keeps working with its state
+        for attr, value in kept.items():
+            setattr(module, attr, value)
+    return module
+
+
+def reload_bot(bot):
+    '''Reloads RELOADED and switches bot to the new code, returns False on errors.'''
+    try:
+        for name in RELOADED:
+            # engines are imported when they are used
+            if name == 'yanbinbot' or name in sys.modules:
+                reload_module(name)
+        bot.__class__ = sys.modules['yanbinbot'].TheBot
+        bot.reloaded()
+    except Exception as ex:
+        logging.error('failed to reload the code: %s', str(ex))
+        return False
+    return True
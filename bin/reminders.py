@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+'''Reminders about upcoming lessons.
+
+A chat subscribes to be reminded N minutes before lessons that match a
+filter. Lessons repeat weekly, so every (subscription, lesson) pair is
+one timer in a heap ordered by the next time it fires; a fired timer is
+pushed back for the next week. When the schedule changes only the timers
+of changed lessons are replaced, the heap is not rebuilt. Timers are
+deleted lazily: the heap entry stays until it comes up and is skipped.
+
+Only subscriptions and the time reminders were last checked are saved;
+the timers are rebuilt from them, so reminders that came due while the
+bot was down are still sent if their lesson has not started yet.
+'''
+
+import schedule.times as times
+import schedule.weekday as weekday
+
+import datetime
+import heapq
+import threading
+
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+WEEK = datetime.timedelta(days=7)
+
+
+def next_fire(dow, starts, minutes_before, after):
+    '''First time after `after` that is minutes_before ahead of a lesson at dow, starts.'''
+    midnight = after.replace(hour=0, minute=0, second=0, microsecond=0)
+    lesson = midnight + datetime.timedelta(days=(dow.ordinal - after.weekday()) % 7, minutes=starts)
+    fire = lesson - datetime.timedelta(minutes=minutes_before)
+    while fire <= after:
+        fire += WEEK
+    return fire
+
+
+class ReminderQueue(object):
+    '''make_filter(text) returns predicate(discipline, lesson) for a filter text.'''
+
+    def __init__(self, make_filter):
+        self.make_filter = make_filter
+        self.lock = threading.RLock()
+        # (chat, minutes, filter text) -> predicate
+        self.filters = {}
+        # (discipline, weekday, starts, place) -> (discipline, weekday, lesson)
+        self.lessons = {}
+        self.heap = []
+        self.seq = 0
+        # (subscription, slot) -> fire time of the live heap entry
+        self.timers = {}
+        self.by_slot = {}
+        self.by_subscription = {}
+        self.checked = None
+
+    def now(self):
+        return datetime.datetime.now()
+
+    def subscriptions(self):
+        '''{str(chat): [[minutes, filter]]}, as saved with the bot state.'''
+        result = {}
+        with self.lock:
+            for chat, minutes, text in self.filters:
+                result.setdefault(chat, []).append([minutes, text])
+        return result
+
+    def restore(self, subscriptions, checked=None):
+        with self.lock:
+            self.filters = {}
+            for chat, items in subscriptions.items():
+                for minutes, text in items:
+                    self.filters[(chat, minutes, text)] = self.make_filter(text)
+            if checked:
+                self.checked = datetime.datetime.strptime(checked, TIME_FORMAT)
+            self.rebuild()
+
+    def checked_time(self):
+        with self.lock:
+            return self.checked.strftime(TIME_FORMAT) if self.checked else None
+
+    def add(self, chat, minutes, text):
+        subscription = (chat, minutes, text)
+        with self.lock:
+            if subscription in self.filters:
+                return
+            self.filters[subscription] = self.make_filter(text)
+            for slot in self.lessons:
+                self.add_timer(subscription, slot)
+
+    def remove(self, chat, text=None):
+        '''Removes reminders of the chat, only those with the filter if given.'''
+        with self.lock:
+            for subscription in [s for s in self.filters if s[0] == chat and text in (None, s[2])]:
+                del self.filters[subscription]
+                for key in self.by_subscription.pop(subscription, ()):
+                    self.drop_timer(key)
+
+    def update(self, schedule, changes=None):
+        '''Takes a new schedule, only the lessons in changes when they are given.'''
+        with self.lock:
+            if changes is None:
+                self.lessons = {}
+                for discipline, days in schedule.items():
+                    for dow in weekday.days:
+                        for lesson in days.get(dow, ()):
+                            self.add_lesson(discipline, dow, lesson)
+                self.rebuild()
+                return
+            for change in changes:
+                if change.old:
+                    slot = self.slot(change.discipline, change.dow, change.old)
+                    self.lessons.pop(slot, None)
+                    for key in self.by_slot.pop(slot, ()):
+                        self.drop_timer(key)
+                if change.new:
+                    slot = self.add_lesson(change.discipline, change.dow, change.new)
+                    if slot:
+                        for subscription in self.filters:
+                            self.add_timer(subscription, slot)
+
+    def due(self, now=None):
+        '''Returns [(chat, minutes, discipline, weekday, lesson)] to remind about now.'''
+        now = now or self.now()
+        reminders = []
+        with self.lock:
+            if self.checked is None:
+                self.checked = now
+            while self.heap and self.heap[0][0] <= now:
+                fire, _, key = heapq.heappop(self.heap)
+                if self.timers.get(key) != fire:
+                    continue
+                (chat, minutes, _), slot = key
+                discipline, dow, lesson = self.lessons[slot]
+                # reminders missed while the bot was down are late, not useless
+                if now < fire + datetime.timedelta(minutes=minutes):
+                    reminders.append((chat, minutes, discipline, dow, lesson))
+                self.push(key, next_fire(dow, slot[2], minutes, now))
+            self.checked = now
+            if len(self.heap) > 2 * len(self.timers) + 64:
+                self.heap = [(fire, seq, key) for fire, seq, key in self.heap if self.timers.get(key) == fire]
+                heapq.heapify(self.heap)
+        return reminders
+
+    @staticmethod
+    def slot(discipline, dow, lesson):
+        return (discipline, dow, times.minutes(lesson.starts), lesson.place.strip())
+
+    def add_lesson(self, discipline, dow, lesson):
+        if not lesson:
+            return None
+        slot = self.slot(discipline, dow, lesson)
+        if slot[2] == times.NO_MINUTES:
+            return None
+        self.lessons[slot] = (discipline, dow, lesson)
+        return slot
+
+    def rebuild(self):
+        self.heap = []
+        self.timers = {}
+        self.by_slot = {}
+        self.by_subscription = {}
+        for subscription in self.filters:
+            for slot in self.lessons:
+                self.add_timer(subscription, slot)
+
+    def add_timer(self, subscription, slot):
+        discipline, dow, lesson = self.lessons[slot]
+        if not self.filters[subscription](discipline, lesson):
+            return
+        key = (subscription, slot)
+        self.by_slot.setdefault(slot, set()).add(key)
+        self.by_subscription.setdefault(subscription, set()).add(key)
+        after = self.checked or self.now()
+        self.push(key, next_fire(dow, slot[2], subscription[1], after))
+
+    def drop_timer(self, key):
+        self.timers.pop(key, None)
+        subscription, slot = key
+        self.by_slot.get(slot, set()).discard(key)
+        self.by_subscription.get(subscription, set()).discard(key)
+
+    def push(self, key, fire):
+        self.seq += 1
+        self.timers[key] = fire
+        heapq.heappush(self.heap, (fire, self.seq, key))
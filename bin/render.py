@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+'''Markdown rendering of lesson lists and a cache of rendered replies.'''
+
+import collections
+import threading
+
+
+RENDER_CACHE_SIZE = 256
+NOT_FOUND = 'занятия, соответствующие вашему запросу, не найдены\n'
+
+
+def render_lesson(l):
+    parts = ['_%s%s_ *%s* _%s_: %s, %s' % (l.starts, ('-'+l.ends if l.ends else ''), l.teacher, l.name, l.complex, l.place)]
+    if l.difficulty.strip():
+        parts.append(', *%s нагрузка*' % l.difficulty.strip())
+    if l.audience.strip():
+        parts.append(', %s' % l.audience.strip())
+    if l.comment.strip():
+        parts.append(' - *%s*' % l.comment.strip())
+    parts.append('\n\n')
+    return ''.join(parts)
+
+
+def render_lessons(sections):
+    '''sections: [(label, lessons)], sections without lessons are skipped.'''
+    parts = []
+    for label, lessons in sections:
+        if lessons:
+            parts.append('*%s*\n\n' % label)
+            parts.extend(render_lesson(l) for l in lessons)
+            parts.append('\n')
+    return ''.join(parts) or NOT_FOUND
+
+
+class RenderCache(object):
+    '''LRU cache of rendered replies that counts hits and misses.'''
+
+    def __init__(self, size=RENDER_CACHE_SIZE):
+        self.size = size
+        self.items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
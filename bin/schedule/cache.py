@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+'''Stale-while-revalidate cache for the fetched schedule.
+
+The first get() fetches synchronously because there is nothing to serve
+yet. After the TTL (plus a random jitter, so restarted bots do not hit
+the spreadsheet at the same moment) get() keeps returning the old
+schedule and starts one background refresh. A failed refresh is logged,
+the old schedule stays and the next attempt is made after `retry` seconds.
+'''
+
+import logging
+import random
+import threading
+import time
+
+
+class ScheduleCache(object):
+    def __init__(self, fetch, ttl=3600, jitter=0, retry=60):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.jitter = jitter
+        self.retry = retry
+        self.value = None
+        self.version = 0
+        self.loaded_at = None
+        self.expires = 0
+        self.refreshing = False
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+
+    def add_listener(self, listener):
+        '''listener(old, new) is called after every successful load.'''
+        self.listeners.append(listener)
+
+    def get(self):
+        with self.lock:
+            value = self.value
+            if value is not None:
+                if time.monotonic() >= self.expires and not self.refreshing:
+                    self.refreshing = True
+                    threading.Thread(target=self.background_refresh, daemon=True).start()
+                return value
+        with self.load_lock:
+            if self.value is None:
+                self.set(self.fetch())
+            return self.value
+
+    def background_refresh(self):
+        try:
+            with self.load_lock:
+                value = self.fetch()
+                if value is None:
+                    raise ValueError('fetcher returned no schedule')
+                self.set(value)
+        except Exception as ex:
+            logging.error('failed to refresh schedule, serving the one loaded at %s: %s',
+                          time.ctime(self.loaded_at), str(ex))
+            with self.lock:
+                self.expires = time.monotonic() + self.retry
+        finally:
+            self.refreshing = False
+
+    def set(self, value, loaded_at=None):
+        '''Stores a schedule fetched at loaded_at (time.time(), now by default).
+
+        Setting the object already stored only renews its expiration time.
+        '''
+        if value is None:
+            raise ValueError('fetcher returned no schedule')
+        now = time.time()
+        loaded_at = now if loaded_at is None else loaded_at
+        with self.lock:
+            old = self.value
+            self.value = value
+            self.loaded_at = loaded_at
+            self.expires = time.monotonic() + self.ttl + random.uniform(0, self.jitter) - (now - loaded_at)
+            if value is old:
+                return
+            self.version += 1
+        for listener in self.listeners:
+            listener(old, value)
+
+    def invalidate(self):
+        with self.lock:
+            self.expires = 0
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+'''Compact in-memory layout of a schedule.
+
+Most cells repeat across hundreds of rows: places, teachers, difficulty,
+audience. CompactLessons keeps the lessons of one day of one discipline
+as columns of codes into a shared StringTable, with start and end times
+parsed into minutes since midnight. It is an immutable sequence of
+Lesson, so the index and the renderer work with it unchanged; a Lesson
+is built only when it is accessed. Rows that failed to parse (None) are
+dropped, the index skips them anyway.
+'''
+
+from schedule.schedule import Lesson
+from schedule.times import minutes
+
+import array
+import sys
+
+
+# the table is rebuilt once it holds this many times the strings it was rebuilt with
+TABLE_GROWTH = 2
+
+
+class StringTable(object):
+    '''Interned strings addressed by small integer codes.'''
+
+    def __init__(self):
+        self.strings = []
+        self.codes = {}
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.strings)
+            self.strings.append(sys.intern(value))
+        return code
+
+
+class CompactLessons(object):
+    __slots__ = ('strings', 'columns', 'starts_minutes', 'ends_minutes')
+
+    def __init__(self, lessons, table):
+        lessons = [l for l in lessons if l]
+        self.strings = table.strings
+        self.columns = tuple(array.array('I', (table.code(l[field]) for l in lessons))
+                             for field in range(len(Lesson._fields)))
+        self.starts_minutes = array.array('h', (minutes(l.starts) for l in lessons))
+        self.ends_minutes = array.array('h', (minutes(l.ends) for l in lessons))
+
+    def __len__(self):
+        return len(self.starts_minutes)
+
+    def __getitem__(self, pos):
+        if isinstance(pos, slice):
+            return [self[i] for i in range(*pos.indices(len(self)))]
+        strings = self.strings
+        return Lesson._make(strings[column[pos]] for column in self.columns)
+
+    def __iter__(self):
+        strings = self.strings
+        for codes in zip(*self.columns):
+            yield Lesson._make(strings[code] for code in codes)
+
+
+def compact(schedule, table=None):
+    '''Returns the schedule with every list of lessons replaced by CompactLessons.'''
+    if table is None:
+        table = StringTable()
+    return {discipline: {day: CompactLessons(lessons, table) for day, lessons in days.items()}
+            for discipline, days in schedule.items()}
+
+
+class Compactor(object):
+    '''Wraps a fetch function to return compact schedules.
+
+    The same fetched schedule gives the same compact one, so ScheduleCache
+    still sees an unchanged schedule as unchanged, and disciplines whose
+    table the fetcher did not reparse are not converted again. Strings of
+    lessons that changed stay in the table, so once it has grown
+    TABLE_GROWTH times it is rebuilt from the current schedule.
+    '''
+
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self.table = StringTable()
+        # strings in the table when it was last rebuilt
+        self.table_size = None
+        self.source = None
+        self.result = None
+        self.disciplines = {}
+
+    def convert(self, schedule):
+        result = self.convert_changed(schedule)
+        if self.table_size is None:
+            self.table_size = len(self.table.strings)
+        elif len(self.table.strings) > TABLE_GROWTH * self.table_size:
+            self.table = StringTable()
+            self.disciplines = {}
+            result = self.convert_changed(schedule)
+            self.table_size = len(self.table.strings)
+        return result
+
+    def convert_changed(self, schedule):
+        disciplines = {}
+        for discipline, days in schedule.items():
+            known = self.disciplines.get(discipline)
+            if known is None or known[0] is not days:
+                known = (days, compact({discipline: days}, self.table)[discipline])
+            disciplines[discipline] = known
+        self.disciplines = disciplines
+        return {discipline: known[1] for discipline, known in disciplines.items()}
+
+    def __call__(self):
+        source = self.fetch()
+        if source is not self.source:
+            self.result = self.convert(source)
+            self.source = source
+        return self.result
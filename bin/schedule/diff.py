@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+'''Lesson level differences between two schedules.
+
+Lessons are matched by day, discipline, start time and place: the same
+slot with another teacher or comment is a change, a slot that appears or
+disappears is an addition or a removal. Disciplines and days whose lesson
+lists are the very same objects are skipped without looking inside; the
+fetcher keeps unchanged tables as the same objects, so the work is
+proportional to the tables that changed, not to the whole schedule.
+'''
+
+import schedule.weekday as weekday
+
+from collections import namedtuple
+
+
+# old is None for an added lesson, new is None for a removed one
+Change = namedtuple('Change', ['discipline', 'dow', 'old', 'new'])
+
+
+def slot(lesson):
+    return (lesson.starts.strip(), lesson.place.strip())
+
+
+def diff_lessons(old, new):
+    '''Yields (old, new) pairs of lessons of one day that differ.'''
+    old_slots = {}
+    for lesson in old:
+        if lesson:
+            old_slots.setdefault(slot(lesson), []).append(lesson)
+    for lesson in new:
+        if not lesson:
+            continue
+        same_slot = old_slots.get(slot(lesson))
+        if not same_slot:
+            yield None, lesson
+            continue
+        previous = same_slot.pop(0)
+        if previous != lesson:
+            yield previous, lesson
+    for lessons in old_slots.values():
+        for lesson in lessons:
+            yield lesson, None
+
+
+def diff(old, new):
+    '''Changes from schedule old to schedule new, in day order.'''
+    changes = []
+    if old is new:
+        return changes
+    disciplines = list(old) + [d for d in new if d not in old]
+    for dow in weekday.days:
+        for discipline in disciplines:
+            old_days, new_days = old.get(discipline, {}), new.get(discipline, {})
+            if old_days is new_days:
+                continue
+            old_lessons, new_lessons = old_days.get(dow, ()), new_days.get(dow, ())
+            if old_lessons is new_lessons:
+                continue
+            for previous, lesson in diff_lessons(old_lessons, new_lessons):
+                changes.append(Change(discipline, dow, previous, lesson))
+    return changes
@@ -2,35 +2,205 @@
 # -*- coding: utf-8 -*-
 
 import os
-from schedule.schedule import Lesson
+from schedule.schedule import Lesson, NAMESPACE_SEPARATOR
 import schedule.weekday as weekday
 
-import pyquery
+import codecs
+import concurrent.futures
+import html.parser
 import requests
-import parse
 import json
+import hashlib
+import threading
 
 
 SHIYANBIN_SCHEDULE_LINK = 'https://docs.google.com/spreadsheets/d/1qrSKfJFQ79qYXdmEPNAy20ibVyMWhOOw1lscJG8lALQ/pubhtml#'
 
 NO_TEXT = '---NO_TEXT---'
 
+# Returned by request_shiyanbin_schedule when the page has not changed
+# since the previous successful request.
+NOT_MODIFIED = 'not modified'
 
-def request_shiyanbin_schedule():
-    response = requests.get(SHIYANBIN_SCHEDULE_LINK)
-    if response.ok:
-        return pyquery.PyQuery(response.content.decode('utf-8'))('table')
+TABLES = ['qigong', 'kungfu', 'children']
+# Lesson fields by table column, None is the column appended to another
+# field as SUFFIXES tells.
+COLUMNS = {
+    'qigong': ['starts', 'ends', 'name', 'place', 'teacher', 'comment',
+               'difficulty', 'complex', None, 'audience'],
+    'kungfu': ['starts', 'ends', 'name', 'place', 'teacher', 'difficulty',
+               'complex', 'comment', None, 'audience'],
+    'children': ['starts', 'ends', 'name', 'audience', None, 'place',
+                 'teacher', 'complex', 'comment'],
+}
+SUFFIXES = {
+    'qigong': ('complex', ' ({0})'),
+    'kungfu': ('complex', ' ({0})'),
+    'children': ('audience', ' (age {0})'),
+}
+CHUNK_SIZE = 64 * 1024
 
+# [(name, link)] fetched by fetch() instead of the default spreadsheet
+_sources = []
+# parses changed tables of a spreadsheet concurrently when set
+_parse_executor = None
 
-def iterrows(table):
-    for row in table.findall('.//tr'):
-        yield [NO_TEXT if td.text is None else td.text.strip() for td in row.findall('td')]
+# link -> conditional request headers taken from the last 200 response
+_validators = {}
+# link -> last fetched schedule
+_schedules = {}
+# (link, table kind) -> (table digest, parsed table)
+_tables = {}
+# links of fetch_all sources -> (schedules of the sources, combined schedule)
+_combined = {}
 
+stats = {
+    'refreshes': 0,
+    'not_modified': 0,
+    'tables_parsed': 0,
+    'tables_skipped': 0,
+}
+_stats_lock = threading.Lock()
 
-def parse_table(table, row_parser):
+# caches and settings that survive a hot reload, see reloader
+KEEP_ON_RELOAD = ['_sources', '_parse_executor', '_validators', '_schedules', '_tables', '_combined',
+                  'stats', '_stats_lock']
+
+
+def count(name):
+    with _stats_lock:
+        stats[name] += 1
+
+
+def configure(sources=None, parse_workers=0, parse_processes=False):
+    '''Sets the spreadsheets fetch() reads and how their tables are parsed.
+
+    sources is [(name, link)], every spreadsheet gets its disciplines
+    prefixed with its name. With parse_workers the tables of a spreadsheet
+    are parsed in a thread pool, or in a process pool with parse_processes.
+    '''
+    global _sources, _parse_executor
+    _sources = list(sources or [])
+    if _parse_executor is not None:
+        _parse_executor.shutdown()
+    _parse_executor = None
+    if parse_workers:
+        pool = concurrent.futures.ProcessPoolExecutor if parse_processes else concurrent.futures.ThreadPoolExecutor
+        _parse_executor = pool(max_workers=parse_workers)
+
+
+class TableParser(html.parser.HTMLParser):
+    '''Collects cell texts of the first tables of a page, row by row.
+
+    The text of a cell is the text before its first child element,
+    stripped, or NO_TEXT if there is none. Once the last wanted table
+    is closed the rest of the page is ignored, so reading can stop.
+    '''
+
+    def __init__(self, max_tables=len(TABLES)):
+        super().__init__(convert_charrefs=True)
+        self.max_tables = max_tables
+        self.tables = []
+        self.depth = 0
+        self.row = None
+        self.cell = None
+        self.in_text = False
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if tag == 'table':
+            self.depth += 1
+            if self.depth == 1:
+                self.tables.append([])
+        elif self.depth != 1:
+            return
+        elif tag == 'tr':
+            self.end_row()
+            self.row = []
+        elif tag == 'td':
+            self.end_cell()
+            if self.row is None:
+                self.row = []
+            self.cell = []
+            self.in_text = True
+        else:
+            self.in_text = False
+
+    def handle_endtag(self, tag):
+        if self.done or self.depth == 0:
+            return
+        if tag == 'table':
+            if self.depth == 1:
+                self.end_row()
+                self.done = len(self.tables) >= self.max_tables
+            self.depth -= 1
+        elif self.depth != 1:
+            return
+        elif tag == 'td':
+            self.end_cell()
+        elif tag == 'tr':
+            self.end_row()
+
+    def handle_data(self, data):
+        if self.in_text:
+            self.cell.append(data)
+
+    def handle_comment(self, data):
+        self.in_text = False
+
+    def end_cell(self):
+        if self.cell is not None:
+            self.row.append(''.join(self.cell).strip() if self.cell else NO_TEXT)
+            self.cell = None
+            self.in_text = False
+
+    def end_row(self):
+        self.end_cell()
+        if self.row is not None:
+            self.tables[-1].append(self.row)
+            self.row = None
+
+
+def read_tables(chunks, max_tables=len(TABLES)):
+    '''Rows of the first max_tables tables of a page given as byte chunks.'''
+    parser = TableParser(max_tables)
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for chunk in chunks:
+        parser.feed(decoder.decode(chunk))
+        if parser.done:
+            break
+    else:
+        parser.feed(decoder.decode(b'', final=True))
+        parser.close()
+    return parser.tables
+
+
+def request_shiyanbin_schedule(link=None):
+    link = link or SHIYANBIN_SCHEDULE_LINK
+    response = requests.get(link, headers=_validators.get(link, {}), stream=True)
+    if response.status_code == 304:
+        response.close()
+        if link in _schedules:
+            return NOT_MODIFIED
+        response = requests.get(link, stream=True)
+    with response:
+        # requests.HTTPError: the schedule cache keeps serving the last good schedule
+        response.raise_for_status()
+        validators = {}
+        if response.headers.get('ETag'):
+            validators['If-None-Match'] = response.headers['ETag']
+        if response.headers.get('Last-Modified'):
+            validators['If-Modified-Since'] = response.headers['Last-Modified']
+        _validators[link] = validators
+        return read_tables(response.iter_content(CHUNK_SIZE))
+
+
+def parse_table(rows, row_parser):
     current_day = 0
     schedule = {}
-    for row in iterrows(table):
+    for row in rows:
         if current_day < len(weekday.days) and row and weekday.days[current_day] == row[0]:
             current_day += 1
             continue
@@ -43,56 +213,34 @@ def parse_table(table, row_parser):
     return schedule
 
 
-def parse_lesson_from_kungfu_table(row):
-    result = parse.parse('{starts}###{ends}###{name}###'
-                         '{place}###{teacher}###{difficulty}'
-                         '###{complex}###{comment}###{}###{audience}',
-                         '###'.join(row))
-    if result is None:
+def parse_lesson(row, kind):
+    '''Maps the cells of a row to Lesson fields by position, None for short rows.'''
+    columns = COLUMNS[kind]
+    if len(row) < len(columns):
         return None
-
-    values = result.named
-    for k, v in values.items():
-        if v == NO_TEXT:
-            values[k] = ''
-    if result[0] != NO_TEXT:
-        values['complex'] += ' ({0})'.format(result[0])
+    values = dict.fromkeys(Lesson._fields, '')
+    extra = NO_TEXT
+    for field, text in zip(columns, row):
+        if field is None:
+            extra = text
+        elif text != NO_TEXT:
+            values[field] = text
+    if extra != NO_TEXT:
+        field, suffix = SUFFIXES[kind]
+        values[field] += suffix.format(extra)
     return Lesson(**values)
 
 
-def parse_lesson_from_qigong_table(row):
-    result = parse.parse('{starts}###{ends}###{name}###'
-                         '{place}###{teacher}###{comment}'
-                         '###{difficulty}###{complex}###{}###{audience}',
-                         '###'.join(row))
-    if result is None:
-        return None
+def parse_lesson_from_kungfu_table(row):
+    return parse_lesson(row, 'kungfu')
 
-    values = result.named
-    for k, v in values.items():
-        if v == NO_TEXT:
-            values[k] = ''
-    if result[0] != NO_TEXT:
-        values['complex'] += ' ({0})'.format(result[0])
-    return Lesson(**values)
 
+def parse_lesson_from_qigong_table(row):
+    return parse_lesson(row, 'qigong')
 
-def parse_lesson_from_children_table(row):
-    result = parse.parse('{starts}###{ends}###{name}###'
-                         '{audience}###{}###{place}'
-                         '###{teacher}###{complex}###{comment}',
-                         '###'.join(row))
-    if result is None:
-        return None
 
-    values = result.named
-    for k, v in values.items():
-        if v == NO_TEXT:
-            values[k] = ''
-    if result[0] != NO_TEXT:
-        values['audience'] += ' (age {0})'.format(result[0])
-    values['difficulty'] = ''
-    return Lesson(**values)
+def parse_lesson_from_children_table(row):
+    return parse_lesson(row, 'children')
 
 
 def to_json(python_object):
@@ -103,13 +251,87 @@ def to_json(python_object):
         raise TypeError(repr(python_object) + ' is not JSON serializable')
 
 
-def fetch():
-    sch = request_shiyanbin_schedule()
-    qigong, kungfu, children = sch[:3]
-    kungfu = parse_table(kungfu, parse_lesson_from_kungfu_table)
-    qigong = parse_table(qigong, parse_lesson_from_qigong_table)
-    children = parse_table(children, parse_lesson_from_children_table)
-    return {'qigong': qigong, 'kungfu': kungfu, 'children': children}
+ROW_PARSERS = {
+    'qigong': parse_lesson_from_qigong_table,
+    'kungfu': parse_lesson_from_kungfu_table,
+    'children': parse_lesson_from_children_table,
+}
+
+
+def parse_tables(link, tables, executor=None):
+    '''Parses the tables by TABLES, reusing those whose cells did not change.
+
+    Changed tables are parsed with the executor when there are several,
+    the result does not depend on which of them is done first.
+    '''
+    result = {}
+    changed = []
+    for kind, rows in zip(TABLES, tables):
+        digest = hashlib.sha1(repr(rows).encode('utf-8')).digest()
+        cached = _tables.get((link, kind))
+        if cached and cached[0] == digest:
+            count('tables_skipped')
+            result[kind] = cached[1]
+        else:
+            changed.append((kind, digest, rows))
+    row_parsers = [ROW_PARSERS[kind] for kind, _, _ in changed]
+    rows = [rows for _, _, rows in changed]
+    if executor is not None and len(changed) > 1:
+        parsed = list(executor.map(parse_table, rows, row_parsers))
+    else:
+        parsed = list(map(parse_table, rows, row_parsers))
+    for (kind, digest, _), table in zip(changed, parsed):
+        count('tables_parsed')
+        _tables[(link, kind)] = (digest, table)
+        result[kind] = table
+    return {kind: result[kind] for kind in TABLES}
+
+
+def fetch_sheet(link, executor=None):
+    '''Returns the schedule of one spreadsheet, the very same object when nothing changed.'''
+    count('refreshes')
+    sch = request_shiyanbin_schedule(link)
+    if sch is NOT_MODIFIED:
+        count('not_modified')
+        return _schedules[link]
+    result = parse_tables(link, sch[:len(TABLES)], executor)
+    previous = _schedules.get(link)
+    if previous and all(previous[k] is result[k] for k in result):
+        count('not_modified')
+        result = previous
+    _schedules[link] = result
+    return result
+
+
+def fetch_all(sources, executor=None):
+    '''Fetches [(name, link)] in parallel into one schedule keyed by 'name/discipline'.
+
+    Disciplines follow the order of sources. The very same object is
+    returned when none of the spreadsheets changed.
+    '''
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(sources)) as pool:
+        parts = list(pool.map(lambda source: fetch_sheet(source[1], executor), sources))
+    key = tuple(link for _, link in sources)
+    previous = _combined.get(key)
+    if previous and all(a is b for a, b in zip(previous[0], parts)):
+        return previous[1]
+    result = {}
+    for (name, _), part in zip(sources, parts):
+        for discipline, days in part.items():
+            result[name + NAMESPACE_SEPARATOR + discipline] = days
+    _combined[key] = (parts, result)
+    return result
+
+
+def fetch(link=None):
+    '''Returns the schedule, the very same object when nothing changed.
+
+    Without a link the configured spreadsheets are fetched, by default the
+    one at SHIYANBIN_SCHEDULE_LINK.
+    '''
+    if link is None and _sources:
+        return fetch_all(_sources, _parse_executor)
+    return fetch_sheet(link or SHIYANBIN_SCHEDULE_LINK, _parse_executor)
 
 
 def main():
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+'''Lookup tables over one loaded schedule.
+
+The index is built once per schedule and never modified, so it can be
+shared between threads. Lessons are addressed by their position in the
+sheet, which is also the order they are shown in. Lessons of several
+spreadsheets are kept apart by studio, the namespace of their disciplines.
+'''
+
+from schedule.schedule import NAMESPACE_SEPARATOR
+import schedule.compact as compact
+import schedule.times as times
+import schedule.weekday as weekday
+
+import bisect
+import re
+
+
+MAX_CACHED_PATTERNS = 1024
+
+
+class ScheduleIndex(object):
+    def __init__(self, schedule, version=0):
+        self.schedule = schedule
+        self.version = version
+        # (studio, discipline, weekday) -> lessons in sheet order
+        self.lessons = {}
+        # (studio, discipline, weekday) -> sorted [(start minutes, position)]
+        self.by_start = {}
+        # (studio, discipline, weekday) -> end minutes by position
+        self.ends = {}
+        # (lowercased teacher, studio, discipline, weekday) -> positions
+        self.by_teacher = {}
+        self.teachers = set()
+        self.lower_teachers = set()
+        self.patterns = {}
+        # spreadsheets in the order of the schedule, '' for one without a name
+        self.studios = []
+        for discipline, days in schedule.items():
+            studio, _, discipline = discipline.rpartition(NAMESPACE_SEPARATOR)
+            if studio not in self.studios:
+                self.studios.append(studio)
+            for day, lessons in days.items():
+                dow = day if isinstance(day, weekday.Weekday) else weekday.lookup(day)
+                key = (studio, discipline, dow)
+                if isinstance(lessons, compact.CompactLessons):
+                    starts, ends = lessons.starts_minutes, lessons.ends_minutes
+                else:
+                    lessons = tuple(l for l in lessons if l)
+                    starts = [times.minutes(l.starts) for l in lessons]
+                    ends = [times.minutes(l.ends) for l in lessons]
+                self.lessons[key] = lessons
+                self.by_start[key] = sorted(zip(starts, range(len(lessons))))
+                self.ends[key] = ends
+                for pos, l in enumerate(lessons):
+                    teacher = l.teacher.strip()
+                    if teacher:
+                        self.teachers.add(teacher)
+                        self.lower_teachers.add(teacher.lower())
+                    self.by_teacher.setdefault((teacher.lower(),) + key, []).append(pos)
+
+    def find_teachers(self, pattern):
+        '''Lowercased teachers in which the regular expression is found.'''
+        teachers = self.patterns.get(pattern)
+        if teachers is None:
+            teachers = frozenset(t for t in self.lower_teachers if re.search(pattern, t))
+            if len(self.patterns) >= MAX_CACHED_PATTERNS:
+                self.patterns = {}
+            self.patterns[pattern] = teachers
+        return teachers
+
+    def select(self, discipline, dow, teachers=None, starts_from=None, starts_before=None, running_at=None,
+               studio=''):
+        '''Lessons of the day of the studio by any of the teachers in the time window.
+
+        Times are minutes since midnight: lessons start not earlier than
+        starts_from and before starts_before, running_at is a time they
+        have started by and not ended yet. Lessons without a parsable start
+        time are outside of any window.
+        '''
+        key = (studio, discipline, dow)
+        lessons = self.lessons.get(key, ())
+        positions = None
+        if teachers:
+            positions = set()
+            for teacher in teachers:
+                positions.update(self.by_teacher.get((teacher,) + key, ()))
+        if lessons and (starts_from is not None or starts_before is not None or running_at is not None):
+            by_start = self.by_start[key]
+            # unparsable start times are NO_MINUTES and sort first
+            lo = bisect.bisect_left(by_start, (max(starts_from or 0, 0),))
+            hi = len(by_start)
+            if starts_before is not None:
+                hi = bisect.bisect_left(by_start, (starts_before,))
+            if running_at is not None:
+                hi = min(hi, bisect.bisect_left(by_start, (running_at + 1,)))
+            window = set(pos for _, pos in by_start[lo:hi])
+            if running_at is not None:
+                ends = self.ends[key]
+                window = set(pos for pos in window if ends[pos] > running_at)
+            positions = window if positions is None else positions & window
+        if positions is None:
+            return lessons
+        return [lessons[pos] for pos in sorted(positions)]
@@ -8,3 +8,6 @@ Lesson = namedtuple(
     ['starts', 'ends', 'name',
      'place', 'difficulty', 'teacher',
      'complex', 'comment', 'audience'])
+
+# schedules of several spreadsheets are keyed by '<spreadsheet>/<discipline>'
+NAMESPACE_SEPARATOR = '/'
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+'''On-disk copy of the last fetched schedule.
+
+A snapshot lets a (re)started bot answer the first query at once instead
+of waiting for the spreadsheet. It is compact JSON with the schedule in
+the fetcher's own layout and the time it was fetched.
+'''
+
+from schedule.schedule import Lesson
+import utils
+
+import json
+import os
+
+
+def save(path, schedule, loaded_at):
+    '''Atomically and durably replaces the snapshot at path.'''
+    # the fetcher keys days by repr(Weekday), patched schedules by Weekday
+    data = {
+        'loaded_at': loaded_at,
+        'schedule': {kind: {day if isinstance(day, str) else repr(day): list(lessons)
+                            for day, lessons in days.items()}
+                     for kind, days in schedule.items()},
+    }
+    # a crash never leaves a truncated snapshot for workers and warm starts
+    utils.atomic_write(path, json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+
+def load(path):
+    '''Returns (schedule, loaded_at) stored at path.'''
+    with open(path, 'rb') as f_in:
+        data = json.loads(f_in.read().decode('utf-8'))
+    schedule = {}
+    for kind, days in data['schedule'].items():
+        schedule[kind] = {day: [Lesson(*lesson) if lesson else None for lesson in lessons]
+                          for day, lessons in days.items()}
+    return schedule, data['loaded_at']
+
+
+class SnapshotReader(object):
+    '''Fetch function for ScheduleCache that reads a snapshot another process writes.
+
+    The file is parsed again only when it changes, otherwise the schedule
+    loaded before is returned.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.schedule = None
+
+    def __call__(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime != self.mtime:
+            self.schedule, _ = load(self.path)
+            self.mtime = mtime
+        return self.schedule
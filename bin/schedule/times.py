@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+'''Lesson times as minutes since midnight.
+
+The spreadsheet mostly has '18.30', but also '21:30' and '8.00'.
+
+    >>> minutes('8.30'), minutes('21:30'), minutes(' 18 '), minutes('18.5')
+    (510, 1290, 1080, -1)
+    >>> minutes(''), minutes('по записи'), minutes('25.00')
+    (-1, -1, -1)
+    >>> format_minutes(510)
+    '8.30'
+'''
+
+import datetime
+import re
+
+
+NO_MINUTES = -1
+
+TIME_RE = re.compile(r'^\s*(\d{1,2})(?:[.:](\d\d))?\s*$')
+
+
+def minutes(value):
+    '''Minutes since midnight of 'H.MM', 'HH:MM' or 'H', NO_MINUTES if it is not a time.'''
+    m = TIME_RE.match(value)
+    if not m:
+        return NO_MINUTES
+    hours, mins = int(m.group(1)), int(m.group(2) or 0)
+    if hours < 24 and mins < 60:
+        return hours * 60 + mins
+    return NO_MINUTES
+
+
+def format_minutes(value):
+    return '{0}.{1:02d}'.format(value // 60, value % 60)
+
+
+def now():
+    current = datetime.datetime.today()
+    return current.hour * 60 + current.minute
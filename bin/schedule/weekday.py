@@ -18,6 +18,13 @@
     Weekday(tue)
     >>> FRI + 5
     Weekday(wed)
+    >>> MON - 1, MON - 8
+    (Weekday(sun), Weekday(sun))
+
+    >>> lookup('Weekday(thu)'), lookup(' Пт'), lookup('someday')
+    (Weekday(thu), Weekday(fri), None)
+    >>> {repr(TUE): 1}[TUE]
+    1
 '''
 
 import datetime
@@ -25,10 +32,20 @@ import itertools
 
 
 class Weekday(object):
+    '''A day of the week, equal to any of its names and to its repr.
+
+    Schedules are keyed both by Weekday and by its repr, so the hash is
+    the hash of the repr. The ordinal is set once days are listed.
+    '''
+    __slots__ = ('_short', '_ru_name', '_names', '_repr', '_hash', 'ordinal')
+
     def __init__(self, short, ru, *other_names):
         self._short = short
         self._ru_name = ru
         self._names = tuple(itertools.chain([short, ru], other_names))
+        self._repr = 'Weekday({0})'.format(short)
+        self._hash = hash(self._repr)
+        self.ordinal = None
 
     def short(self):
         return self._short
@@ -37,25 +54,25 @@ class Weekday(object):
         return self._ru_name
 
     def __eq__(self, other):
+        if other is self:
+            return True
         if isinstance(other, str):
-            return other.strip().lower() in self._names or other == repr(self)
-        return self._names == other._names
+            return lookup(other) is self
+        if isinstance(other, Weekday):
+            return self._names == other._names
+        return NotImplemented
 
     def __repr__(self):
-        return 'Weekday({0})'.format(self._short)
+        return self._repr
 
     def __hash__(self):
-        return hash(repr(self))
+        return self._hash
 
     def __add__(self, shift):
-         if shift < 0:
-             return self - (-shift)
-         return days[(days.index(self) + shift) % len(days)]
+        return days[(self.ordinal + shift) % len(days)]
 
     def __sub__(self, shift):
-         if shift < 0:
-             return self + (-shift)
-         return self + (len(days) - shift%len(days))
+        return days[(self.ordinal - shift) % len(days)]
 
 
 MON = Weekday('mon', 'понедельник', '1', 'monday', 'пн')
@@ -77,6 +94,23 @@ days = [
     SUN,
 ]
 
+# repr and every (lowercased) name -> Weekday
+by_name = {}
+for ordinal, day in enumerate(days):
+    day.ordinal = ordinal
+    by_name[repr(day)] = day
+    for name in day._names:
+        by_name[name] = day
+del ordinal, day
+
+
+def lookup(name):
+    '''Weekday by its repr or any of its names, None if there is none.'''
+    day = by_name.get(name)
+    if day is None:
+        day = by_name.get(name.strip().lower())
+    return day
+
 
 def today():
     return days[datetime.datetime.now().weekday()]
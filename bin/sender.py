@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+'''Outgoing message scheduler that keeps within Telegram's rate limits.
+
+Telegram allows about 30 messages per second overall, about one per
+second in a private chat (short bursts are fine) and 20 per minute in a
+group. Exceeding them gets 429 answers with a retry_after. Messages are
+queued per chat, so a chat never gets its replies out of order; among
+chats that may send, short replies go first. A 429 puts the message back
+at the head of its chat queue until retry_after passes; after
+max_retries of them in a row the message is given up on.
+'''
+
+import collections
+import logging
+import threading
+import time
+
+import metrics
+import utils
+
+
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+CHAT_BURST = 10
+GROUP_RATE = 20 / 60.
+GROUP_BURST = 20
+SHORT_MESSAGE = 512
+# 429 answers in a row after which send gives up on a message
+MAX_RETRIES = 5
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def delay(self, now):
+        '''Seconds until a token is available.'''
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class SendScheduler(object):
+    def __init__(self, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE, chat_burst=CHAT_BURST,
+                 group_rate=GROUP_RATE, group_burst=GROUP_BURST, max_retries=MAX_RETRIES,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.max_retries = max_retries
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.clock = clock
+        self.sleep = sleep
+        self.global_bucket = TokenBucket(global_rate, global_rate, clock())
+        self.chat_buckets = {}
+        self.not_before = {}
+        self.queues = collections.OrderedDict()
+        # seq of a queued message -> 429 answers it got
+        self.retries = {}
+        self.seq = 0
+        self.lock = threading.RLock()
+        self.stats = {
+            'queue_depth': 0,
+            'max_queue_depth': 0,
+            'sent': 0,
+            'retried': 0,
+            'wait_seconds': 0.,
+            'max_wait_seconds': 0.,
+        }
+
+    def chat_bucket(self, chat_id, now):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # group and channel ids are negative
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst, now)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst, now)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def submit(self, server_url, action, msg):
+        with self.lock:
+            self.seq += 1
+            item = (server_url, action, msg, self.clock(), self.seq)
+            self.queues.setdefault(msg.get('chat_id'), collections.deque()).append(item)
+            self.stats['queue_depth'] += 1
+            self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], self.stats['queue_depth'])
+
+    def pending(self):
+        return self.stats['queue_depth']
+
+    @staticmethod
+    def priority(item):
+        msg = item[2]
+        return (len(msg.get('text', '')) > SHORT_MESSAGE, item[4])
+
+    def reserve(self, chat_id, now):
+        '''Takes the tokens to send to the chat now or returns how long to wait.'''
+        delay = max(self.not_before.get(chat_id, 0) - now,
+                    self.chat_bucket(chat_id, now).delay(now),
+                    self.global_bucket.delay(now))
+        if delay <= 0:
+            self.chat_bucket(chat_id, now).take()
+            self.global_bucket.take()
+        return delay
+
+    def deliver(self, chat_id, item):
+        '''Sends the item, returns False if it has to be retried later.'''
+        server_url, action, msg, enqueued, _ = item
+        with metrics.SEND.time():
+            response = utils.do_request(server_url, action, msg)
+        retry_after = None
+        if isinstance(response, dict) and not response.get('ok', True):
+            retry_after = response.get('parameters', {}).get('retry_after')
+        if retry_after:
+            logging.warning('chat %s is rate limited for %s s', chat_id, retry_after)
+            with self.lock:
+                self.not_before[chat_id] = self.clock() + retry_after
+                self.stats['retried'] += 1
+            return False
+        wait = self.clock() - enqueued
+        with self.lock:
+            self.stats['sent'] += 1
+            self.stats['wait_seconds'] += wait
+            self.stats['max_wait_seconds'] = max(self.stats['max_wait_seconds'], wait)
+        return True
+
+    def send_ready(self):
+        '''Sends one message that may go now, otherwise returns seconds to wait.'''
+        with self.lock:
+            now = self.clock()
+            delays = []
+            queues = [(chat_id, queue) for chat_id, queue in self.queues.items() if queue]
+            for chat_id, queue in sorted(queues, key=lambda q: self.priority(q[1][0])):
+                delay = self.reserve(chat_id, now)
+                if delay <= 0:
+                    item = queue.popleft()
+                    break
+                delays.append(delay)
+            else:
+                return min(delays) if delays else 0
+        try:
+            done = self.deliver(chat_id, item)
+        except Exception as ex:
+            metrics.SEND_ERRORS.inc()
+            logging.error('failed to send %s: %s', str(item[2]), str(ex))
+            done = True
+        with self.lock:
+            seq = item[4]
+            if not done:
+                self.retries[seq] = self.retries.get(seq, 0) + 1
+                if self.retries[seq] <= self.max_retries:
+                    queue.appendleft(item)
+                else:
+                    metrics.SEND_ERRORS.inc()
+                    logging.error('gave up sending %s after %d rate limited attempts', str(item[2]),
+                                  self.retries[seq])
+                    done = True
+            if done:
+                self.retries.pop(seq, None)
+                self.stats['queue_depth'] -= 1
+            if not queue and self.queues.get(chat_id) is queue:
+                del self.queues[chat_id]
+        return 0
+
+    def flush(self):
+        '''Sends all queued messages, sleeping as the limits require.'''
+        while self.pending():
+            delay = self.send_ready()
+            if delay > 0:
+                self.sleep(delay)
+
+    def send(self, server_url, action, msg):
+        '''Sends one message right away, sleeping as the limits require.
+
+        For callers that keep per-chat order themselves, like the webhook.
+        '''
+        for delay in self.sending(server_url, action, msg):
+            self.sleep(delay)
+
+    def sending(self, server_url, action, msg):
+        '''Sends one message, yielding the seconds to wait for the limits in between.
+
+        The caller waits, so the async engine does not hold a thread or a
+        send slot while a chat is rate limited. After max_retries 429
+        answers in a row the message is given up on.
+        '''
+        chat_id = msg.get('chat_id')
+        item = (server_url, action, msg, self.clock(), 0)
+        retries = 0
+        while True:
+            with self.lock:
+                delay = self.reserve(chat_id, self.clock())
+            if delay > 0:
+                yield delay
+            elif self.deliver(chat_id, item):
+                return
+            elif retries < self.max_retries:
+                retries += 1
+            else:
+                metrics.SEND_ERRORS.inc()
+                logging.error('gave up sending %s after %d rate limited attempts', str(msg), retries + 1)
+                return
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Runs a command as a daemon and restarts it when it crashes.
+
+start() runs this script in a new interpreter and session as the
+supervisor, so nothing of the calling process, like its threads, is
+carried over, and returns once the command says it is ready: the
+supervisor gets the write end of a pipe with --ready-fd and passes it
+on to the command in READY_ENV, which calls notify_ready() when it has
+loaded its state. The supervisor restarts a command that exits with an error,
+waiting twice as long after every crash in a row, and stops when the
+command exits cleanly. SIGTERM, SIGINT and SIGHUP are passed on to the
+command, which finishes its sends, saves its state and exits. If the
+command does not get ready in time, start() stops the supervisor and the
+command with it, so a half started bot does not run next to the old one.
+'''
+
+import argparse
+import logging
+import os
+import select
+import signal
+import subprocess
+import sys
+import time
+
+
+READY_ENV = 'YANBINBOT_READY_FD'
+READY_TIMEOUT = 60
+MIN_BACKOFF = 1
+MAX_BACKOFF = 60
+# a command running this long has not crashed in a row, backoff starts over
+STABLE_TIME = 60
+UMASK = 0o022
+STOP_SIGNALS = [signal.SIGTERM, signal.SIGINT, signal.SIGHUP]
+
+
+def notify_ready():
+    '''Tells the process that started this one that it is ready, once.'''
+    fd = os.environ.pop(READY_ENV, None)
+    if fd is None:
+        return
+    try:
+        os.write(int(fd), b'ready\n')
+        os.close(int(fd))
+    except (OSError, ValueError) as ex:
+        logging.error('failed to notify readiness: %s', str(ex))
+
+
+def wait_ready(fd, timeout=READY_TIMEOUT):
+    '''Reads fd until the ready line, returns False on EOF or timeout.'''
+    deadline = time.monotonic() + timeout
+    data = b''
+    try:
+        while b'\n' not in data:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                return False
+            chunk = os.read(fd, 64)
+            if not chunk:
+                return False
+            data += chunk
+        return data.split(b'\n', 1)[0] == b'ready'
+    finally:
+        os.close(fd)
+
+
+def backoff_delay(backoff, min_backoff=MIN_BACKOFF, max_backoff=MAX_BACKOFF):
+    '''Delay before the next start after a crash, given the last one (0 for none).'''
+    return min(max_backoff, backoff * 2 or min_backoff)
+
+
+class ProcessSupervisor(object):
+    def __init__(self, cmd, pid_path=None, ready_fd=None, min_backoff=MIN_BACKOFF, max_backoff=MAX_BACKOFF,
+                 stable_time=STABLE_TIME):
+        self.cmd = cmd
+        self.pid_path = pid_path
+        # passed to the first start only, later ones have no one to tell
+        self.ready_fd = ready_fd
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.stable_time = stable_time
+        self.process = None
+        self.stopping = False
+        self.starts = 0
+
+    def stop(self, signum=signal.SIGTERM, frame=None):
+        self.stopping = True
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+
+    def spawn(self):
+        env = dict(os.environ)
+        pass_fds = []
+        if self.ready_fd is not None:
+            env[READY_ENV] = str(self.ready_fd)
+            pass_fds.append(self.ready_fd)
+        self.process = subprocess.Popen(self.cmd, env=env, pass_fds=pass_fds)
+        if self.ready_fd is not None:
+            os.close(self.ready_fd)
+            self.ready_fd = None
+        self.starts += 1
+        if self.pid_path:
+            with open(self.pid_path, 'w') as f_out:
+                f_out.write('%d\n' % self.process.pid)
+
+    def sleep(self, seconds):
+        deadline = time.monotonic() + seconds
+        while not self.stopping and time.monotonic() < deadline:
+            time.sleep(min(0.1, deadline - time.monotonic()))
+
+    def run(self):
+        '''Runs the command until it exits cleanly or a stop signal, returns its exit code.'''
+        for signum in STOP_SIGNALS:
+            signal.signal(signum, self.stop)
+        backoff = 0
+        while True:
+            started = time.monotonic()
+            self.spawn()
+            code = self.process.wait()
+            if self.stopping or code == 0:
+                return code
+            if time.monotonic() - started >= self.stable_time:
+                backoff = 0
+            backoff = backoff_delay(backoff, self.min_backoff, self.max_backoff)
+            logging.error('%s exited with %d, restarting in %g s', ' '.join(self.cmd), code, backoff)
+            self.sleep(backoff)
+            if self.stopping:
+                return code
+
+
+def start(cmd, pid_path=None, log_path=os.devnull, timeout=READY_TIMEOUT):
+    '''Starts cmd under a detached supervisor, returns True once it is ready.
+
+    Otherwise the supervisor and cmd are stopped and False is returned.
+    '''
+    read_fd, write_fd = os.pipe()
+    argv = [sys.executable, os.path.abspath(__file__), '--ready-fd', str(write_fd), '-l', log_path]
+    if pid_path:
+        argv += ['-p', pid_path]
+    try:
+        with open(log_path, 'ab') as log:
+            # the session leader has no terminal, and only opening one would give it one
+            process = subprocess.Popen(argv + ['--'] + list(cmd), pass_fds=[write_fd], stdin=subprocess.DEVNULL,
+                                       stdout=log, stderr=log, start_new_session=True)
+    finally:
+        os.close(write_fd)
+    if wait_ready(read_fd, timeout):
+        return True
+    # the supervisor is the leader of the process group of cmd
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+    process.wait()
+    return False
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument('-p', '--pid-file', help='file path to save daemon pid')
+    p.add_argument('-l', '--log', default=os.devnull, help='file for the output of the command')
+    p.add_argument('-t', '--timeout', type=float, default=READY_TIMEOUT,
+                   help='seconds to wait for the command to get ready')
+    # given by start() to the supervisor it runs
+    p.add_argument('--ready-fd', type=int, help=argparse.SUPPRESS)
+    p.add_argument('arg', nargs='+', help='command to run')
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.ready_fd is not None:
+        os.umask(UMASK)
+        sys.exit(ProcessSupervisor(args.arg, args.pid_file, args.ready_fd).run() or 0)
+    if not start(args.arg, args.pid_file, args.log, args.timeout):
+        sys.stderr.write('[ERROR] %s did not get ready in %g s\n' % (args.arg[0], args.timeout))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,107 @@
 # -*- coding: utf-8 -*-
 
 import requests
+import requests.adapters
 import logging
+import os
+
+from urllib3.util.retry import Retry
+
+import hotlog
+
+
+POOL_SIZE = 10
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+RETRIES = 3
+RETRY_BACKOFF = 0.5
+# bot API methods that only read, repeating them changes nothing
+READ_METHODS = frozenset(['getUpdates', 'getMe', 'getWebhookInfo'])
+
+# 'send' and 'read' -> keep-alive session, with its (connect, read) timeouts in .timeouts
+_sessions = {}
+# arguments of the last configure(), for processes that have to configure the same
+_settings = {}
+
+
+def make_session(pool_size, retry, connect_timeout, read_timeout):
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                                            max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.timeouts = (connect_timeout, read_timeout)
+    return session
+
+
+def configure(pool_size=POOL_SIZE, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+              retries=RETRIES, retry_backoff=RETRY_BACKOFF):
+    '''Sets up the keep-alive sessions used by do_request.
+
+    Connection errors are retried with exponential backoff for every
+    request: the request did not reach the bot API. 502/503/504 answers are
+    retried only for READ_METHODS, a proxy may answer them after Telegram
+    got a sendMessage, and repeating it would send the reply twice.
+    '''
+    global _sessions
+    _settings.update(pool_size=pool_size, connect_timeout=connect_timeout, read_timeout=read_timeout,
+                     retries=retries, retry_backoff=retry_backoff)
+    send_retry = Retry(total=retries, connect=retries, read=0, status=0, other=0, allowed_methods=None,
+                       backoff_factor=retry_backoff, raise_on_status=False)
+    read_retry = Retry(total=retries, connect=retries, read=0, status=retries,
+                       status_forcelist=(502, 503, 504), allowed_methods=None,
+                       backoff_factor=retry_backoff, raise_on_status=False)
+    sessions = {
+        'send': make_session(pool_size, send_retry, connect_timeout, read_timeout),
+        # getUpdates holds its connection while long polling, one is enough
+        'read': make_session(1, read_retry, connect_timeout, read_timeout),
+    }
+    previous, _sessions = _sessions, sessions
+    for session in previous.values():
+        session.close()
+    return sessions
+
+
+def get_settings():
+    '''Arguments of the last configure(), to pass to configure() in another process.'''
+    return dict(_settings)
+
+
+def get_session(name='send'):
+    return (_sessions or configure())[name]
 
 
 def do_request(server_url, name, data=None):
+    data = data or {}
     files = None
     if 'photo' in data:
         files = {'photo': ('route.png', data['photo'], 'image/png')}
         del data['photo']
-    r = requests.post('/'.join([server_url, name]), data=data, files=files)
+    session = get_session('read' if name in READ_METHODS else 'send')
+    connect_timeout, read_timeout = session.timeouts
+    # long polling getUpdates holds the connection for up to `timeout` seconds
+    timeout = (connect_timeout, read_timeout + data.get('timeout', 0))
+    r = session.post('/'.join([server_url, name]), data=data, files=files, timeout=timeout)
     if r:
-        logging.warning(r.text)
-    return r.json() if r else None
+        hotlog.hot.debug('response', method=name, status=r.status_code, size=len(r.content))
+        return r.json()
+    try:
+        # error description, e.g. parameters.retry_after of a 429
+        return r.json()
+    except ValueError:
+        return None
+
+
+def atomic_write(path, data):
+    '''Replaces the file at path with data (bytes), durably and never half-written.'''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f_out:
+        f_out.write(data)
+        f_out.flush()
+        os.fsync(f_out.fileno())
+    os.replace(tmp_path, path)
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+'''Webhook mode: Telegram POSTs every update to a local HTTP endpoint.
+
+There is no polling delay and no idle traffic. Updates are queued per
+chat and answered with 200 right away, replies are sent through the bot
+API: Telegram redelivers an update it does not get an answer for in
+time, and answering while sending would make long replies time out.
+Every chat is answered by one thread at a time, so its replies keep
+their order, while other chats are answered in parallel. Reminders and
+change notifications are sent by a thread of their own every
+NOTIFY_INTERVAL seconds, also while no updates come in. A reverse proxy
+is expected to terminate TLS in front of it.
+'''
+
+import collections
+import concurrent.futures
+import http.server
+import json
+import logging
+import threading
+
+import metrics
+import utils
+
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+NOTIFY_INTERVAL = 5
+
+
+class ChatQueues(object):
+    '''Calls process(item) for the items of every chat in order, chats in parallel.'''
+
+    def __init__(self, process, workers=None):
+        self.process = process
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        # chat -> items not taken yet, present while the chat has a thread
+        self.queues = {}
+        self.idle = threading.Condition()
+
+    def put(self, chat, item):
+        with self.idle:
+            queue = self.queues.get(chat)
+            if queue is not None:
+                queue.append(item)
+                return
+            self.queues[chat] = collections.deque([item])
+        self.executor.submit(self.drain, chat)
+
+    def drain(self, chat):
+        while True:
+            with self.idle:
+                queue = self.queues[chat]
+                if not queue:
+                    del self.queues[chat]
+                    self.idle.notify_all()
+                    return
+                item = queue.popleft()
+            try:
+                self.process(item)
+            except Exception as ex:
+                logging.error('failed to process %s: %s', str(item), str(ex))
+
+    def join(self, timeout=None):
+        '''Waits until every queued item is processed, returns False on timeout.'''
+        with self.idle:
+            return self.idle.wait_for(lambda: not self.queues, timeout)
+
+    def shutdown(self):
+        self.join()
+        self.executor.shutdown()
+
+
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        if server.secret and self.headers.get(SECRET_HEADER) != server.secret:
+            self.respond(403, {})
+            return
+        try:
+            update = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+        except ValueError:
+            self.respond(400, {})
+            return
+        with server.lock:
+            # a redelivery of an update queued already, Telegram retries slow answers
+            seen = server.bot.seen_updates.seen(update)
+            if not seen:
+                server.bot.seen_updates.add(update)
+        if seen:
+            metrics.UPDATES_SKIPPED.inc()
+        else:
+            server.chats.put(update.get('message', {}).get('chat', {}).get('id'), update)
+        self.respond(200, {})
+
+    def respond(self, code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebhookServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, bot, server_url, host='127.0.0.1', port=0, secret=None, workers=None):
+        super().__init__((host, port), WebhookHandler)
+        self.bot = bot
+        self.server_url = server_url
+        self.secret = secret
+        self.stopping = False
+        self.lock = threading.Lock()
+        self.chats = ChatQueues(self.answer, workers)
+
+    def answer(self, update):
+        try:
+            for action, msg in self.bot.process_update(update):
+                self.bot.sender.send(self.server_url, action, msg)
+            metrics.UPDATES.inc()
+        except Exception as ex:
+            metrics.UPDATE_ERRORS.inc()
+            logging.error('failed to process update: %s\n%s', str(update), str(ex))
+
+    def service_actions(self):
+        # also asked to restart by others, like a handover, between updates
+        if self.bot.need_restart and not self.stopping:
+            self.stopping = True
+            threading.Thread(target=self.shutdown).start()
+
+    def server_close(self):
+        super().server_close()
+        # answers what was queued, the state is saved after that
+        self.chats.shutdown()
+
+
+def send_notifications(bot, server_url, stopped, interval=NOTIFY_INTERVAL):
+    '''Sends reminders and change notifications every interval seconds until stopped is set.'''
+    while not stopped.wait(interval):
+        try:
+            bot.send_notifications(server_url)
+        except Exception as ex:
+            logging.error('failed to send notifications: %s', str(ex))
+
+
+def run_webhook(bot, server_url, host, port, url=None, secret=None, notify_interval=NOTIFY_INTERVAL):
+    '''Serves updates until interrupted or asked to restart.
+
+    With url the webhook is (re)registered with Telegram first.
+    '''
+    server = WebhookServer(bot, server_url, host, port, secret)
+    stopped = threading.Event()
+    notifier = threading.Thread(target=send_notifications, args=(bot, server_url, stopped, notify_interval),
+                                daemon=True)
+    notifier.start()
+    if url:
+        data = {'url': url}
+        if secret:
+            data['secret_token'] = secret
+        response = utils.do_request(server_url, 'setWebhook', data)
+        if not response or not response.get('ok'):
+            logging.error('failed to set webhook: %s', str(response))
+    logging.warning('listening for updates on %s:%d', host, server.server_port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.error('keyboard interrupt, stopped processing messages')
+    finally:
+        stopped.set()
+        notifier.join()
+        server.server_close()
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+'''Supervisor mode: one receiver process and a pool of worker processes.
+
+The receiver polls getUpdates and fans updates out to N workers by chat
+id, so every chat is always answered by the same worker and in order.
+Workers do not fetch the spreadsheet: the receiver keeps the schedule
+fresh and writes it to the snapshot file, which workers read (and reread
+only when it changes). TheBot.offset of the receiver moves past an update
+only after a worker acknowledged it, and the update is remembered as
+answered by the receiver, which saves the state. getUpdates is asked from
+that committed offset, so Telegram keeps the updates workers are still
+answering; they come back in every response and are skipped, and at
+most max_pending are given to workers at a time.
+
+Workers are spawned, not forked: the receiver has the schedule refresh
+thread and keep-alive sessions running. A worker that dies is started
+again and gets the updates it did not acknowledge; an update that kills
+a worker twice is given up on.
+'''
+
+import logging
+import multiprocessing
+import queue
+import time
+
+import dedup
+import hotlog
+import metrics
+import offsets
+import sender
+import utils
+import schedule.snapshot
+from yanbinbot import LogFormat, TheBot, poll_delay
+
+
+SNAPSHOT_CHECK_INTERVAL = 5
+# how often workers are checked while acks are waited for
+WORKER_CHECK_INTERVAL = 0.5
+MAX_PENDING = 100
+
+
+def worker_main(tasks, acks, server_url, snapshot_path, global_rate, subscriptions, reminders,
+                utils_settings=None, log_settings=(logging.WARNING, 1.0)):
+    # a spawned process starts with nothing configured
+    log_level, log_sample = log_settings
+    logging.basicConfig(format=LogFormat, level=log_level)
+    hotlog.hot.configure(sample=log_sample)
+    utils.configure(**(utils_settings or {}))
+    bot = TheBot(schedule_ttl=SNAPSHOT_CHECK_INTERVAL)
+    bot.schedule_cache.fetch = schedule.snapshot.SnapshotReader(snapshot_path)
+    # the receiver notifies subscribers and reminds, workers only keep subscriptions of their chats
+    bot.schedule_cache.listeners.remove(bot.notify_subscribers)
+    bot.subscriptions = subscriptions
+    bot.reminders = reminders
+    # chats are split between workers, the global limit is split too
+    bot.sender = sender.SendScheduler(global_rate=global_rate)
+    while True:
+        updates = tasks.get()
+        if updates is None:
+            break
+        for update in updates:
+            try:
+                for action, msg in bot.process_update(update):
+                    bot.sender.submit(server_url, action, msg)
+                bot.sender.flush()
+            except Exception as ex:
+                logging.error('failed to process update: %s\n%s', str(update), str(ex))
+        # the receiver keeps subscriptions to notify and to save
+        chats = set(str(update.get('message', {}).get('chat', {}).get('id')) for update in updates)
+        reminders = bot.reminders
+        acks.put(([u['update_id'] for u in updates], bot.need_restart,
+                  dict((chat, (bot.subscriptions.get(chat), reminders.get(chat, []))) for chat in chats)))
+        bot.need_restart = False
+
+
+class Supervisor(object):
+    def __init__(self, bot, server_url, workers, wait_time=5, poll_timeout=0, max_backoff=60,
+                 max_pending=MAX_PENDING):
+        if not bot.snapshot_path:
+            raise ValueError('workers read the schedule from a snapshot, snapshot_path is required')
+        self.bot = bot
+        self.server_url = server_url
+        self.wait_time = wait_time
+        self.poll_timeout = poll_timeout
+        self.max_backoff = max_backoff
+        self.max_pending = max_pending
+        self.offsets = offsets.OffsetTracker(bot.offset)
+        # update_id -> (update_id, chat id, message id) of updates given to workers
+        self.dispatched = {}
+        # per worker, update_id -> update it has not acknowledged yet
+        self.in_flight = [{} for _ in range(workers)]
+        # update_ids given again to a worker started after one died with them
+        self.redispatched = set()
+        self.stopped = False
+        self.stopping = False
+        self.context = multiprocessing.get_context('spawn')
+        self.acks = self.context.Queue()
+        self.tasks = [self.context.Queue() for _ in range(workers)]
+        self.processes = [self.make_worker(i) for i in range(workers)]
+
+    def make_worker(self, i):
+        return self.context.Process(
+            target=worker_main, daemon=True,
+            args=(self.tasks[i], self.acks, self.server_url, self.bot.snapshot_path,
+                  sender.GLOBAL_RATE / float(len(self.tasks)), self.bot.subscriptions, self.bot.reminders,
+                  utils.get_settings(), (logging.getLogger().level, hotlog.hot.sample)))
+
+    def stop(self):
+        self.stopped = True
+
+    def worker_for(self, update):
+        chat_id = update.get('message', {}).get('chat', {}).get('id') or 0
+        return hash(chat_id) % len(self.tasks)
+
+    def get_updates(self):
+        while len(self.offsets.pending) >= self.max_pending:
+            self.collect_acks(WORKER_CHECK_INTERVAL, first=True)
+        # pending updates come first, so at most max_pending are given to workers at a time
+        request = {'offset': self.offsets.committed, 'limit': self.max_pending}
+        if self.poll_timeout:
+            request['timeout'] = self.poll_timeout
+        with metrics.GET_UPDATES.time():
+            response = utils.do_request(self.server_url, 'getUpdates', request)
+        if response and isinstance(response, dict) and response.get('ok'):
+            updates = response['result']
+            if updates and isinstance(updates, list):
+                hotlog.hot.debug('updates', count=len(updates), updates=updates)
+                batches = {}
+                dispatched = False
+                for update in updates:
+                    if not self.offsets.add(update['update_id']):
+                        continue
+                    if self.bot.seen_updates.seen(update):
+                        metrics.UPDATES_SKIPPED.inc()
+                        self.bot.offset = max(self.bot.offset, self.offsets.ack(update['update_id']))
+                        continue
+                    self.dispatched[update['update_id']] = dedup.update_keys(update)
+                    worker = self.worker_for(update)
+                    self.in_flight[worker][update['update_id']] = update
+                    batches.setdefault(worker, []).append(update)
+                    dispatched = True
+                for worker, batch in batches.items():
+                    self.tasks[worker].put(batch)
+                # only updates still being answered: polling again would return them right away
+                if not dispatched and self.offsets.pending:
+                    self.collect_acks(max(self.wait_time, WORKER_CHECK_INTERVAL), first=True)
+            return True
+        logging.error('failed to get updates: %s', str(response))
+        return False
+
+    def collect_acks(self, timeout=0, first=False):
+        '''Commits acknowledged updates for up to timeout seconds, or until none is pending.
+
+        With first it returns after the first ack.
+        '''
+        deadline = time.monotonic() + timeout
+        while self.offsets.pending:
+            self.check_workers()
+            remaining = deadline - time.monotonic()
+            try:
+                ack = (self.acks.get(timeout=min(remaining, WORKER_CHECK_INTERVAL)) if remaining > 0
+                       else self.acks.get_nowait())
+            except queue.Empty:
+                if remaining <= 0:
+                    return
+                continue
+            self.commit(*ack)
+            if first:
+                return
+
+    def drain_acks(self):
+        while True:
+            try:
+                self.commit(*self.acks.get_nowait())
+            except queue.Empty:
+                return
+
+    def commit(self, update_ids, need_restart, subscriptions):
+        for update_id in update_ids:
+            keys = self.dispatched.pop(update_id, None)
+            if keys is None:
+                # answered by a worker that died before the ack was read
+                continue
+            for in_flight in self.in_flight:
+                in_flight.pop(update_id, None)
+            self.redispatched.discard(update_id)
+            metrics.UPDATES.inc()
+            self.bot.seen_updates.add_keys(keys)
+            self.bot.offset = max(self.bot.offset, self.offsets.ack(update_id))
+        self.bot.need_restart = self.bot.need_restart or need_restart
+        current = self.bot.reminders
+        for chat, (filters, reminders) in subscriptions.items():
+            if filters:
+                self.bot.subscriptions[chat] = filters
+            else:
+                self.bot.subscriptions.pop(chat, None)
+            if reminders != current.get(chat, []):
+                self.bot.reminder_queue.remove(chat)
+                for minutes, text in reminders:
+                    self.bot.reminder_queue.add(chat, minutes, text)
+
+    def check_workers(self):
+        '''Starts again the workers that died and gives them their updates back.'''
+        if self.stopping:
+            return
+        for i, process in enumerate(self.processes):
+            # not started yet or running
+            if process.exitcode is None:
+                continue
+            # acks it sent before it died
+            self.drain_acks()
+            logging.error('worker %d exited with %s, starting it again', i, process.exitcode)
+            self.tasks[i] = self.context.Queue()
+            self.processes[i] = self.make_worker(i)
+            self.processes[i].start()
+            batch = []
+            for update_id, update in sorted(self.in_flight[i].items()):
+                if update_id not in self.redispatched:
+                    self.redispatched.add(update_id)
+                    batch.append(update)
+                    continue
+                logging.error('giving up on update that stopped a worker twice: %s', str(update))
+                metrics.UPDATE_ERRORS.inc()
+                del self.in_flight[i][update_id]
+                self.redispatched.discard(update_id)
+                self.dispatched.pop(update_id)
+                self.bot.offset = max(self.bot.offset, self.offsets.ack(update_id))
+            if batch:
+                self.tasks[i].put(batch)
+
+    def run(self):
+        # make sure there is a snapshot for the workers to start from
+        self.bot.get_schedule()
+        for process in self.processes:
+            process.start()
+        backoff = 0
+        try:
+            while not self.stopped and not self.bot.need_restart:
+                try:
+                    ok = self.get_updates()
+                    self.bot.send_notifications(self.server_url)
+                except Exception as ex:
+                    ok = False
+                # keeps the snapshot fresh: refreshes run in the background
+                self.bot.get_schedule()
+                delay, backoff = poll_delay(ok, backoff, self.wait_time, self.poll_timeout, self.max_backoff)
+                deadline = time.monotonic() + delay
+                self.collect_acks(delay)
+                # collecting stops once nothing is pending, the poll still waits for the delay
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    time.sleep(remaining)
+                self.bot.checkpoint()
+        except KeyboardInterrupt:
+            logging.error('keyboard interrupt, stopped processing messages')
+        finally:
+            self.stopping = True
+            for tasks in self.tasks:
+                tasks.put(None)
+            while self.offsets.pending and any(p.is_alive() for p in self.processes):
+                self.collect_acks(1)
+            for process in self.processes:
+                process.join()
+            self.collect_acks()
@@ -11,11 +11,31 @@ import argparse
 import os
 import sys
 import datetime
-import subprocess
 import random
+import signal
+import threading
 
 import utils
+import dedup
+import hotlog
+import matcher
+import metrics
+import offset_log
+import handover
+import reloader
+import supervise
+import outgoing
+import reminders
+import render
+import sender
+import schedule.cache
+import schedule.compact
+import schedule.diff
 import schedule.fetcher
+import schedule.index
+import schedule.schedule
+import schedule.snapshot
+import schedule.times as times
 import schedule.weekday as weekday
 
 
@@ -28,7 +48,14 @@ ProgPath = os.path.abspath(sys.argv[0])
 ProgDir = os.path.dirname(ProgPath)
 ProjDir = os.path.dirname(ProgDir)
 DataDir = os.path.join(ProjDir, 'data')
-DaemonizePath = os.path.join(ProgDir, 'daemonize.py')
+LogFormat = '[%(levelname)s] %(asctime)s: %(message)s'
+
+
+def sheet_source(value):
+    name, sep, link = value.partition('=')
+    if not sep or not name or not link or '/' in name:
+        raise argparse.ArgumentTypeError('expected NAME=URL, got %r' % value)
+    return name, link
 
 
 def parse_args():
@@ -36,6 +63,59 @@ def parse_args():
     p.add_argument('-s', '--state', help='path to bot state file')
     p.add_argument('-p', '--pid', help='path to pid file')
     p.add_argument('-l', '--log', help='path to log')
+    p.add_argument('-w', '--wait', type=float, default=5,
+                   help='seconds to sleep between getUpdates calls when not long polling')
+    p.add_argument('-t', '--poll-timeout', type=int, default=0,
+                   help='long polling timeout in seconds for getUpdates, 0 disables long polling')
+    p.add_argument('--max-backoff', type=float, default=60,
+                   help='upper bound in seconds for the delay after failed getUpdates calls')
+    p.add_argument('--pool-size', type=int, default=utils.POOL_SIZE,
+                   help='number of keep-alive connections to the bot API')
+    p.add_argument('--connect-timeout', type=float, default=utils.CONNECT_TIMEOUT,
+                   help='bot API connect timeout in seconds')
+    p.add_argument('--read-timeout', type=float, default=utils.READ_TIMEOUT,
+                   help='bot API read timeout in seconds, added to the long polling timeout')
+    p.add_argument('--retries', type=int, default=utils.RETRIES,
+                   help='retries with exponential backoff for failed bot API connections')
+    p.add_argument('--fsync-interval', type=float, default=offset_log.FSYNC_INTERVAL,
+                   help='seconds between writes of the offset log, a crash answers this much again')
+    p.add_argument('--compact-every', type=int, default=offset_log.COMPACT_EVERY,
+                   help='offset log records before the state is saved and the log started over')
+    p.add_argument('--restart', choices=['daemonize', 'reload', 'handover'], default='daemonize',
+                   help='on restart start a new daemon (the default), reload the code in place '
+                        'or hand over to a new process')
+    p.add_argument('--ready-timeout', type=float, default=supervise.READY_TIMEOUT,
+                   help='seconds a restarted daemon has to load its state before the old one keeps working')
+    p.add_argument('--handover-fd', type=int, help=argparse.SUPPRESS)
+    p.add_argument('-e', '--engine', choices=['sync', 'async'], default='sync',
+                   help='process updates one by one or concurrently with asyncio')
+    p.add_argument('--workers', type=int, default=0,
+                   help='answer updates in this many worker processes, sharing the schedule snapshot')
+    p.add_argument('--max-sends', type=int, default=8,
+                   help='limit of concurrent outgoing requests for the async engine')
+    p.add_argument('--schedule-ttl', type=float, default=3600,
+                   help='seconds before the schedule is refreshed in the background')
+    p.add_argument('--schedule-jitter', type=float, default=300,
+                   help='random extra seconds added to every schedule TTL')
+    p.add_argument('--compact-schedule', action='store_true',
+                   help='keep the schedule as interned string columns to save memory')
+    p.add_argument('--sheet', type=sheet_source, action='append', metavar='NAME=URL',
+                   help='published spreadsheet of a studio, repeat for several; lessons of all are shown')
+    p.add_argument('--parse-workers', type=int, default=0,
+                   help='parse the tables of a spreadsheet concurrently in this many workers')
+    p.add_argument('--parse-processes', action='store_true',
+                   help='use processes instead of threads for --parse-workers')
+    p.add_argument('--snapshot', help='path to schedule snapshot, next to the state file by default')
+    p.add_argument('--webhook-listen', metavar='HOST:PORT',
+                   help='receive updates on a local HTTP endpoint instead of polling')
+    p.add_argument('--webhook-url', help='public URL of the endpoint to register with setWebhook')
+    p.add_argument('--webhook-secret', help='secret token Telegram must send with every update')
+    p.add_argument('--metrics-listen', metavar='HOST:PORT',
+                   help='serve metrics in the Prometheus text format at http://HOST:PORT/metrics')
+    p.add_argument('--log-level', choices=['debug', 'info', 'warning', 'error'], default='warning',
+                   help='info logs commands and filters, debug also every update and bot API response')
+    p.add_argument('--log-sample', type=float, default=1.0,
+                   help='share of info and debug records of every update to write, from 0 to 1')
     return p.parse_args()
 
 
@@ -45,12 +125,19 @@ def init(args):
         args.pid = os.path.join(DataDir, 'shiyanbin.pid')
     if not args.state:
         args.state = os.path.join(DataDir, 'shiyanbin.json')
+    if not args.snapshot:
+        args.snapshot = os.path.splitext(args.state)[0] + '.schedule.json'
     if not args.log:
         args.log = os.path.join(ProjDir, 'log', 'shiyanbin.log')
     log_dir = os.path.dirname(args.log)
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
-    logging.basicConfig(format='[%(levelname)s] %(asctime)s: %(message)s', level=logging.WARNING)
+    logging.basicConfig(format=LogFormat, level=args.log_level.upper())
+    hotlog.hot.configure(sample=args.log_sample)
+    utils.configure(pool_size=args.pool_size, connect_timeout=args.connect_timeout,
+                    read_timeout=args.read_timeout, retries=args.retries)
+    schedule.fetcher.configure(sources=args.sheet, parse_workers=args.parse_workers,
+                               parse_processes=args.parse_processes)
 
 
 def get_next_token(text):
@@ -69,6 +156,14 @@ def map_to_aliases(aliases_map):
     return all_aliases
 
 
+def poll_delay(ok, backoff, wait_time, poll_timeout, max_backoff):
+    '''Returns the delay before the next getUpdates and the new backoff.'''
+    if ok:
+        return (0 if poll_timeout else wait_time), 0
+    backoff = min(max_backoff, backoff * 2 or max(wait_time, 1))
+    return backoff, backoff
+
+
 class TheBot(object):
     CmdMap = {
         'restart': ['обновись', 'восстань', 'проснись', 'вставай'],
@@ -76,6 +171,7 @@ class TheBot(object):
         'beforeyesterday': ['позавчера'],
         'yesterday': ['вчера'],
         'today': ['сегодня'],
+        'now': ['сейчас'],
         'tomorrow': ['завтра'],
         'aftertomorrow': ['послезавтра'],
         'monday': ['mon', 'пн', "понедельник"],
@@ -87,6 +183,9 @@ class TheBot(object):
         'sunday': ['sun', 'вс', "воскресенье"],
         'teachers': ['инструкторы', "мастера", "инструктора", "мастеры", "учителя", 'учители'],
         'all_lessons': ['все', 'занятия', 'неделя'],
+        'subscribe': ['подписаться', 'подписка', 'подписки'],
+        'unsubscribe': ['отписаться'],
+        'remind': ['напомни', 'напоминай', 'напоминания'],
     }
     TeacherMap = {
         'алексей': ['леша'],
@@ -109,24 +208,98 @@ class TheBot(object):
         'янбин': ['шифу', "ши фу", 'ян бин'],
         'янфан': ['ян фан'],
     }
-    AttrsToSave = ['offset']
-
-    def __init__(self):
+    DisciplineLabels = [('qigong', 'Цигун'), ('kungfu', 'Кунг-фу'), ('children', 'Дети')]
+    DisciplinePatterns = [
+        ('kungfu', 'кунгфу|кунг-фу|кунг фу'),
+        ('qigong', 'цигун|ци-гун|ци гун|тайцзи|тайчи|тайцзицюань'),
+        ('children', 'дети|детские'),
+    ]
+    # '30 кунгфу', 'за 15 минут цигун', 'стоп валерий'
+    RemindRe = re.compile(r'^(?:(стоп|stop|off)|(?:за\s+)?(\d+)(?:\s*(?:минут[уы]?|мин|min)\b\.?)?)?\s*(.*)$')
+    # 'после 18', 'с 18.30', 'до 20:00'
+    TimeFilterRe = re.compile(r'(?:^|\s)(после|с|до)\s+(\d{1,2}(?:[.:]\d\d)?)(?=\s|$)')
+    AttrsToSave = ['offset', 'subscriptions', 'reminders', 'reminders_checked', 'answered']
+
+    def __init__(self, schedule_ttl=3600, schedule_jitter=0, snapshot_path=None, compact_schedule=False):
+        self.offset_log = None
         self.offset = 0
         self.need_restart = False
+        self.seen_updates = dedup.SeenUpdates()
+        # str(chat id) -> filters, as for show_lessons, of changes to notify about
+        self.subscriptions = {}
+        self.outbox = []
+        self.outbox_lock = threading.Lock()
+        self.reminder_queue = reminders.ReminderQueue(self.make_filter)
+        self.build_matcher()
+        # late binding keeps schedule.fetcher.fetch patchable
+        def fetch():
+            with metrics.SCHEDULE_FETCH.time():
+                return schedule.fetcher.fetch()
+        self.compactor = None
+        if compact_schedule:
+            fetch = self.compactor = schedule.compact.Compactor(fetch)
+        self.schedule_cache = schedule.cache.ScheduleCache(fetch, schedule_ttl, schedule_jitter)
+        self.index = None
+        self.render_cache = render.RenderCache()
+        self.sender = sender.SendScheduler()
+        self.snapshot_path = snapshot_path
+        # registered first, so reminders are computed for the snapshot too
+        self.schedule_cache.add_listener(self.notify_subscribers)
+        if snapshot_path:
+            self.load_snapshot()
+            self.schedule_cache.add_listener(self.save_snapshot)
+
+
+    def build_matcher(self):
         self.cmd_aliases = map_to_aliases(self.CmdMap)
         self.teacher_aliases = map_to_aliases(self.TeacherMap)
-        self.schedule = None
-        self.schedule_time = None
+        self.matcher = matcher.AliasMatcher([
+            ('filler', [('занятия|занятие', None), ('в|во', None)]),
+            ('teacher', list(self.teacher_aliases.items())),
+            ('command', [(c, c) for c in list(self.CmdMap.keys()) + list(self.cmd_aliases.keys())]),
+            ('discipline', [(pattern, kind) for kind, pattern in self.DisciplinePatterns]),
+        ])
+
+
+    def reloaded(self):
+        '''Called by reloader once the bot has the class of the new code.'''
+        self.build_matcher()
+        self.index = None
+        self.render_cache = render.RenderCache()
+        # bound methods given away still run the old code
+        self.reminder_queue.make_filter = self.make_filter
+        self.reminders = self.reminders
+        listeners = self.schedule_cache.listeners
+        for i, listener in enumerate(listeners):
+            if getattr(listener, '__self__', None) is self:
+                listeners[i] = getattr(self, listener.__name__)
+
+
+    def load_snapshot(self):
+        if not os.path.exists(self.snapshot_path):
+            return
+        try:
+            schdl, loaded_at = schedule.snapshot.load(self.snapshot_path)
+        except Exception as ex:
+            logging.error('failed to load schedule snapshot %s: %s', self.snapshot_path, str(ex))
+            return
+        if self.compactor:
+            schdl = self.compactor.convert(schdl)
+        self.schedule_cache.set(schdl, loaded_at)
+        # serve the snapshot right away, but check the spreadsheet on first use
+        self.schedule_cache.invalidate()
+        logging.warning('schedule snapshot loaded from %s', self.snapshot_path)
+
+
+    def save_snapshot(self, old, new):
+        try:
+            schedule.snapshot.save(self.snapshot_path, new, self.schedule_cache.loaded_at)
+        except Exception as ex:
+            logging.error('failed to save schedule snapshot %s: %s', self.snapshot_path, str(ex))
 
 
     def get_schedule(self):
-        now = datetime.datetime.now()
-        if self.schedule != None and now - self.schedule_time < datetime.timedelta(hours=1):
-            return self.schedule
-        self.schedule = schedule.fetcher.fetch()
-        self.schedule_time = now
-        return self.schedule
+        return self.schedule_cache.get()
 
 
     def process_command(self, command, text, msg):
@@ -136,13 +309,12 @@ class TheBot(object):
             command = command[0]
         if '@' in command:
             cmd, name = command.rsplit('@', 1)
-            logging.warning('command only for %s: %s', name, cmd)
             if name.lower() != BotName:
-                logging.warning('skipping command: %s', command)
+                hotlog.hot.info('skipping command', command=cmd, bot=name)
                 return []
             command = cmd
         command = command.rstrip('!,.)')
-        logging.warning('processing command: %s', command)
+        hotlog.hot.info('command', command=command)
         command = self.cmd_aliases.get(command, command)
         method = getattr(self, command+'_cmd', None)
         if not method:
@@ -175,6 +347,9 @@ class TheBot(object):
     def today_cmd(self, text, msg):
         return self.show_lessons(text, msg, weekday.today(), today=True)
 
+    def now_cmd(self, text, msg):
+        return self.show_lessons(text, msg, weekday.today(), now=True)
+
     def tomorrow_cmd(self, text, msg):
         return self.show_lessons(text, msg, weekday.today() + 1)
 
@@ -201,17 +376,18 @@ class TheBot(object):
         return ans
 
 
-    def get_all_teachers(self, lower=False):
+    def get_index(self):
         schdl = self.get_schedule()
-        all_teachers = set()
-        for week in schdl.values():
-            for day in week.values():
-                for lesson in day:
-                    if lesson:
-                        teacher = lesson.teacher.strip()
-                        if teacher:
-                            all_teachers.add(teacher.lower() if lower else teacher)
-        return all_teachers
+        index = self.index
+        if index is None or index.schedule is not schdl:
+            index = self.index = schedule.index.ScheduleIndex(schdl, self.schedule_cache.version)
+            self.render_cache.clear()
+        return index
+
+
+    def get_all_teachers(self, lower=False):
+        index = self.get_index()
+        return set(index.lower_teachers if lower else index.teachers)
 
 
     @staticmethod
@@ -222,62 +398,249 @@ class TheBot(object):
         return text, (m.group(2) if m else None)
 
 
-    def show_lessons(self, text, msg, dow=None, today=False):
-        s = self.get_schedule()
-        all_teachers = self.get_all_teachers(True)
+    def extract_time_window(self, text):
+        '''Removes time filters from the text, returns (text, starts_from, starts_before).'''
+        starts_from = starts_before = None
+        for m in reversed(list(self.TimeFilterRe.finditer(text))):
+            value = times.minutes(m.group(2))
+            if value == times.NO_MINUTES:
+                continue
+            if m.group(1) == 'до':
+                starts_before = value
+            else:
+                starts_from = value
+            text = text[:m.start()] + ' ' + text[m.end():]
+        return ' '.join(text.split()), starts_from, starts_before
+
+
+    def parse_filter(self, text):
+        '''Returns (disciplines, teacher pattern or None, starts_from, starts_before) of a filter.'''
         types = set()
-        only_teachers = set()
+        pattern = starts_from = starts_before = None
         if text:
             text = text.strip().lower()
-            logging.warning('filter: %s', text)
-            patterns = {'kungfu':'кунгфу|кунг-фу|кунг фу',
-                        'qigong': 'цигун|ци-гун|ци гун|тайцзи|тайчи|тайцзицюань',
-                        'children': 'дети|детские'}
-            for kind, pattern in patterns.items():
-                text, word = self.find_and_extract(text, pattern)
-                if word != None:
+            hotlog.hot.debug('filter', text=text)
+            text, starts_from, starts_before = self.extract_time_window(text)
+            found = self.matcher.scan(text)
+            for alias in sorted(found.get('discipline', ())):
+                text, kind, _ = self.matcher.extract(text, [alias])
+                if kind != None:
                     types.add(kind)
             text = text.replace('\\', '')
             if text.strip():
-                try: # in case re.search fails with exception due to bad text
-                    for teacher in all_teachers:
-                        if re.search(text, teacher):
-                            logging.warning('only teacher: %s', teacher)
-                            only_teachers.add(teacher)
-                finally:
-                    pass
-        ans = ''
-        for name, label in [('qigong', 'Цигун'), ('kungfu', 'Кунг-фу'), ('children', 'Дети')]:
-            if types and name not in types:
-                continue
-            lessons = []
-            for l in s[name][dow]:
-                if l:
-                    if today:
-                        starts = datetime.datetime.strptime(l.starts, '%H.%M').strftime('%H.%M') # to process time format like 8.30
-                        now = datetime.datetime.today().strftime('%H.%M')
-                        if starts < now:
+                pattern = text
+        return frozenset(types), pattern, starts_from, starts_before
+
+
+    @metrics.SHOW_LESSONS.timed
+    def show_lessons(self, text, msg, dow=None, today=False, now=False):
+        index = self.get_index()
+        only_teachers = frozenset()
+        running_at = None
+        types, pattern, starts_from, starts_before = self.parse_filter(text)
+        if pattern:
+            only_teachers = index.find_teachers(pattern)
+            hotlog.hot.debug('only teachers', teachers=only_teachers)
+        # lessons already started are skipped, so the reply changes every minute
+        if today:
+            starts_from = max(starts_from or 0, times.now())
+        if now:
+            running_at = times.now()
+        window = (starts_from, starts_before, running_at)
+        key = (index.version, types, only_teachers, dow, window)
+        ans = self.render_cache.get(key)
+        if ans is None:
+            with metrics.RENDER.time():
+                sections = []
+                # lessons of several spreadsheets are grouped by studio
+                for studio in index.studios:
+                    for name, label in self.DisciplineLabels:
+                        if types and name not in types:
                             continue
-                    if only_teachers and l.teacher.strip().lower() not in only_teachers:
-                        continue
-                    lessons.append(l)
-            if lessons:
-                ans += '*%s*\n\n' % label
-                for l in lessons:
-                    ans += '_%s%s_ *%s* _%s_: %s, %s' % (l.starts, ('-'+l.ends if l.ends else ''), l.teacher, l.name, l.complex, l.place)
-                    if l.difficulty.strip():
-                        ans += ', *%s нагрузка*' % l.difficulty.strip()
-                    if l.audience.strip():
-                        ans += ', %s' % l.audience.strip()
-                    if l.comment.strip():
-                        ans += ' - *%s*' % l.comment.strip()
-                    ans += '\n\n'
-                ans += '\n'
-        if not ans:
-            ans += 'занятия, соответствующие вашему запросу, не найдены\n'
+                        if studio:
+                            label = '%s, %s' % (label, studio)
+                        sections.append((label, index.select(name, dow, only_teachers, *window, studio=studio)))
+                ans = render.render_lessons(sections)
+            self.render_cache.put(key, ans)
         return [{'text': ans}]
 
 
+    def subscribe_cmd(self, text, msg):
+        chat = str(msg['chat']['id'])
+        filters = self.subscriptions.get(chat, [])
+        text = ' '.join(text.split()) if text else ''
+        if not text:
+            if not filters:
+                return [{'text': 'Напишите, об изменениях каких занятий сообщать, '
+                                 'например: подписаться цигун, подписаться валерий'}]
+            return [{'text': 'Сообщаю об изменениях: %s' % ', '.join(filters)}]
+        types, pattern, _, _ = self.parse_filter(text)
+        if not types and not pattern:
+            return [{'text': 'Не понимаю, на что подписаться: %s' % text}]
+        if text not in filters:
+            self.subscriptions[chat] = filters + [text]
+        return [{'text': 'Буду сообщать об изменениях: %s' % text}]
+
+    def unsubscribe_cmd(self, text, msg):
+        chat = str(msg['chat']['id'])
+        text = ' '.join(text.split()) if text else ''
+        filters = [f for f in self.subscriptions.get(chat, []) if text and f != text]
+        if filters:
+            self.subscriptions[chat] = filters
+        else:
+            self.subscriptions.pop(chat, None)
+        return [{'text': 'Больше не сообщаю об изменениях%s' % (': ' + text if text else '')}]
+
+
+    @property
+    def offset(self):
+        return self._offset
+
+    @offset.setter
+    def offset(self, value):
+        self._offset = value
+        if self.offset_log is not None:
+            self.offset_log.append(value)
+
+
+    def checkpoint(self):
+        '''Saves the state if the offset log asks for it, engines call it where no update is answered.'''
+        if self.offset_log is not None:
+            self.offset_log.compact_if_due()
+
+
+    @property
+    def reminders(self):
+        return self.reminder_queue.subscriptions()
+
+    @reminders.setter
+    def reminders(self, value):
+        self.reminder_queue.restore(value, self.reminder_queue.checked_time())
+
+    @property
+    def reminders_checked(self):
+        return self.reminder_queue.checked_time()
+
+    @reminders_checked.setter
+    def reminders_checked(self, value):
+        self.reminder_queue.restore(self.reminder_queue.subscriptions(), value)
+
+
+    @property
+    def answered(self):
+        return self.seen_updates.dump()
+
+    @answered.setter
+    def answered(self, value):
+        self.seen_updates.restore(value)
+
+
+    def remind_cmd(self, text, msg):
+        chat = str(msg['chat']['id'])
+        stop, minutes, text = self.RemindRe.match(' '.join((text or '').split())).groups()
+        if stop:
+            self.reminder_queue.remove(chat, text or None)
+            return [{'text': 'Больше не напоминаю%s' % (': ' + text if text else '')}]
+        if not minutes and not text:
+            items = self.reminder_queue.subscriptions().get(chat)
+            if not items:
+                return [{'text': 'Напишите, о каких занятиях и за сколько минут напоминать, '
+                                 'например: напомни 30 цигун'}]
+            return [{'text': 'Напоминаю: %s' % ', '.join('за %d мин %s' % (m, t) for m, t in items)}]
+        try:
+            types, pattern, _, _ = self.parse_filter(text)
+            self.make_filter(text)
+        except re.error:
+            types = pattern = None
+        if not types and not pattern:
+            return [{'text': 'Не понимаю, о чём напоминать: %s' % text}]
+        minutes = int(minutes or 30)
+        self.reminder_queue.add(chat, minutes, text)
+        # timers need the schedule
+        self.get_schedule()
+        return [{'text': 'Буду напоминать за %d мин: %s' % (minutes, text)}]
+
+
+    def make_filter(self, text):
+        '''Returns predicate(discipline, lesson) for a filter, raises re.error if it is invalid.'''
+        types, pattern, starts_from, starts_before = self.parse_filter(text)
+        teacher = re.compile(pattern) if pattern else None
+
+        def matches(discipline, lesson):
+            if types and discipline.rpartition(schedule.schedule.NAMESPACE_SEPARATOR)[2] not in types:
+                return False
+            if teacher and not teacher.search(lesson.teacher.strip().lower()):
+                return False
+            starts = times.minutes(lesson.starts)
+            if starts_from is not None and starts < starts_from:
+                return False
+            return starts_before is None or 0 <= starts < starts_before
+        return matches
+
+
+    def discipline_label(self, discipline):
+        namespace, _, kind = discipline.rpartition(schedule.schedule.NAMESPACE_SEPARATOR)
+        return dict(self.DisciplineLabels).get(kind, kind) + (' (%s)' % namespace if namespace else '')
+
+
+    def render_change(self, change):
+        label = self.discipline_label(change.discipline)
+        if change.old is None:
+            what, lesson = 'новое занятие', change.new
+        elif change.new is None:
+            what, lesson = 'занятия не будет', change.old
+        else:
+            what, lesson = 'изменилось', change.new
+        return '*%s, %s*: %s\n%s' % (change.dow.ru_name().capitalize(), label, what, render.render_lesson(lesson))
+
+
+    def notify_subscribers(self, old, new):
+        '''Schedule listener: queues change notifications for subscribed chats.'''
+        if old is None:
+            self.reminder_queue.update(new)
+            return
+        changes = schedule.diff.diff(old, new)
+        self.reminder_queue.update(new, changes)
+        if not changes or not self.subscriptions:
+            return
+        replies = []
+        for chat, filters in list(self.subscriptions.items()):
+            texts = []
+            try:
+                predicates = [self.make_filter(f) for f in filters]
+            except re.error as ex:
+                logging.error('bad subscription of %s: %s', chat, str(ex))
+                continue
+            for change in changes:
+                lessons = [l for l in (change.old, change.new) if l]
+                if any(match(change.discipline, l) for match in predicates for l in lessons):
+                    texts.append(self.render_change(change))
+            if texts:
+                msg = {'text': '*Изменения в расписании*\n\n' + ''.join(texts), 'chat_id': int(chat)}
+                replies.append((self.get_action(msg), msg))
+        with self.outbox_lock:
+            self.outbox.extend(outgoing.coalesce(replies))
+
+
+    def send_notifications(self, server_url):
+        '''Sends queued change notifications and reminders that are due.'''
+        if self.subscriptions or self.reminder_queue.filters:
+            # changes are found on refresh, so refresh even if nobody asks
+            self.get_schedule()
+        replies = []
+        for chat, minutes, discipline, dow, lesson in self.reminder_queue.due():
+            msg = {'text': '*Через %d мин, %s*\n%s' % (minutes, self.discipline_label(discipline),
+                                                        render.render_lesson(lesson)),
+                   'chat_id': int(chat)}
+            replies.append((self.get_action(msg), msg))
+        with self.outbox_lock:
+            self.outbox.extend(outgoing.coalesce(replies))
+            outbox, self.outbox = self.outbox, []
+        for action, msg in outbox:
+            self.sender.submit(server_url, action, msg)
+        self.sender.flush()
+
+
     def restart_cmd(self, text, msg):
         if not self.is_root(msg):
             return []
@@ -308,34 +671,36 @@ class TheBot(object):
         return [{'text': 'Welcome, %s!'%self.get_first_name(msg)}]
 
 
-    def replace_teacher_aliases(self, text):
-        for alias, name in self.teacher_aliases.items():
-            txt, replaced = self.find_and_extract(text, alias)
-            if replaced:
-                return txt + ' ' + name
+    def replace_teacher_aliases(self, text, found=None):
+        if found is None:
+            found = self.matcher.scan(text)
+        txt, name, _ = self.matcher.extract(text, found.get('teacher', ()))
+        if name:
+            return txt + ' ' + name
         return text
 
 
+    @metrics.PARSE.timed
+    def parse_text(self, text):
+        '''Splits lowercased message text into command and the rest of it.'''
+        # the filler words are the first two aliases of the matcher
+        for index in (0, 1):
+            text, _, _ = self.matcher.extract(text, [index])
+        found = self.matcher.scan(text)
+        text = self.replace_teacher_aliases(text, found)
+        if text[:1] == '/':
+            return get_next_token(text[1:])
+        rest, cmd, _ = self.matcher.extract(text, found.get('command', ()))
+        if not cmd:
+            return get_next_token(text)
+        return cmd, rest
+
+
     def process_text_message(self, msg):
         if msg.get('forward_from'):
             return []
-        text = msg.get('text', '').lower()
-        text, _ = self.find_and_extract(text, 'занятия|занятие')
-        text, _ = self.find_and_extract(text, 'в|во')
-        text = self.replace_teacher_aliases(text)
+        cmd, rest = self.parse_text(msg.get('text', '').lower())
         result = []
-        cmd = None
-        if text[:1] == '/':
-            text = text[1:]
-        else:
-            for c in list(self.CmdMap.keys()) + list(self.cmd_aliases.keys()):
-                text, word = self.find_and_extract(text, c)
-                if word != None:
-                    cmd = c
-                    rest = text
-                    break
-        if not cmd:
-            cmd, rest = get_next_token(text)
         result += self.process_command(cmd, rest, msg)
         if not result:
             return []
@@ -344,104 +709,203 @@ class TheBot(object):
         return result
 
 
-    def process_response(self, server_url):
-        response = utils.do_request(server_url, 'getUpdates', {'offset': self.offset})
+    @staticmethod
+    def get_action(msg):
+        action = 'sendPhoto' if 'photo' in msg else 'sendLocation' if 'latitude' in msg else 'sendMessage'
+        if action == 'sendMessage':
+            msg['disable_web_page_preview'] = True
+            msg['parse_mode'] = 'Markdown'
+        return action
+
+
+    def process_update(self, update):
+        '''Returns the replies to the update as a list of (action, message).'''
+        msg = update.get('message')
+        if msg and 'text' in msg:
+            return outgoing.coalesce([(self.get_action(m), m) for m in self.process_text_message(msg)])
+        return []
+
+
+    def process_response(self, server_url, poll_timeout=0):
+        request = {'offset': self.offset}
+        if poll_timeout:
+            request['timeout'] = poll_timeout
+        with metrics.GET_UPDATES.time():
+            response = utils.do_request(server_url, 'getUpdates', request)
         if response and isinstance(response, dict) and response.get('ok'):
             updates = response['result']
             if updates and isinstance(updates, list):
-                logging.warning('got updates: %s', str(updates))
-                for update in updates:
-                    try:
-                        msg = update.get('message')
-                        msg_out = None
-                        if msg and 'text' in msg:
-                            msg_out = self.process_text_message(msg)
-                        if msg_out is not None:
-                            for msg in msg_out:
-                                action = 'sendPhoto' if 'photo' in msg else 'sendLocation' if 'latitude' in msg else 'sendMessage' 
-                                if action == 'sendMessage':
-                                    msg['disable_web_page_preview'] = True
-                                    msg['parse_mode'] = 'Markdown'
-                                #logging.warning('sending: %s', str(msg))
-                                utils.do_request(server_url, action, msg)
-                    except Exception as ex:
-                        logging.error('failed to process update: %s\n%s', str(update), str(ex))
-                        raise
-                    self.offset = max(update['update_id']+1, self.offset)
-        else:
-            logging.error('failed to get updates: %s', str(response))
+                hotlog.hot.debug('updates', count=len(updates), updates=updates)
+                try:
+                    for update in updates:
+                        # answered before the batch failed or before a restart
+                        if self.seen_updates.seen(update):
+                            metrics.UPDATES_SKIPPED.inc()
+                            hotlog.hot.info('skipping answered update', update_id=update.get('update_id'))
+                        else:
+                            try:
+                                for action, msg in self.process_update(update):
+                                    self.sender.submit(server_url, action, msg)
+                            except Exception as ex:
+                                metrics.UPDATE_ERRORS.inc()
+                                logging.error('failed to process update: %s\n%s', str(update), str(ex))
+                                raise
+                            metrics.UPDATES.inc()
+                            self.seen_updates.add(update)
+                        self.offset = max(update['update_id']+1, self.offset)
+                finally:
+                    self.sender.flush()
+            return True
+        logging.error('failed to get updates: %s', str(response))
+        return False
 
 
-    def run(self, server_url, wait_time):
-        self.need_restart = False
+    def run(self, server_url, wait_time, poll_timeout=0, max_backoff=60):
+        '''Polls for updates until interrupted or asked to restart.
+
+        With poll_timeout the server holds getUpdates open, so the next
+        request is sent right away; otherwise the bot sleeps wait_time
+        between requests. After failures the delay doubles up to max_backoff.
+        '''
+        backoff = 0
         while True:
             try:
-                self.process_response(server_url)
+                ok = self.process_response(server_url, poll_timeout)
+                self.send_notifications(server_url)
+                self.checkpoint()
             except KeyboardInterrupt:
                 logging.error('keyboard interrupt, stopped processing messages')
                 break
             except Exception as ex:
-                pass
+                ok = False
             if self.need_restart:
                 break
-            time.sleep(wait_time)
+            delay, backoff = poll_delay(ok, backoff, wait_time, poll_timeout, max_backoff)
+            try:
+                time.sleep(delay)
+            except KeyboardInterrupt:
+                logging.error('keyboard interrupt, stopped processing messages')
+                break
 
 
     def save(self, fpath):
-        with open(fpath, 'w') as f_out:
-            data = {}
-            for attr in self.AttrsToSave:
-                data[attr] = getattr(self, attr)
-            json.dump(data, f_out)
+        data = {}
+        for attr in self.AttrsToSave:
+            data[attr] = getattr(self, attr)
+        utils.atomic_write(fpath, json.dumps(data).encode('utf-8'))
 
 
     @staticmethod
-    def load(fpath):
+    def load(fpath, **kwargs):
         with open(fpath) as f_in:
             data = json.load(f_in)
-            bot = TheBot()
+            bot = TheBot(**kwargs)
             for attr in bot.AttrsToSave:
                 if attr in data:
                     setattr(bot, attr, data[attr])
             return bot
 
 
-def is_proc_alive(pid_path):
-    if os.path.exists(pid_path):
-        with open(pid_path) as f_in:
-            pid = f_in.readline().rstrip('\n')
-            if pid:
-                if os.path.exists('/proc/%s'%pid):
-                    return True
-    return False
-
-
 def restart(args):
+    '''Starts a new daemon, returns once it has loaded the state or False if it did not.'''
     if os.path.exists(args.pid):
         os.remove(args.pid)
-    cmd = [DaemonizePath, '-p', args.pid, '--', ProgPath, '-l', args.log, '-s', args.state, '-p', args.pid]
-    subprocess.check_call(cmd)
-    time.sleep(3) # give daemon time to start
-    return is_proc_alive(args.pid)
+    cmd = [sys.executable, ProgPath] + sys.argv[1:] + ['-l', args.log, '-s', args.state, '-p', args.pid]
+    return supervise.start(cmd, args.pid, args.log, args.ready_timeout)
 
 
 
+def serve_metrics(args):
+    if not args.metrics_listen:
+        return None
+    host, port = args.metrics_listen.rsplit(':', 1)
+    return metrics.serve(host, int(port))
+
+
 def run_bot(args):
+    options = {'schedule_ttl': args.schedule_ttl, 'schedule_jitter': args.schedule_jitter,
+               'snapshot_path': args.snapshot, 'compact_schedule': args.compact_schedule}
     if os.path.exists(args.state):
-        bot = TheBot.load(args.state)
+        bot = TheBot.load(args.state, **options)
         logging.warning('Bot state loaded from %s', args.state)
     else:
-        bot = TheBot()
+        bot = TheBot(**options)
+    log = offset_log.OffsetLog(os.path.splitext(args.state)[0] + '.offsets', args.fsync_interval,
+                               args.compact_every, lambda: bot.save(args.state))
+    recovered, answered = log.recover()
+    bot.offset = max(bot.offset, recovered)
+    if args.handover_fd is not None:
+        taken = handover.take_over(args.handover_fd)
+        # the old process saved the state after this one loaded it
+        if os.path.exists(args.state):
+            saved = TheBot.load(args.state, **options)
+            for attr in bot.AttrsToSave:
+                setattr(bot, attr, getattr(saved, attr))
+        recovered, answered = log.recover()
+        bot.offset = max(bot.offset, taken['offset'], recovered)
+        if taken['snapshot'] == bot.snapshot_path:
+            bot.load_snapshot()
+        logging.warning('took over from the old process at offset %d', bot.offset)
+    # answered after the state was saved, updates answered out of order come back after a crash
+    for keys in answered:
+        bot.seen_updates.insert(keys)
+    bot.offset_log = log
+    bot.seen_updates.on_add = log.answer
+    metrics.REGISTRY.add_stats('yanbinbot_sender', lambda: bot.sender.stats)
+    metrics.REGISTRY.add_stats('yanbinbot_fetcher', lambda: schedule.fetcher.stats)
+    metrics_server = serve_metrics(args)
+    supervise.notify_ready()
+    successor = None
     while True:
-        bot.run(args.server_url, 5)
-        bot.save(args.state)
+        if args.webhook_listen:
+            import webhook
+            host, port = args.webhook_listen.rsplit(':', 1)
+            webhook.run_webhook(bot, args.server_url, host, int(port), args.webhook_url, args.webhook_secret)
+        elif args.workers:
+            import workers
+            workers.Supervisor(bot, args.server_url, args.workers, args.wait, args.poll_timeout,
+                               args.max_backoff).run()
+        elif args.engine == 'async':
+            import async_runner
+            async_runner.run_async(bot, args.server_url, args.wait, args.poll_timeout, args.max_backoff,
+                                   args.max_sends)
+        else:
+            bot.run(args.server_url, args.wait, args.poll_timeout, args.max_backoff)
+        # replies still queued after an interrupt
+        bot.sender.flush()
+        # saves the state with the last offset
+        log.compact()
         logging.warning('Bot state saved to %s', args.state)
 
-        if bot.need_restart:
+        if successor is not None:
+            # the new process binds the port once it takes over
+            if metrics_server is not None:
+                metrics_server.close()
+            if successor.complete(bot.offset, bot.snapshot_path):
+                with open(args.pid, 'w') as f_out:
+                    f_out.write('%d\n' % successor.process.pid)
+                logging.warning(BotName + ' handed over to process %d.', successor.process.pid)
+                break
+            logging.error('Could not hand over to a new process. Continuing working.')
+            metrics_server = serve_metrics(args)
+            successor = None
+            bot.need_restart = False
+        elif bot.need_restart and args.restart == 'reload':
+            if reloader.reload_bot(bot):
+                logging.warning(BotName + ' reloaded its code.')
+            else:
+                logging.error('Could not reload. Continuing working with the old code.')
+            bot.need_restart = False
+        elif bot.need_restart and args.restart == 'handover':
+            # keeps answering until the new process is ready and sets need_restart
+            bot.need_restart = False
+            successor = handover.Handover(ProgPath, sys.argv[1:], bot, args.log)
+        elif bot.need_restart:
             if restart(args):
                 logging.warning(BotName + ' restarted as a daemon.')
                 break
             logging.error('Could not restart bot. Continuing working.')
+            bot.need_restart = False
         else:
             break
 
@@ -449,6 +913,8 @@ def run_bot(args):
 def main():
     args = parse_args()
     random.seed(int(time.time()))
+    # stopping by the supervisor goes the way of Ctrl-C: sends are drained, the state is saved
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
     init(args)
     run_bot(args)
 
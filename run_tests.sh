@@ -1,3 +1,9 @@
 #!/usr/bin/env bash
 
+set -e
 PYTHONPATH=bin python3 tests/input_output_tests.py
+PYTHONPATH=bin python3 tests/schedule_tests.py
+PYTHONPATH=bin python3 tests/sender_tests.py
+PYTHONPATH=bin python3 tests/state_tests.py
+PYTHONPATH=bin python3 tests/metrics_tests.py
+PYTHONPATH=bin python3 tests/utils_tests.py
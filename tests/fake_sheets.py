@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Local stand-in for the published Google Sheets schedule page.
+
+Renders a schedule.json (as in tests/*/schedule.json) back into the
+three tables schedule.fetcher expects and serves the page over HTTP with
+ETag/Last-Modified validators, so fetching can be exercised offline:
+
+    PYTHONPATH=bin tests/fake_sheets.py tests/real_data/schedule.json > page.html
+    PYTHONPATH=bin tests/fake_sheets.py -p 8080 tests/real_data/schedule.json
+'''
+
+from schedule.fetcher import COLUMNS, SUFFIXES
+import schedule.weekday as weekday
+
+import argparse
+import email.utils
+import hashlib
+import html
+import http.server
+import json
+import re
+import threading
+import time
+
+
+TABLES = ['qigong', 'kungfu', 'children']
+LESSON_FIELDS = ['starts', 'ends', 'name', 'place', 'difficulty', 'teacher',
+                 'complex', 'comment', 'audience']
+
+
+def suffix_pattern(suffix):
+    '''Matches a field the fetcher appended the ignored column to.'''
+    before, after = suffix.split('{0}')
+    return re.compile('^(.*){0}(.*){1}$'.format(re.escape(before), re.escape(after)), re.S)
+
+
+def render_row(cells):
+    return '<tr>{0}</tr>\n'.format(''.join('<td>{0}</td>'.format(html.escape(c)) for c in cells))
+
+
+def render_table(kind, days):
+    columns = COLUMNS[kind]
+    field, suffix = SUFFIXES[kind]
+    pattern = suffix_pattern(suffix)
+    result = ['<table>\n', render_row([c or '' for c in columns])]
+    for day in weekday.days:
+        result.append(render_row([day.ru_name().capitalize()]))
+        for lesson in days.get(repr(day), []):
+            values = dict(zip(LESSON_FIELDS, lesson))
+            m = pattern.match(values[field])
+            if m:
+                values[field], values[None] = m.groups()
+            else:
+                values[None] = ''
+            result.append(render_row([values[c] for c in columns]))
+    result.append('</table>\n')
+    return ''.join(result)
+
+
+def render_schedule_html(data):
+    tables = ''.join(render_table(kind, data.get(kind, {})) for kind in TABLES)
+    return '<html><body>\n{0}</body></html>\n'.format(tables)
+
+
+class SheetHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        # If-None-Match takes precedence over If-Modified-Since (RFC 7232)
+        if 'If-None-Match' in self.headers:
+            not_modified = self.headers['If-None-Match'] == server.etag
+        else:
+            not_modified = self.headers.get('If-Modified-Since') == server.last_modified
+        if server.status != 200:
+            self.send_error(server.status)
+            return
+        if not_modified:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(server.content)))
+        self.send_header('ETag', server.etag)
+        self.send_header('Last-Modified', server.last_modified)
+        self.end_headers()
+        self.wfile.write(server.content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SheetServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, content, port=0):
+        super().__init__(('127.0.0.1', port), SheetHandler)
+        self.requests = 0
+        # answer of every request, e.g. 503 for a sheet that is down
+        self.status = 200
+        self.set_content(content)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}/pubhtml'.format(self.server_port)
+
+    def set_content(self, content):
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        self.content = content
+        self.etag = '"{0}"'.format(hashlib.sha1(content).hexdigest())
+        self.last_modified = email.utils.formatdate(time.time(), usegmt=True)
+
+
+def serve(content, port=0):
+    '''Starts a SheetServer in a daemon thread and returns it.'''
+    server = SheetServer(content, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('schedule', type=argparse.FileType('rb'), help='schedule.json to render')
+    parser.add_argument('-p', '--port', type=int, help='serve the page on this port instead of printing it')
+    return parser.parse_args()
+
+
+def main(args):
+    page = render_schedule_html(json.loads(args.schedule.read().decode('utf-8')))
+    if args.port is None:
+        print(page, end='')
+        return
+    server = SheetServer(page, args.port)
+    print('serving', server.url)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main(parse_args())
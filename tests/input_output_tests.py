@@ -3,6 +3,9 @@
 
 from cli_yanbinbot import patch_do_request, patch_schedule_fetching, TheBot
 from schedule import weekday
+from async_runner import AsyncRunner
+from webhook import WebhookServer, run_webhook
+import utils
 
 import os
 import argparse
@@ -10,6 +13,10 @@ import unittest
 import io
 import json
 import datetime
+import asyncio
+import threading
+import urllib.request
+import tempfile
 
 
 SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
@@ -23,6 +30,175 @@ class YanBinBotTest(unittest.TestCase):
     def setUp(self):
         self.bot = TheBot()
 
+    def test_async_runner(self):
+        directory = os.path.join(SCRIPT_DIRECTORY, 'whole_week')
+        patch_datetime_today()
+        patch_schedule_fetching(json.loads(read_and_close(os.path.join(directory, INPUT_OUTPUT_TEST_SCHEDULE))))
+        output = io.StringIO()
+        queries = read_and_close(os.path.join(directory, INPUT_OUTPUT_TEST_QUERIES))
+        patch_do_request(io.StringIO(queries), output, False)
+
+        runner = AsyncRunner(self.bot, 'http://stub-url.com', wait_time=0)
+        fake_do_request = utils.do_request
+        def do_request(server_url, action, data=None):
+            response = fake_do_request(server_url, action, data)
+            if action == 'getUpdates' and not response['ok']:
+                runner.stop()
+            return response
+        utils.do_request = do_request
+        asyncio.run(runner.run())
+
+        expected = read_and_close(os.path.join(directory, INPUT_OUTPUT_TEST_EXPECTED))
+        expected = ''.join(line for line in expected.splitlines(True) if not line.startswith('#'*10 + ' '))
+        self.assertEqual(expected, output.getvalue())
+        self.assertEqual(len(queries.splitlines()), self.bot.offset)
+
+    def test_webhook(self):
+        for name in ['real_data', 'whole_week']:
+            directory = os.path.join(SCRIPT_DIRECTORY, name)
+            patch_datetime_today()
+            patch_schedule_fetching(json.loads(read_and_close(os.path.join(directory, INPUT_OUTPUT_TEST_SCHEDULE))))
+            output = io.StringIO()
+            patch_do_request(io.StringIO(), output, False)
+
+            server = WebhookServer(TheBot(), 'http://stub-url.com', secret='s3cret')
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.addCleanup(server.server_close)
+            self.addCleanup(server.shutdown)
+            url = 'http://127.0.0.1:{0}/'.format(server.server_port)
+            queries = read_and_close(os.path.join(directory, INPUT_OUTPUT_TEST_QUERIES))
+            for update_id, query in enumerate(queries.splitlines(True)):
+                output.write('{0} {1} {0}\n'.format('#'*10, query.rstrip('\n')))
+                update = {'update_id': update_id,
+                          'message': {'text': query, 'from': {'username': 'You'}, 'chat': {'id': 0}}}
+                request = urllib.request.Request(url, json.dumps(update).encode('utf-8'),
+                                                 {'X-Telegram-Bot-Api-Secret-Token': 's3cret'})
+                with urllib.request.urlopen(request) as response:
+                    self.assertEqual({}, json.loads(response.read().decode('utf-8')))
+                # replies are sent after the answer
+                self.assertTrue(server.chats.join(10))
+
+            self.assertEqual(read_and_close(os.path.join(directory, INPUT_OUTPUT_TEST_EXPECTED)), output.getvalue())
+
+    def test_webhook_answers_before_replying(self):
+        sent, release = [], threading.Event()
+        self.addCleanup(setattr, utils, 'do_request', utils.do_request)
+        utils.do_request = lambda server_url, action, data=None: sent.append(data['text'])
+        bot = TheBot()
+        def process_update(update):
+            release.wait(10)
+            text = update['message']['text']
+            return [('sendMessage', {'chat_id': 0, 'text': text + str(part)}) for part in range(2)]
+        bot.process_update = process_update
+        server = WebhookServer(bot, 'http://stub-url.com')
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:{0}/'.format(server.server_port)
+        for update_id, text in enumerate(['a', 'b']):
+            update = {'update_id': update_id, 'message': {'message_id': update_id, 'text': text, 'chat': {'id': 0}}}
+            with urllib.request.urlopen(urllib.request.Request(url, json.dumps(update).encode('utf-8'))) as response:
+                self.assertEqual(200, response.status)
+        self.assertEqual([], sent)
+        release.set()
+        self.assertTrue(server.chats.join(10))
+        self.assertEqual(['a0', 'a1', 'b0', 'b1'], sent)
+
+    def test_webhook_notifies_without_updates(self):
+        bot = TheBot()
+        notified = threading.Semaphore(0)
+        bot.send_notifications = lambda server_url: notified.release()
+        webhook = threading.Thread(target=run_webhook, args=(bot, 'http://stub-url.com', '127.0.0.1', 0),
+                                   kwargs={'notify_interval': 0.01})
+        webhook.start()
+        for _ in range(3):
+            self.assertTrue(notified.acquire(timeout=10))
+        bot.need_restart = True
+        webhook.join(10)
+        self.assertFalse(webhook.is_alive())
+
+    def test_all_lessons_coalesced(self):
+        patch_datetime_today()
+        patch_schedule_fetching(json.loads(read_and_close(os.path.join(SCRIPT_DIRECTORY, 'real_data', INPUT_OUTPUT_TEST_SCHEDULE))))
+        msg = {'text': 'все', 'from': {'username': 'You'}, 'chat': {'id': 0}}
+        separate = self.bot.process_text_message(dict(msg))
+        replies = self.bot.process_update({'message': dict(msg), 'update_id': 0})
+        self.assertEqual(14, len(separate))
+        self.assertLessEqual(len(replies), 7)
+        self.assertTrue(all(len(r['text']) <= 4096 for _, r in replies))
+        self.assertEqual('\n'.join(m['text'] for m in separate), '\n'.join(r['text'] for _, r in replies))
+
+    def test_render_cache(self):
+        patch_datetime_today()
+        patch_schedule_fetching(json.loads(read_and_close(os.path.join(SCRIPT_DIRECTORY, 'real_data', INPUT_OUTPUT_TEST_SCHEDULE))))
+        msg = {'text': 'кунгфу в понедельник', 'from': {'username': 'You'}, 'chat': {'id': 0}}
+        first = self.bot.process_text_message(dict(msg))
+        self.assertEqual(first, self.bot.process_text_message(dict(msg)))
+        self.assertEqual((1, 1), (self.bot.render_cache.hits, self.bot.render_cache.misses))
+
+        self.bot.schedule_cache.set({'qigong': {}, 'kungfu': {}, 'children': {}})
+        self.assertNotEqual(first, self.bot.process_text_message(dict(msg)))
+        self.assertEqual((1, 2), (self.bot.render_cache.hits, self.bot.render_cache.misses))
+
+    def test_subscriptions(self):
+        patch_schedule_fetching(json.loads(read_and_close(os.path.join(SCRIPT_DIRECTORY, 'real_data', INPUT_OUTPUT_TEST_SCHEDULE))))
+        def say(text, chat=0):
+            msg = {'text': text, 'from': {'username': 'You'}, 'chat': {'id': chat}}
+            return self.bot.process_text_message(msg)[0]['text']
+        old = self.bot.get_schedule()
+        say('подписаться кунгфу валера')
+        say('подписаться цигун', chat=1)
+        self.assertEqual({'0': ['кунгфу валерий'], '1': ['цигун']}, self.bot.subscriptions)
+        self.assertIn('кунгфу валерий', say('подписки'))
+
+        monday = old['kungfu'][weekday.MON]
+        valery = [l for l in monday if l.teacher == 'Валерий Куртесов'][0]
+        other = [l for l in monday if l.teacher != 'Валерий Куртесов'][0]
+        lessons = [l._replace(comment='отмена') if l in (valery, other) else l for l in monday]
+        kungfu = dict(old['kungfu'])
+        kungfu[weekday.MON] = lessons
+        self.bot.schedule_cache.set(dict(old, kungfu=kungfu))
+        self.assertEqual(1, len(self.bot.outbox))
+        action, msg = self.bot.outbox[0]
+        self.assertEqual(('sendMessage', 0), (action, msg['chat_id']))
+        self.assertIn('*Понедельник, Кунг-фу*: изменилось', msg['text'])
+        self.assertIn('Валерий Куртесов', msg['text'])
+        self.assertNotIn(other.teacher, msg['text'])
+
+        say('отписаться')
+        self.assertEqual({'1': ['цигун']}, self.bot.subscriptions)
+
+    def test_reminders_survive_restart(self):
+        patch_datetime_today()
+        patch_schedule_fetching(json.loads(read_and_close(os.path.join(SCRIPT_DIRECTORY, 'real_data', INPUT_OUTPUT_TEST_SCHEDULE))))
+        msg = {'text': 'напомни за 15 минут кунгфу валера', 'from': {'username': 'You'}, 'chat': {'id': 7}}
+        self.assertIn('за 15 мин', self.bot.process_text_message(msg)[0]['text'])
+        self.bot.reminder_queue.due()
+        path = os.path.join(tempfile.mkdtemp(), 'state.json')
+        self.bot.save(path)
+
+        bot = TheBot.load(path)
+        bot.get_schedule()
+        self.assertEqual({'7': [[15, 'кунгфу валерий']]}, bot.reminders)
+        reminders = bot.reminder_queue.due(FAKE_TODAY.replace(hour=18, minute=20))
+        self.assertEqual([('7', 15, 'kungfu', weekday.MON)], [r[:4] for r in reminders])
+        self.assertEqual('Валерий Куртесов', reminders[0][4].teacher)
+
+    def test_time_filters(self):
+        patch_datetime_today()
+        patch_schedule_fetching(json.loads(read_and_close(os.path.join(SCRIPT_DIRECTORY, 'real_data', INPUT_OUTPUT_TEST_SCHEDULE))))
+        def starts(text):
+            answer = self.bot.process_text_message({'text': text, 'from': {'username': 'You'}, 'chat': {'id': 0}})
+            return [line.split('-')[0] for line in answer[0]['text'].splitlines() if line.startswith('_')]
+        self.assertEqual(['_12.00', '_18.30', '_18.30', '_20.00', '_20.00'], starts('кунгфу в понедельник'))
+        self.assertEqual(['_20.00', '_20.00'], starts('кунгфу в понедельник после 20'))
+        self.assertEqual(['_12.00', '_18.30', '_18.30'], starts('понедельник кунгфу до 20:00'))
+        self.assertEqual(['_18.30', '_18.30'], starts('понедельник с 18.30 кунгфу до 20'))
+        # it is 15.00 on Monday
+        self.assertEqual(['_20.00', '_20.00'], starts('сегодня кунгфу после 19'))
+        self.assertTrue(all('15.00' >= s[1:].zfill(5) for s in starts('сейчас')))
+        self.assertNotEqual([], starts('сейчас'))
+
 
 
 def read_and_close(path):
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from cli_yanbinbot import TheBot
+from hotlog import HotLog
+import metrics
+
+import logging
+import socket
+import unittest
+import urllib.request
+
+
+class Unprintable(object):
+    def __str__(self):
+        raise AssertionError('formatted a disabled record')
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class MetricsTest(unittest.TestCase):
+    def test_renders_cumulative_buckets(self):
+        registry = metrics.Registry()
+        histogram = registry.histogram('test_seconds', 'Test.', buckets=(0.1, 1))
+        counter = registry.counter('test_total', 'Test.')
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+        counter.inc(2)
+        registry.add_stats('test_stats', lambda: {'sent': 5, 'name': 'skipped'})
+        self.assertEqual('\n'.join([
+            '# HELP test_seconds Test.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="0.1"} 2',
+            'test_seconds_bucket{le="1"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            'test_seconds_sum 3.65',
+            'test_seconds_count 4',
+            '# HELP test_total Test.',
+            '# TYPE test_total counter',
+            'test_total 2',
+            '# TYPE test_stats_sent untyped',
+            'test_stats_sent 5',
+        ]) + '\n', registry.render())
+
+    def test_bot_steps_are_timed(self):
+        parsed = metrics.PARSE.count()
+        TheBot().parse_text('сегодня')
+        self.assertEqual(parsed + 1, metrics.PARSE.count())
+
+    def test_serves_scrapes(self):
+        registry = metrics.Registry()
+        registry.counter('test_total', 'Test.').inc()
+        server = metrics.serve('127.0.0.1', 0, registry)
+        self.addCleanup(server.close)
+        self.assertTrue(server.bound.wait(5))
+        url = 'http://127.0.0.1:%d/metrics' % server.server_port
+        with urllib.request.urlopen(url) as response:
+            self.assertEqual(metrics.CONTENT_TYPE, response.headers['Content-Type'])
+            self.assertIn('test_total 1\n', response.read().decode('utf-8'))
+
+    def test_retries_busy_port(self):
+        busy = socket.socket()
+        busy.bind(('127.0.0.1', 0))
+        busy.listen()
+        port = busy.getsockname()[1]
+        server = metrics.serve('127.0.0.1', port, metrics.Registry(), retry=0.05)
+        self.addCleanup(server.close)
+        self.assertFalse(server.bound.wait(0.2))
+        busy.close()
+        self.assertTrue(server.bound.wait(5))
+        self.assertEqual(port, server.server_port)
+
+
+class HotLogTest(unittest.TestCase):
+    def setUp(self):
+        self.log = HotLog('yanbinbot.hot.test')
+        self.handler = RecordingHandler()
+        self.log.logger.addHandler(self.handler)
+        self.addCleanup(self.log.logger.removeHandler, self.handler)
+
+    def test_disabled_records_are_not_formatted(self):
+        self.log.configure(level=logging.INFO)
+        self.log.debug('updates', updates=Unprintable())
+        self.log.info('command', command='today', chat=1)
+        self.assertEqual(['command command=today chat=1'], self.handler.messages)
+
+    def test_samples(self):
+        self.log.configure(level=logging.DEBUG, sample=0)
+        for _ in range(100):
+            self.log.debug('updates', updates=Unprintable())
+        self.log.configure(sample=0.5)
+        for _ in range(1000):
+            self.log.debug('updates', count=1)
+        self.assertTrue(300 < len(self.handler.messages) < 700)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from schedule.cache import ScheduleCache
+from schedule.compact import Compactor
+from schedule.index import ScheduleIndex
+from schedule.diff import diff, Change
+from reminders import ReminderQueue
+import datetime
+import schedule.weekday as weekday
+from cli_yanbinbot import schedule_from_json, patch_schedule_fetching, TheBot
+import schedule.fetcher
+import fake_sheets
+
+import json
+import os
+import requests
+import tempfile
+import time
+import unittest
+
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+REAL_DATA = os.path.join(SCRIPT_DIRECTORY, 'real_data')
+
+
+def read_json(path):
+    with open(path, 'rb') as f:
+        return json.loads(f.read().decode('utf-8'))
+
+
+def read_html(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def wait_for_refresh(cache):
+    while cache.refreshing:
+        time.sleep(0.001)
+
+
+class ScheduleCacheTest(unittest.TestCase):
+    def test_serves_stale_schedule_while_refreshing(self):
+        results = [1, ValueError('sheet is down'), 2]
+        def fetch():
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        loads = []
+        cache = ScheduleCache(fetch, ttl=0, retry=0)
+        cache.add_listener(lambda old, new: loads.append((old, new)))
+
+        self.assertEqual(1, cache.get())
+        self.assertEqual(1, cache.get())
+        wait_for_refresh(cache)
+        self.assertEqual(1, cache.get())
+        wait_for_refresh(cache)
+        self.assertEqual(2, cache.get())
+        self.assertEqual([(None, 1), (1, 2)], loads)
+        self.assertEqual(2, cache.version)
+
+
+class FetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.server = fake_sheets.serve(read_html(os.path.join(REAL_DATA, 'schedule.html')))
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.stats = dict(schedule.fetcher.stats)
+
+    def stat(self, name):
+        return schedule.fetcher.stats[name] - self.stats[name]
+
+    def test_fetches_saved_page(self):
+        expected = schedule_from_json(read_json(os.path.join(REAL_DATA, 'schedule.json')))
+        got = schedule.fetcher.fetch(self.server.url)
+        self.assertEqual(sorted(expected), sorted(got))
+        for kind in expected:
+            self.assertEqual({repr(day): lessons for day, lessons in expected[kind].items()}, got[kind])
+
+    def test_fails_clearly_when_sheet_is_down(self):
+        first = schedule.fetcher.fetch(self.server.url)
+        self.server.status = 503
+        self.assertRaises(requests.HTTPError, schedule.fetcher.fetch, self.server.url)
+        cache = ScheduleCache(lambda: schedule.fetcher.fetch(self.server.url), ttl=0, retry=0)
+        cache.set(first)
+        self.assertIs(first, cache.get())
+        wait_for_refresh(cache)
+        self.assertIs(first, cache.get())
+        self.server.status = 200
+        self.assertIs(first, schedule.fetcher.fetch(self.server.url))
+
+    def test_skips_unchanged_page_and_tables(self):
+        first = schedule.fetcher.fetch(self.server.url)
+        self.assertIs(first, schedule.fetcher.fetch(self.server.url))
+        self.assertEqual(1, self.stat('not_modified'))
+        self.assertEqual(3, self.stat('tables_parsed'))
+
+        page = self.server.content.replace('Иван Шавров'.encode('utf-8'), 'Иван'.encode('utf-8'))
+        self.server.set_content(page)
+        second = schedule.fetcher.fetch(self.server.url)
+        self.assertIsNot(first, second)
+        self.assertIs(first['qigong'], second['qigong'])
+        self.assertIs(first['children'], second['children'])
+        self.assertIsNot(first['kungfu'], second['kungfu'])
+        self.assertEqual(4, self.stat('tables_parsed'))
+        self.assertEqual(2, self.stat('tables_skipped'))
+        self.assertEqual(3, self.server.requests)
+
+    def test_fetches_several_sheets_in_parallel(self):
+        other = fake_sheets.serve(self.server.content.replace('Чань 1'.encode('utf-8'), 'Зал 2'.encode('utf-8')))
+        self.addCleanup(other.server_close)
+        self.addCleanup(other.shutdown)
+        self.addCleanup(schedule.fetcher.configure)
+        schedule.fetcher.configure(sources=[('center', self.server.url), ('north', other.url)], parse_workers=3)
+        got = schedule.fetcher.fetch()
+        self.assertEqual(['center/qigong', 'center/kungfu', 'center/children',
+                          'north/qigong', 'north/kungfu', 'north/children'], list(got))
+        self.assertEqual(got['center/kungfu'], schedule.fetcher.fetch(self.server.url)['kungfu'])
+        self.assertIs(got, schedule.fetcher.fetch())
+
+        index = ScheduleIndex(got)
+        self.assertEqual(['center', 'north'], index.studios)
+        center = index.select('kungfu', weekday.MON, studio='center')
+        north = index.select('kungfu', weekday.MON, studio='north')
+        self.assertEqual(list(got['center/kungfu'][repr(weekday.MON)]), list(center))
+        self.assertEqual(['Зал 2' if l.place == 'Чань 1' else l.place for l in center], [l.place for l in north])
+
+        bot = TheBot()
+        bot.schedule_cache.set(got)
+        msg = {'text': 'кунгфу в понедельник', 'from': {'username': 'You'}, 'chat': {'id': 0}}
+        text = bot.process_text_message(msg)[0]['text']
+        # every lesson shows under the studio it is in
+        self.assertLess(text.index('*Кунг-фу, center*'), text.index('*Кунг-фу, north*'))
+        self.assertLess(text.index('*Кунг-фу, north*'), text.index('Зал 2'))
+
+    def test_reads_first_tables_only(self):
+        page = ('<table><tr><th>h</th><td>a &amp; b<br>c</td><td> </td><td><span>x</span>y<td>z'
+                '<tr><td>q</td></table><table><tr><td>1</td></tr></table><table></table><table><tr><td>4')
+        chunks = [page[i:i + 7].encode('utf-8') for i in range(0, len(page), 7)]
+        self.assertEqual([[['a & b', '', schedule.fetcher.NO_TEXT, 'z'], ['q']], [['1']], []],
+                         schedule.fetcher.read_tables(chunks))
+
+
+class SnapshotTest(unittest.TestCase):
+    def test_warm_start_serves_snapshot(self):
+        self.addCleanup(setattr, schedule.fetcher, 'fetch', schedule.fetcher.fetch)
+        path = os.path.join(tempfile.mkdtemp(), 'shiyanbin.schedule.json')
+        data = read_json(os.path.join(REAL_DATA, 'schedule.json'))
+        patch_schedule_fetching(data)
+        TheBot(snapshot_path=path).get_schedule()
+
+        def failing_fetch():
+            raise IOError('no network')
+        schedule.fetcher.fetch = failing_fetch
+        bot = TheBot(snapshot_path=path)
+        got = bot.get_schedule()
+        for kind, days in schedule_from_json(data).items():
+            self.assertEqual({repr(day): lessons for day, lessons in days.items()}, got[kind])
+        wait_for_refresh(bot.schedule_cache)
+        self.assertIs(got, bot.get_schedule())
+
+    def test_reminds_after_warm_start(self):
+        self.addCleanup(setattr, schedule.fetcher, 'fetch', schedule.fetcher.fetch)
+        work = tempfile.mkdtemp()
+        path, state = os.path.join(work, 'shiyanbin.schedule.json'), os.path.join(work, 'shiyanbin.json')
+        patch_schedule_fetching(read_json(os.path.join(REAL_DATA, 'schedule.json')))
+        bot = TheBot(snapshot_path=path)
+        bot.get_schedule()
+        bot.reminder_queue.due(datetime.datetime(2016, 1, 4, 15, 0))
+        bot.reminder_queue.add('1', 30, 'кунгфу валерий')
+        bot.save(state)
+
+        def failing_fetch():
+            raise IOError('no network')
+        schedule.fetcher.fetch = failing_fetch
+        bot = TheBot.load(state, snapshot_path=path)
+        # Monday kungfu lessons of Валерий Куртесов start at 18.30 and 20.00
+        due = bot.reminder_queue.due(datetime.datetime(2016, 1, 4, 18, 0))
+        self.assertEqual([('1', 30, 'kungfu', weekday.MON, '18.30')], [r[:4] + (r[4].starts,) for r in due])
+
+
+class CompactTest(unittest.TestCase):
+    def test_compact_schedule_keeps_lessons(self):
+        plain = schedule_from_json(read_json(os.path.join(REAL_DATA, 'schedule.json')))
+        compactor = Compactor(lambda: plain)
+        got = compactor()
+        self.assertIs(got, compactor())
+        for kind, days in plain.items():
+            for day, lessons in days.items():
+                self.assertEqual([l for l in lessons if l], list(got[kind][day]))
+                self.assertEqual([l.starts for l in lessons if l], [l.starts for l in got[kind][day]])
+        self.assertIs(got['kungfu'][list(plain['kungfu'])[0]].strings, compactor.table.strings)
+        changed = dict(plain, kungfu={})
+        self.assertIs(got['qigong'], compactor.convert(changed)['qigong'])
+
+
+    def test_rebuilds_string_table(self):
+        plain = schedule_from_json(read_json(os.path.join(REAL_DATA, 'schedule.json')))
+        compactor = Compactor(None)
+        compactor.convert(plain)
+        size = len(compactor.table.strings)
+        for i in range(20):
+            # every lesson gets a comment no lesson had before
+            changed = dict(plain, kungfu={day: [l and l._replace(comment='Замена %d %r %d' % (i, day, pos))
+                                                for pos, l in enumerate(lessons)]
+                                          for day, lessons in plain['kungfu'].items()})
+            got = compactor.convert(changed)
+            self.assertEqual('Замена %d %r 0' % (i, weekday.MON), got['kungfu'][weekday.MON][0].comment)
+            # rebuilt with the strings of the current schedule only
+            self.assertLessEqual(len(compactor.table.strings), 2 * compactor.table_size)
+            self.assertLess(compactor.table_size, 2 * size)
+
+class DiffTest(unittest.TestCase):
+    def test_changes_by_slot(self):
+        old = schedule_from_json(read_json(os.path.join(REAL_DATA, 'schedule.json')))
+        monday = old['kungfu'][weekday.MON]
+        changed = monday[1]._replace(comment='New!')
+        added = monday[0]._replace(starts='21.00')
+        new = dict(old, kungfu=dict(old['kungfu'], **{repr(weekday.MON): [changed, added] + monday[2:]}))
+        self.assertEqual([Change('kungfu', weekday.MON, monday[1], changed),
+                          Change('kungfu', weekday.MON, None, added),
+                          Change('kungfu', weekday.MON, monday[0], None)], diff(old, new))
+        self.assertEqual([], diff(old, dict(old)))
+
+
+class ReminderQueueTest(unittest.TestCase):
+    def test_fires_before_lessons_and_follows_changes(self):
+        old = schedule_from_json(read_json(os.path.join(REAL_DATA, 'schedule.json')))
+        queue = ReminderQueue(lambda text: lambda discipline, lesson: lesson.teacher == text)
+        monday = datetime.datetime(2016, 1, 4, 15, 0)
+        queue.due(monday)
+        queue.update(old)
+        queue.add('1', 30, 'Валерий Куртесов')
+        # Monday kungfu lessons of Валерий Куртесов start at 18.30 and 20.00
+        self.assertEqual([], queue.due(monday.replace(hour=17, minute=59)))
+        due = queue.due(monday.replace(hour=18))
+        self.assertEqual([('1', 30, 'kungfu', weekday.MON, '18.30')], [r[:4] + (r[4].starts,) for r in due])
+
+        lessons = list(old['kungfu'][weekday.MON])
+        pos = [l.starts for l in lessons].index('20.00')
+        moved = lessons[pos]._replace(starts='20.15')
+        lessons[pos] = moved
+        new = dict(old, kungfu=dict(old['kungfu']))
+        new['kungfu'][weekday.MON] = lessons
+        queue.update(new, diff(old, new))
+        self.assertEqual([], queue.due(monday.replace(hour=19, minute=30)))
+        self.assertEqual([moved], [r[4] for r in queue.due(monday.replace(hour=19, minute=45))])
+
+        # after a week of downtime the reminder missed at 19.45 is late but its lesson
+        # has not started yet, the one at 18.00 is not sent after its lesson started
+        restored = ReminderQueue(queue.make_filter)
+        restored.update(new)
+        restored.restore(queue.subscriptions(), '2016-01-11 17:00:00')
+        self.assertEqual(['20.15'], [r[4].starts for r in restored.due(datetime.datetime(2016, 1, 11, 20, 10))])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from sender import SendScheduler
+import utils
+
+import unittest
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class SendSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.sent = []
+        self.responses = {}
+        def fake_do_request(server_url, action, data=None):
+            response = self.responses.pop(data['text'], None)
+            if response is None:
+                self.sent.append((self.clock.now, data['chat_id'], data['text']))
+            return response
+        self.addCleanup(setattr, utils, 'do_request', utils.do_request)
+        utils.do_request = fake_do_request
+        self.scheduler = SendScheduler(global_rate=30, chat_rate=1, chat_burst=2,
+                                       clock=self.clock, sleep=self.clock.sleep)
+
+    def submit(self, chat_id, text):
+        self.scheduler.submit('http://stub-url.com', 'sendMessage', {'chat_id': chat_id, 'text': text})
+
+    def test_limits_chat_and_keeps_order(self):
+        for i in range(4):
+            self.submit(1, 'long %d %s' % (i, 'x' * 1000))
+        self.submit(2, 'short')
+        self.scheduler.flush()
+        self.assertEqual([(0., 2), (0., 1), (0., 1), (1., 1), (2., 1)],
+                         [(t, chat) for t, chat, _ in self.sent])
+        self.assertEqual(['long 0', 'long 1', 'long 2', 'long 3'],
+                         [text[:6] for _, chat, text in self.sent if chat == 1])
+        self.assertEqual(5, self.scheduler.stats['max_queue_depth'])
+        self.assertEqual(0, self.scheduler.pending())
+
+    def test_short_replies_go_first(self):
+        self.submit(1, 'x' * 1000)
+        self.submit(2, 'short')
+        self.scheduler.flush()
+        self.assertEqual([2, 1], [chat for _, chat, _ in self.sent])
+
+    def test_requeues_after_retry_after(self):
+        self.responses['first'] = {'ok': False, 'error_code': 429, 'parameters': {'retry_after': 5}}
+        self.submit(1, 'first')
+        self.submit(1, 'second')
+        self.submit(2, 'other')
+        self.scheduler.flush()
+        self.assertEqual([(0., 2, 'other'), (5., 1, 'first'), (5., 1, 'second')], self.sent)
+        self.assertEqual(1, self.scheduler.stats['retried'])
+        self.assertEqual(5., self.scheduler.stats['max_wait_seconds'])
+
+
+
+    def test_flush_gives_up_on_throttled_message(self):
+        limited = {'ok': False, 'error_code': 429, 'parameters': {'retry_after': 5}}
+        sent = []
+        def fake_do_request(server_url, action, data=None):
+            if data['chat_id'] == 1:
+                return limited
+            sent.append((self.clock.now, data['text']))
+        utils.do_request = fake_do_request
+        scheduler = SendScheduler(max_retries=2, clock=self.clock, sleep=self.clock.sleep)
+        for chat_id, text in [(1, 'stuck'), (2, 'other')]:
+            scheduler.submit('http://stub-url.com', 'sendMessage', {'chat_id': chat_id, 'text': text})
+        scheduler.flush()
+        self.assertEqual([(0., 'other')], sent)
+        self.assertEqual((0, 3, 10.), (scheduler.pending(), scheduler.stats['retried'], self.clock.now))
+
+    def test_send_gives_up_and_leaves_waiting_to_caller(self):
+        limited = {'ok': False, 'error_code': 429, 'parameters': {'retry_after': 5}}
+        utils.do_request = lambda server_url, action, data=None: limited
+        slept = []
+        scheduler = SendScheduler(max_retries=2, clock=self.clock, sleep=slept.append)
+        delays = []
+        for delay in scheduler.sending('http://stub-url.com', 'sendMessage', {'chat_id': 1, 'text': 'hi'}):
+            delays.append(delay)
+            self.clock.now += delay
+        # the caller waited between attempts, the scheduler never slept
+        self.assertEqual(([5., 5.], []), (delays, slept))
+        self.assertEqual(3, scheduler.stats['retried'])
+
+
+if __name__ == '__main__':
+    unittest.main()
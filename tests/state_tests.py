@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from async_runner import AsyncRunner
+from dedup import SeenUpdates
+from offset_log import OffsetLog, RECORD
+import offset_log
+from cli_yanbinbot import TheBot
+import handover
+import reloader
+import schedule.fetcher
+import schedule.snapshot
+import supervise
+import utils
+import workers
+
+import asyncio
+import http.server
+import json
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+
+class OffsetLogTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'shiyanbin.offsets')
+
+    def test_recovers_last_good_record(self):
+        log = OffsetLog(self.path, interval=0, compact_every=0)
+        for offset in range(1, 201):
+            log.append(offset)
+        log.close()
+        self.assertEqual(200 * RECORD.size, os.path.getsize(self.path))
+        with open(self.path, 'ab') as f_out:
+            # a torn record and a corrupted one
+            f_out.write(RECORD.pack(offset_log.pack(offset_log.OFFSET, 500)[:-4], 0) + b'\x01\x02')
+        log = OffsetLog(self.path, interval=0, compact_every=0)
+        self.assertEqual((200, []), log.recover())
+        self.assertEqual(200 * RECORD.size, os.path.getsize(self.path))
+        # appended after the last good record, not after the torn one
+        for offset in range(201, 211):
+            log.append(offset)
+        log.close()
+        self.assertEqual((210, []), OffsetLog(self.path).recover())
+
+    def test_groups_writes_and_compacts(self):
+        saved = []
+        log = OffsetLog(self.path, interval=3600, compact_every=2, save_state=lambda: saved.append(log.pending))
+        log.append(1)
+        for offset in range(2, 100):
+            log.append(offset)
+        self.assertEqual(1, log.stats['writes'])
+        log.flush()
+        # only compact_if_due saves the state, never the flushing timer
+        self.assertEqual([], saved)
+        self.assertTrue(log.compact_if_due())
+        self.assertEqual([99], saved)
+        self.assertFalse(log.compact_if_due())
+        self.assertEqual(0, os.path.getsize(self.path))
+        log.append(100)
+        log.close()
+        self.assertEqual((100, []), OffsetLog(self.path).recover())
+
+    def test_bot_state_is_replaced_atomically(self):
+        state = os.path.join(self.dir, 'shiyanbin.json')
+        bot = TheBot()
+        bot.offset_log = OffsetLog(self.path, interval=0, save_state=lambda: bot.save(state))
+        bot.offset = 42
+        bot.offset_log.compact()
+        self.assertEqual(['shiyanbin.json', 'shiyanbin.offsets'], sorted(os.listdir(self.dir)))
+        with open(state) as f_in:
+            self.assertEqual(42, json.load(f_in)['offset'])
+        self.assertEqual(42, TheBot.load(state).offset)
+
+
+def make_update(update_id, chat=1, message=None, text='сегодня'):
+    return {'update_id': update_id,
+            'message': {'message_id': message or update_id, 'chat': {'id': chat}, 'text': text}}
+
+
+class SeenUpdatesTest(unittest.TestCase):
+    def test_forgets_the_oldest(self):
+        seen = SeenUpdates(capacity=3)
+        for update_id in range(5):
+            seen.add(make_update(update_id))
+        self.assertEqual(3, len(seen))
+        self.assertEqual([False, False, True, True, True], [seen.seen(make_update(i)) for i in range(5)])
+
+    def test_knows_message_of_another_update(self):
+        seen = SeenUpdates()
+        seen.add(make_update(1, chat=7, message=30))
+        self.assertTrue(seen.seen(make_update(2, chat=7, message=30)))
+        self.assertFalse(seen.seen(make_update(2, chat=8, message=30)))
+        self.assertFalse(seen.seen({'update_id': 3}))
+
+    def test_replay_after_failed_batch_sends_nothing(self):
+        sent = []
+        def fake_do_request(server_url, action, data=None):
+            if action == 'getUpdates':
+                return {'ok': True, 'result': [make_update(10), make_update(11, text='\x00boom')]}
+            sent.append(data['chat_id'])
+            return {'ok': True}
+        self.addCleanup(setattr, utils, 'do_request', utils.do_request)
+        utils.do_request = fake_do_request
+        bot = TheBot()
+        def process_update(update):
+            if '\x00' in update['message']['text']:
+                raise ValueError('boom')
+            return [('sendMessage', {'chat_id': 1, 'text': 'answer'})]
+        bot.process_update = process_update
+        bot.offset = 10
+        self.assertRaises(ValueError, bot.process_response, 'http://stub-url.com')
+        self.assertEqual(([1], 11), (sent, bot.offset))
+        # the next poll gets the whole batch again
+        bot.process_update = lambda update: [('sendMessage', {'chat_id': 2, 'text': 'again'})]
+        bot.process_response('http://stub-url.com')
+        self.assertEqual(([1, 2], 12), (sent, bot.offset))
+
+    def test_replay_after_crash_sends_nothing(self):
+        work = tempfile.mkdtemp()
+        path = os.path.join(work, 'shiyanbin.offsets')
+        bot = TheBot()
+        bot.offset_log = OffsetLog(path, interval=3600, save_state=lambda: bot.save(os.path.join(work, 'state')))
+        bot.seen_updates.on_add = bot.offset_log.answer
+        bot.offset = 10
+        # answered out of order, the offset waits for update 10
+        bot.seen_updates.add(make_update(11))
+        bot.offset_log.flush()
+        # crashed: the state was never saved and the log not closed
+        sent = []
+        def fake_do_request(server_url, action, data=None):
+            if action == 'getUpdates':
+                return {'ok': True, 'result': [make_update(10, chat=1), make_update(11, chat=2)]}
+            sent.append(data['chat_id'])
+            return {'ok': True}
+        self.addCleanup(setattr, utils, 'do_request', utils.do_request)
+        utils.do_request = fake_do_request
+        bot = TheBot()
+        offset, answered = OffsetLog(path).recover()
+        self.assertEqual((10, [(11, 1, 11)]), (offset, answered))
+        bot.offset = offset
+        for keys in answered:
+            bot.seen_updates.insert(keys)
+        bot.process_update = lambda update: [('sendMessage', {'chat_id': update['message']['chat']['id'], 'text': 'a'})]
+        bot.process_response('http://stub-url.com')
+        self.assertEqual(([1], 12), (sent, bot.offset))
+
+
+class PollTest(unittest.TestCase):
+    def run_bot(self, responses, **kwargs):
+        requests, delays = [], []
+        responses = iter(responses)
+        bot = TheBot()
+        def fake_do_request(server_url, action, data=None):
+            requests.append(data)
+            return next(responses, None)
+        def fake_sleep(delay):
+            delays.append(delay)
+            bot.need_restart = len(delays) == 6
+        self.addCleanup(setattr, utils, 'do_request', utils.do_request)
+        self.addCleanup(setattr, time, 'sleep', time.sleep)
+        utils.do_request = fake_do_request
+        time.sleep = fake_sleep
+        bot.run('http://stub-url.com', **kwargs)
+        return requests, delays
+
+    def test_sends_poll_timeout(self):
+        requests, delays = self.run_bot([{'ok': True, 'result': []}] * 7, wait_time=1, poll_timeout=30)
+        self.assertEqual([{'offset': 0, 'timeout': 30}] * 7, requests)
+        self.assertEqual([0] * 6, delays)
+        requests, delays = self.run_bot([{'ok': True, 'result': []}] * 7, wait_time=1)
+        self.assertEqual([{'offset': 0}] * 7, requests)
+        self.assertEqual([1] * 6, delays)
+
+    def test_backoff_doubles_up_to_max_and_resets(self):
+        ok = {'ok': True, 'result': []}
+        requests, delays = self.run_bot([None, None, None, None, ok, None], wait_time=1, poll_timeout=30,
+                                        max_backoff=4)
+        self.assertEqual([1, 2, 4, 4, 0, 1], delays)
+
+
+class AsyncRunnerTest(unittest.TestCase):
+    def test_polls_from_committed_offset_with_limited_pending(self):
+        updates = [make_update(update_id, chat=update_id % 3) for update_id in range(1, 11)]
+        requests, answering, most = [], [], [0]
+        lock = threading.Lock()
+        bot = TheBot()
+        runner = AsyncRunner(bot, 'http://stub-url.com', wait_time=0, max_pending=3)
+
+        def fake_do_request(server_url, action, data=None):
+            requests.append((data['offset'], runner.offsets.committed))
+            if data['offset'] > 10:
+                runner.stop()
+            return {'ok': True, 'result': [u for u in updates if u['update_id'] >= data['offset']][:data['limit']]}
+
+        def process_update(update):
+            with lock:
+                answering.append(update['update_id'])
+                most[0] = max(most[0], len(runner.offsets.pending))
+            time.sleep(0.01)
+            return []
+        self.addCleanup(setattr, utils, 'do_request', utils.do_request)
+        utils.do_request = fake_do_request
+        bot.process_update = process_update
+        asyncio.run(runner.run())
+        runner.executor.shutdown()
+        self.assertEqual(list(range(1, 11)), sorted(answering))
+        self.assertEqual(11, bot.offset)
+        self.assertLessEqual(most[0], 3)
+        # never confirmed an update to Telegram before it was answered; committed is read on
+        # an executor thread while chats answer, it may have moved on since the request was made
+        self.assertTrue(all(offset <= committed for offset, committed in requests), requests)
+
+
+class SupervisorTest(unittest.TestCase):
+    def setUp(self):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                body = b'{"ok": true, "result": {}}'
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def test_starts_dead_worker_again_with_its_updates(self):
+        snapshot = os.path.join(tempfile.mkdtemp(), 'shiyanbin.schedule.json')
+        schedule.snapshot.save(snapshot, {}, time.time())
+        bot = TheBot(snapshot_path=snapshot)
+        bot.offset = 1
+        supervisor = workers.Supervisor(bot, 'http://127.0.0.1:%d/bot' % self.server.server_port, 1)
+        self.addCleanup(setattr, utils, 'do_request', utils.do_request)
+        utils.do_request = lambda server_url, action, data=None: {'ok': True, 'result': [make_update(1)]}
+        dead = supervisor.processes[0]
+        dead.start()
+        dead.kill()
+        dead.join()
+        supervisor.get_updates()
+        supervisor.collect_acks(30)
+        started = supervisor.processes[0]
+        self.addCleanup(started.join)
+        self.addCleanup(supervisor.tasks[0].put, None)
+        self.assertIsNot(dead, started)
+        self.assertTrue(started.is_alive())
+        self.assertEqual((2, []), (bot.offset, list(supervisor.offsets.pending)))
+
+    def test_polls_from_committed_offset_with_limited_pending(self):
+        snapshot = os.path.join(tempfile.mkdtemp(), 'shiyanbin.schedule.json')
+        schedule.snapshot.save(snapshot, {}, time.time())
+        bot = TheBot(snapshot_path=snapshot)
+        bot.offset = 1
+        updates = [make_update(update_id, chat=update_id % 3) for update_id in range(1, 8)]
+        supervisor = workers.Supervisor(bot, 'http://127.0.0.1:%d/bot' % self.server.server_port, 2,
+                                        wait_time=0, max_pending=3)
+        requests, most = [], [0]
+
+        def fake_do_request(server_url, action, data=None):
+            requests.append((data['offset'], data['limit'], supervisor.offsets.committed))
+            most[0] = max(most[0], len(supervisor.offsets.pending))
+            if data['offset'] > 7:
+                supervisor.stop()
+            return {'ok': True, 'result': [u for u in updates if u['update_id'] >= data['offset']][:data['limit']]}
+        self.addCleanup(setattr, utils, 'do_request', utils.do_request)
+        utils.do_request = fake_do_request
+        supervisor.run()
+        self.assertEqual(8, bot.offset)
+        self.assertLessEqual(most[0], 3)
+        # never confirmed an update to Telegram before a worker answered it
+        self.assertEqual([(committed, 3) for _, _, committed in requests], [r[:2] for r in requests])
+
+
+class RestartTest(unittest.TestCase):
+    def test_reload_keeps_state_and_schedule(self):
+        bot = TheBot()
+        bot.offset = 5
+        bot.subscriptions = {'1': ['кунгфу']}
+        schdl = {'kungfu': {}}
+        bot.schedule_cache.set(schdl)
+        self.addCleanup(schedule.fetcher._validators.pop, 'link', None)
+        schedule.fetcher._validators['link'] = {'ETag': 'x'}
+        old_class = type(bot)
+        self.assertTrue(reloader.reload_bot(bot))
+        self.assertIsNot(old_class, type(bot))
+        self.assertIs(sys.modules['yanbinbot'].TheBot, type(bot))
+        self.assertEqual((5, {'1': ['кунгфу']}), (bot.offset, bot.subscriptions))
+        self.assertIs(schdl, bot.get_schedule())
+        self.assertEqual({'ETag': 'x'}, schedule.fetcher._validators['link'])
+        self.assertIn(bot.notify_subscribers, bot.schedule_cache.listeners)
+        self.assertEqual(('сегодня', ''), bot.parse_text('сегодня'))
+
+    def test_hands_over_offset(self):
+        work = tempfile.mkdtemp()
+        prog = os.path.join(work, 'new_bot.py')
+        with open(prog, 'w') as f_out:
+            f_out.write('import handover, json, sys\n'
+                        'taken = handover.take_over(int(sys.argv[-1]))\n'
+                        'json.dump([sys.argv[1:-2], taken], open(%r, "w"))\n' % os.path.join(work, 'taken.json'))
+        bot = TheBot()
+        successor = handover.Handover(prog, ['-s', 'state.json', '--handover-fd', '3'], bot, os.path.join(work, 'log'))
+        self.assertTrue(successor.ready.wait(handover.READY_TIMEOUT))
+        while not bot.need_restart:
+            time.sleep(0.01)
+        # the engine that runs until complete() is not stopped again
+        bot.need_restart = False
+        successor.watcher.join()
+        self.assertFalse(bot.need_restart)
+        self.assertTrue(successor.complete(42, 'snapshot.json'))
+        successor.process.wait()
+        with open(os.path.join(work, 'taken.json')) as f_in:
+            self.assertEqual([['-s', 'state.json'], {'offset': 42, 'snapshot': 'snapshot.json'}], json.load(f_in))
+
+    def test_stops_engine_when_new_process_dies(self):
+        work = tempfile.mkdtemp()
+        prog = os.path.join(work, 'new_bot.py')
+        with open(prog, 'w') as f_out:
+            f_out.write('import sys\nsys.exit(1)\n')
+        bot = TheBot()
+        successor = handover.Handover(prog, [], bot, os.path.join(work, 'log'))
+        successor.watcher.join(handover.READY_TIMEOUT)
+        self.assertTrue(bot.need_restart)
+        self.assertFalse(successor.ready.is_set())
+        self.assertFalse(successor.complete(42, 'snapshot.json'))
+        self.assertEqual(1, successor.process.wait())
+
+    def test_failed_reload_keeps_old_code(self):
+        work = tempfile.mkdtemp()
+        path = os.path.join(work, 'reloaded_module.py')
+        with open(path, 'w') as f_out:
+            f_out.write('KEEP_ON_RELOAD = ["state"]\nstate = {}\n')
+        sys.path.insert(0, work)
+        self.addCleanup(sys.path.remove, work)
+        self.addCleanup(sys.modules.pop, 'reloaded_module', None)
+        import reloaded_module
+        state = reloaded_module.state
+        with open(path, 'w') as f_out:
+            f_out.write('raise ImportError("broken new code")\n')
+        self.addCleanup(setattr, reloader, 'RELOADED', reloader.RELOADED)
+        reloader.RELOADED = ['reloaded_module'] + reloader.RELOADED
+        bot = TheBot()
+        bot.offset = 5
+        old_class = type(bot)
+        self.assertFalse(reloader.reload_bot(bot))
+        self.assertIs(old_class, type(bot))
+        self.assertIs(state, sys.modules['reloaded_module'].state)
+        self.assertEqual(5, bot.offset)
+        self.assertEqual(('сегодня', ''), bot.parse_text('сегодня'))
+
+
+class SuperviseTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.runs = os.path.join(self.dir, 'runs')
+
+    def script(self, body):
+        path = os.path.join(self.dir, 'command.py')
+        with open(path, 'w') as f_out:
+            f_out.write('import os, sys, supervise\n'
+                        'runs = open(%r, "a+")\n'
+                        'runs.write("x")\n'
+                        'runs.seek(0)\n'
+                        'count = len(runs.read())\n'
+                        '%s\n' % (self.runs, body))
+        return [sys.executable, path]
+
+    def test_backoff_doubles_up_to_max(self):
+        delays = [0]
+        for _ in range(8):
+            delays.append(supervise.backoff_delay(delays[-1], 1, 60))
+        self.assertEqual([1, 2, 4, 8, 16, 32, 60, 60], delays[1:])
+
+    def test_restarts_until_clean_exit(self):
+        cmd = self.script('sys.exit(0 if count == 3 else 2)')
+        supervisor = supervise.ProcessSupervisor(cmd, os.path.join(self.dir, 'pid'), min_backoff=0.01)
+        self.assertEqual(0, supervisor.run())
+        self.assertEqual(3, supervisor.starts)
+        with open(os.path.join(self.dir, 'pid')) as f_in:
+            self.assertEqual(supervisor.process.pid, int(f_in.read()))
+
+    def test_start_returns_when_ready(self):
+        pid_path = os.path.join(self.dir, 'pid')
+        started = time.monotonic()
+        self.assertTrue(supervise.start(self.script('supervise.notify_ready()'), pid_path,
+                                        os.path.join(self.dir, 'log')))
+        self.assertLess(time.monotonic() - started, 3)
+        self.assertEqual(0o644, os.stat(pid_path).st_mode & 0o777)
+        self.assertFalse(supervise.start(self.script('sys.exit(0)'), timeout=10))
+
+    def test_supervisor_is_a_new_interpreter(self):
+        pid_path = os.path.join(self.dir, 'pid')
+        self.assertTrue(supervise.start(self.script('supervise.notify_ready()\nimport time\ntime.sleep(60)'),
+                                        pid_path))
+        with open(pid_path) as f_in:
+            pid = int(f_in.read())
+        with open('/proc/%d/stat' % pid) as f_in:
+            supervisor = int(f_in.read().rsplit(')', 1)[1].split()[1])
+        self.addCleanup(os.killpg, supervisor, signal.SIGTERM)
+        # not a fork of this process with its threads
+        self.assertEqual(supervisor, os.getsid(supervisor))
+        with open('/proc/%d/cmdline' % supervisor, 'rb') as f_in:
+            self.assertIn(b'supervise.py', f_in.read())
+
+    def test_stops_command_that_does_not_get_ready(self):
+        pid_path = os.path.join(self.dir, 'pid')
+        self.assertFalse(supervise.start(self.script('import time; time.sleep(60)'), pid_path, timeout=0.5))
+        with open(pid_path) as f_in:
+            pid = int(f_in.read())
+        deadline = time.monotonic() + 5
+        while os.path.exists('/proc/%d' % pid) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(os.path.exists('/proc/%d' % pid))
+
+
+if __name__ == '__main__':
+    unittest.main()
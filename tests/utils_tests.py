@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import utils
+
+import http.server
+import threading
+import unittest
+
+
+class RetryTest(unittest.TestCase):
+    def setUp(self):
+        hits = self.hits = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                hits.append(self.path)
+                status, body = (502, b'') if len(hits) % 2 else (200, b'{"ok": true, "result": []}')
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(utils.configure)
+        sessions = utils.configure(retry_backoff=0)
+        for session in sessions.values():
+            self.addCleanup(session.close)
+        self.url = 'http://127.0.0.1:%d/bot' % self.server.server_port
+
+    def test_retries_bad_gateway_for_reads_only(self):
+        self.assertEqual({'ok': True, 'result': []}, utils.do_request(self.url, 'getUpdates', {'offset': 1}))
+        self.assertEqual(['/bot/getUpdates', '/bot/getUpdates'], self.hits)
+        # the proxy may have passed it on, a second reply could reach the chat
+        self.assertIsNone(utils.do_request(self.url, 'sendMessage', {'chat_id': 1, 'text': 'hi'}))
+        self.assertEqual(['/bot/sendMessage'], self.hits[2:])
+
+
+if __name__ == '__main__':
+    unittest.main()